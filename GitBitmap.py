@@ -0,0 +1,179 @@
+import hashlib
+import mmap
+import os
+import struct
+from GitEwah import ewah_parse_int, ewah_serialize_int
+from GitPack import pack_list
+
+# Reachability bitmaps (pack-*.bitmap), in git's format, version 1.
+# For some commits of a pack, a bitmap of every object reachable from
+# the commit: bit i stands for the i-th object of the pack, in pack
+# order (see GitPack.revindex()).  "What's reachable from these commits
+# but not those" is then a matter of | and & ~ on bitmaps.
+#
+# A header ("BITM", version, flags, number of commits, the pack's
+# checksum), then four EWAH bitmaps telling the objects' types
+# (commits, trees, blobs, tags), then for each commit: its position in
+# the pack index, a XOR offset, flags, and its EWAH bitmap.  With a XOR
+# offset n, the real bitmap is this one XORed with the real bitmap of
+# the n-th previous commit, which makes the bitmaps of close commits
+# small.  Then optionally the name hashes of the objects, in index
+# order, and a SHA-1 of it all.
+
+BITMAP_SIGNATURE = b"BITM"
+BITMAP_VERSION = 1
+# The pack holds everything reachable from its objects
+BITMAP_OPT_FULL_DAG = 0x1
+BITMAP_OPT_HASH_CACHE = 0x4
+BITMAP_OPT_LOOKUP_TABLE = 0x10
+BITMAP_TYPES = (b'commit', b'tree', b'blob', b'tag')
+# How many previous bitmaps to try XORing a bitmap against
+BITMAP_XOR_WINDOW = 10
+
+class GitBitmap(object):
+    """ The reachability bitmaps of a pack, memory-mapped.  Bitmaps are
+    Python ints, decoded on first use. """
+
+    def __init__(self, pack, path):
+        self.pack = pack
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+
+        if data[0:4] != BITMAP_SIGNATURE:
+            raise Exception(f"Not a bitmap file: {path}")
+        version, flags, count = struct.unpack_from(">HHL", data, 4)
+        if version != BITMAP_VERSION:
+            raise Exception(f"Unsupported bitmap version {version} in {path}")
+        if not flags & BITMAP_OPT_FULL_DAG:
+            raise Exception(f"Unsupported bitmap {path}: the pack isn't closed under reachability")
+        if data[12:32] != pack.pack[-20:]:
+            raise Exception(f"Bitmap {path} doesn't match its pack")
+
+        offset = 32
+        self.types = dict()
+        for fmt in BITMAP_TYPES:
+            self.types[fmt], _, offset = ewah_parse_int(data, offset)
+
+        # Index position of each commit -> its entry.  Entries are (offset
+        # of the EWAH bitmap, XOR offset), and only decoded when needed.
+        self.commits = dict()
+        self.entries = list()
+        for i in range(count):
+            pos, xor, _ = struct.unpack_from(">LBB", data, offset)
+            offset += 6
+            self.commits[pos] = i
+            self.entries.append((offset, xor))
+            words = struct.unpack_from(">L", data, offset + 4)[0]
+            offset += 8 + 8 * words + 4
+
+        self.hash_cache = None
+        if flags & BITMAP_OPT_HASH_CACHE:
+            self.hash_cache = offset
+            offset += 4 * len(pack)
+        if offset > len(data) - 20:
+            raise Exception(f"Malformed bitmap {path}: truncated")
+
+        self.cache = dict()
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def commit_bitmap(self, sha):
+        """ Return the bitmap of commit sha (binary), or None if it has
+        none. """
+        pos = self.pack.find(sha)
+        if pos is None or pos not in self.commits:
+            return None
+        return self.entry(self.commits[pos])
+
+    def entry(self, i):
+        """ Return the bitmap of the i-th entry, undoing XORs. """
+        # Follow the XOR chain down to an entry we know, or a plain
+        # one...
+        chain = list()
+        while i not in self.cache:
+            chain.append(i)
+            xor = self.entries[i][1]
+            if not xor:
+                break
+            i -= xor
+        # ...and decode up from there.
+        for i in reversed(chain):
+            offset, xor = self.entries[i]
+            value, _, _ = ewah_parse_int(self.data, offset)
+            if xor:
+                value ^= self.cache[i - xor]
+            self.cache[i] = value
+        return self.cache[i]
+
+    def name_hash(self, pos):
+        """ Return the name hash of the object at index position pos, or
+        0 if the file has none. """
+        if self.hash_cache is None:
+            return 0
+        return struct.unpack_from(">L", self.data, self.hash_cache + 4 * pos)[0]
+
+def pack_bitmap(repo):
+    """ Return the GitBitmap of repo's bitmapped pack, or None if there's
+    none (or pack.useBitmaps is false). """
+    if not repo.conf.getboolean("pack", "usebitmaps", fallback=True):
+        return None
+    for pack in pack_list(repo):
+        if pack.bitmap is None:
+            path = pack.path[:-len(".pack")] + ".bitmap"
+            if not os.path.exists(path):
+                continue
+            pack.bitmap = GitBitmap(pack, path)
+        return pack.bitmap
+    return None
+
+def bitmap_positions(value):
+    """ Yield the positions of the bits set in value, an int bitmap """
+    data = value.to_bytes((value.bit_length() + 7) // 8, "little")
+    for (i, byte) in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield 8 * i + low.bit_length() - 1
+            byte ^= low
+
+def bitmap_write(pack, types, commits, hashes=None):
+    """ Write the bitmap file of pack.  types maps each object type to
+    the bitmap of the objects of that type.  commits is a list of (index
+    position, bitmap) pairs, in the order to write them: close commits
+    should come together, as bitmaps are XORed against the previous
+    ones.  hashes, if given, lists the objects' name hashes in index
+    order. """
+    flags = BITMAP_OPT_FULL_DAG | (BITMAP_OPT_HASH_CACHE if hashes is not None else 0)
+    out = bytearray(BITMAP_SIGNATURE)
+    out += struct.pack(">HHL", BITMAP_VERSION, flags, len(commits))
+    out += pack.pack[-20:]
+    for fmt in BITMAP_TYPES:
+        out += ewah_serialize_int(types.get(fmt, 0))
+
+    for (i, (pos, value)) in enumerate(commits):
+        # XOR against the previous bitmap closest to this one, if that
+        # leaves fewer bits set.
+        best = value
+        xor = 0
+        for j in range(max(0, i - BITMAP_XOR_WINDOW), i):
+            candidate = value ^ commits[j][1]
+            if candidate.bit_count() < best.bit_count():
+                best = candidate
+                xor = i - j
+        out += struct.pack(">LBB", pos, xor, 0)
+        out += ewah_serialize_int(best)
+
+    if hashes is not None:
+        out += struct.pack(f">{len(hashes)}L", *hashes)
+    out += hashlib.sha1(out).digest()
+
+    path = pack.path[:-len(".pack")] + ".bitmap"
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(out)
+    os.replace(tmp_path, path)
@@ -0,0 +1,112 @@
+import struct
+
+# Changed-path Bloom filters, as git stores them in the commit-graph
+# (BIDX and BDAT chunks, version 1).  Each commit gets a filter of the
+# paths it changed compared to its first parent, leading directories
+# included.  A filter answers "definitely not changed" or "maybe", so
+# that path-limited walks only diff the trees of commits that may have
+# touched the path.
+#
+# Every path sets BLOOM_HASHES bits, from two murmur3 hashes combined
+# as hash0 + i * hash1.  Filters get BLOOM_BITS_PER_ENTRY bits per
+# path.  Commits changing more than BLOOM_MAX_CHANGED_PATHS files get a
+# one-byte filter with all bits set, which says "maybe" to everything.
+
+BLOOM_VERSION = 1
+BLOOM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGED_PATHS = 512
+BLOOM_SEED0 = 0x293ae76f
+BLOOM_SEED1 = 0x7e646e2c
+BLOOM_TRUNCATED = b'\xff'
+
+MURMUR_MASK = 0xFFFFFFFF
+
+def murmur3(seed, data):
+    """ 32-bit murmur3 of data (bytes), as git's version 1 filters
+    compute it.  git reads bytes as (signed) chars there, so bytes
+    above 127 are sign-extended: we do the same, to build filters git
+    can use. """
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+
+    signed = [ b - 256 if b > 127 else b for b in data ]
+    blocks = len(data) // 4
+    for i in range(blocks):
+        k = (signed[4*i] | (signed[4*i+1] << 8) | (signed[4*i+2] << 16) | (signed[4*i+3] << 24)) & MURMUR_MASK
+        k = (k * c1) & MURMUR_MASK
+        k = ((k << 15) | (k >> 17)) & MURMUR_MASK
+        k = (k * c2) & MURMUR_MASK
+        seed ^= k
+        seed = ((seed << 13) | (seed >> 19)) & MURMUR_MASK
+        seed = (seed * 5 + 0xe6546b64) & MURMUR_MASK
+
+    tail = signed[4*blocks:]
+    if tail:
+        k = 0
+        for (i, b) in enumerate(tail):
+            k ^= (b << (8 * i)) & MURMUR_MASK
+        k = (k * c1) & MURMUR_MASK
+        k = ((k << 15) | (k >> 17)) & MURMUR_MASK
+        k = (k * c2) & MURMUR_MASK
+        seed ^= k
+
+    seed ^= len(data)
+    seed ^= seed >> 16
+    seed = (seed * 0x85ebca6b) & MURMUR_MASK
+    seed ^= seed >> 13
+    seed = (seed * 0xc2b2ae35) & MURMUR_MASK
+    seed ^= seed >> 16
+    return seed
+
+def bloom_key(path, hashes=BLOOM_HASHES):
+    """ Return the hashes of path (a str, without trailing slash) """
+    data = path.encode("utf8")
+    hash0 = murmur3(BLOOM_SEED0, data)
+    hash1 = murmur3(BLOOM_SEED1, data)
+    return [ (hash0 + i * hash1) & MURMUR_MASK for i in range(hashes) ]
+
+def bloom_path_keys(path, hashes=BLOOM_HASHES):
+    """ Return the keys of path and of each of its leading directories:
+    all of them are in the filter of a commit that changed path. """
+    parts = path.split("/")
+    return [ bloom_key("/".join(parts[:i]), hashes) for i in range(1, len(parts) + 1) ]
+
+def bloom_filter(paths):
+    """ Return the filter of a commit that changed paths, a list of
+    file paths.  Their leading directories are added too.  Return
+    BLOOM_TRUNCATED if there are too many. """
+    if len(paths) > BLOOM_MAX_CHANGED_PATHS:
+        return BLOOM_TRUNCATED
+
+    keys = set()
+    for path in paths:
+        while path and path not in keys:
+            keys.add(path)
+            path = path.rpartition("/")[0]
+
+    # An empty filter still takes a byte, with no bit set.
+    size = max(1, (len(keys) * BLOOM_BITS_PER_ENTRY + 7) // 8)
+    data = bytearray(size)
+    bits = size * 8
+    for key in keys:
+        for h in bloom_key(key):
+            h %= bits
+            data[h >> 3] |= 1 << (h & 7)
+    return bytes(data)
+
+def bloom_contains(data, key):
+    """ Return False if the filter data definitely doesn't hold key,
+    True if it may. """
+    bits = len(data) * 8
+    if not bits:
+        return True
+    for h in key:
+        h %= bits
+        if not data[h >> 3] & (1 << (h & 7)):
+            return False
+    return True
+
+def bloom_settings_serialize():
+    """ The header of the BDAT chunk """
+    return struct.pack(">LLL", BLOOM_VERSION, BLOOM_HASHES, BLOOM_BITS_PER_ENTRY)
@@ -0,0 +1,449 @@
+import hashlib
+import mmap
+import os
+import struct
+from GitRepository import GitLock, repo_dir, repo_file
+from GitObject import GitCommit, GitTag, GitTree, object_read_raw
+from GitBloom import *
+
+# The commit-graph file (objects/info/commit-graph), in git's format.
+# It caches the parents, root tree, commit date and generation number
+# of every commit reachable from the refs, so that history walks don't
+# have to inflate and parse commit objects.
+#
+# A 8-byte header ("CGPH", version 1, hash version 1, chunk count,
+# number of base graphs), then a table of (4-byte chunk id, 8-byte
+# offset) ending with a zero id, the chunks, and a SHA-1 of it all:
+#
+#   OIDF  256-entry fanout table, as in pack indexes
+#   OIDL  the sorted SHAs of the commits
+#   CDAT  for each commit: root tree SHA, the positions of its first two
+#         parents, and its generation number and commit date
+#   EDGE  the positions of the other parents of octopus merges
+#   BIDX  for each commit, the end offset of its Bloom filter in BDAT
+#   BDAT  the Bloom filter settings, then the filters (see GitBloom)
+
+COMMIT_GRAPH_SIGNATURE = b"CGPH"
+# A CDAT entry: tree, parent 1, parent 2, generation << 2 | the two
+# high bits of the date, the 32 low bits of the date.
+COMMIT_GRAPH_DATA = struct.Struct(">20sLLLL")
+# A parent position meaning "no parent"
+GRAPH_PARENT_NONE = 0x70000000
+# On the second parent, the other bits are an index into EDGE.  In
+# EDGE, it marks the last parent of a commit.
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+# Generation numbers are stored on 30 bits.  Commits outside of the
+# graph have an infinite generation: they may be anyone's descendant.
+GENERATION_MAX = 0x3FFFFFFF
+GENERATION_INFINITY = 0xFFFFFFFF
+
+class GitCommitGraph(object):
+    """ A commit-graph file, memory-mapped.  Commits are known by their
+    position in the sorted SHA list, and so are their parents: walking
+    the history is a matter of reading integers at fixed offsets. """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+
+        if len(data) < 8 + 12 + 20 or data[0:4] != COMMIT_GRAPH_SIGNATURE:
+            raise Exception(f"Not a commit-graph file: {path}")
+        version, hash_version, chunk_count, base_count = data[4], data[5], data[6], data[7]
+        if version != 1:
+            raise Exception(f"Unsupported commit-graph version {version} in {path}")
+        if hash_version != 1:
+            raise Exception(f"Unsupported hash version {hash_version} in {path}: only SHA-1 is supported")
+        if base_count != 0:
+            raise Exception(f"Unsupported commit-graph chain in {path}")
+
+        # Chunks we don't know about (generation data v2...) are
+        # optional: skip them.
+        self.chunks = dict()
+        end = len(data) - 20
+        for i in range(chunk_count):
+            chunk_id, offset = struct.unpack_from(">4sQ", data, 8 + 12 * i)
+            next_offset = struct.unpack_from(">Q", data, 8 + 12 * (i + 1) + 4)[0]
+            if not (offset <= next_offset <= end):
+                raise Exception(f"Malformed commit-graph {path}: bad chunk offset")
+            self.chunks[chunk_id] = (offset, next_offset - offset)
+
+        for required in (b"OIDF", b"OIDL", b"CDAT"):
+            if required not in self.chunks:
+                raise Exception(f"Malformed commit-graph {path}: no {required.decode('ascii')} chunk")
+
+        self.fanout = struct.unpack_from(">256L", data, self.chunks[b"OIDF"][0])
+        self.count = self.fanout[255]
+        self.oid_table = self.chunks[b"OIDL"][0]
+        self.data_table = self.chunks[b"CDAT"][0]
+        self.edge_table = self.chunks[b"EDGE"][0] if b"EDGE" in self.chunks else None
+        if self.chunks[b"OIDL"][1] < 20 * self.count \
+           or self.chunks[b"CDAT"][1] < COMMIT_GRAPH_DATA.size * self.count:
+            raise Exception(f"Malformed commit-graph {path}: truncated chunk")
+
+        # Changed-path Bloom filters are optional too.  git ignores
+        # them if they don't look right, and so do we.
+        self.bloom_index = None
+        if b"BIDX" in self.chunks and b"BDAT" in self.chunks \
+           and self.chunks[b"BIDX"][1] == 4 * self.count and self.chunks[b"BDAT"][1] >= 12:
+            version, hashes, _ = struct.unpack_from(">LLL", data, self.chunks[b"BDAT"][0])
+            if version == BLOOM_VERSION:
+                self.bloom_index = self.chunks[b"BIDX"][0]
+                self.bloom_data = self.chunks[b"BDAT"][0] + 12
+                self.bloom_size = self.chunks[b"BDAT"][1] - 12
+                self.bloom_hashes = hashes
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def sha(self, pos):
+        """ Return the hex SHA of the pos-th commit """
+        start = self.oid_table + 20 * pos
+        return self.data[start:start+20].hex()
+
+    def find(self, sha):
+        """ Binary search for binary sha.  Return its position, or
+        None. """
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        data = self.data
+        base = self.oid_table
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + 20 * mid
+            cur = data[start:start+20]
+            if cur < sha:
+                lo = mid + 1
+            elif cur > sha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def position(self, sha):
+        """ Return the position of commit sha (hex), or None """
+        return self.find(bytes.fromhex(sha))
+
+    def commit(self, pos):
+        """ Return (tree SHA, parent positions, generation, date) for
+        the pos-th commit. """
+        tree, p1, p2, gen, date = COMMIT_GRAPH_DATA.unpack_from(
+            self.data, self.data_table + COMMIT_GRAPH_DATA.size * pos)
+        return (tree.hex(), self.parents_decode(p1, p2),
+                gen >> 2, ((gen & 0b11) << 32) | date)
+
+    def parents(self, pos):
+        """ Return the positions of the parents of the pos-th commit """
+        p1, p2 = struct.unpack_from(">LL", self.data,
+                                    self.data_table + COMMIT_GRAPH_DATA.size * pos + 20)
+        return self.parents_decode(p1, p2)
+
+    def bloom(self, pos):
+        """ Return the changed-path Bloom filter of the pos-th commit,
+        or None if the graph has none. """
+        if self.bloom_index is None:
+            return None
+        end = struct.unpack_from(">L", self.data, self.bloom_index + 4 * pos)[0]
+        start = struct.unpack_from(">L", self.data, self.bloom_index + 4 * pos - 4)[0] if pos else 0
+        if not (start <= end <= self.bloom_size):
+            return None
+        return self.data[self.bloom_data + start:self.bloom_data + end]
+
+    def parents_decode(self, p1, p2):
+        if p1 == GRAPH_PARENT_NONE:
+            return list()
+        if p2 == GRAPH_PARENT_NONE:
+            return [ p1 ]
+        if not p2 & GRAPH_EXTRA_EDGES:
+            return [ p1, p2 ]
+
+        # An octopus merge: the other parents are listed in EDGE.
+        ret = [ p1 ]
+        offset = self.edge_table + 4 * (p2 & ~GRAPH_EXTRA_EDGES)
+        while True:
+            edge = struct.unpack_from(">L", self.data, offset)[0]
+            ret.append(edge & ~GRAPH_LAST_EDGE)
+            if edge & GRAPH_LAST_EDGE:
+                return ret
+            offset += 4
+
+def commit_graph(repo):
+    """ Return repo's GitCommitGraph, or None if there's none (or
+    core.commitGraph is false).  It's cached on the repository, and
+    reloaded when the file is replaced. """
+    if not repo.conf.getboolean("core", "commitgraph", fallback=True):
+        return None
+
+    path = repo_file(repo, "objects", "info", "commit-graph")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    if repo.commit_graph is not None and repo.commit_graph_stamp == stamp:
+        return repo.commit_graph
+    if repo.commit_graph is not None:
+        repo.commit_graph.close()
+
+    repo.commit_graph = GitCommitGraph(path)
+    repo.commit_graph_stamp = stamp
+    return repo.commit_graph
+
+def commit_parse(data):
+    """ Return (tree SHA, parent SHAs, commit date) from the raw data of
+    a commit object. """
+    commit = GitCommit(data)
+    parents = commit.kvlm.get(b'parent', list())
+    if type(parents) != list:
+        parents = [ parents ]
+    # The committer line ends with "<timestamp> <timezone>".
+    committer = commit.kvlm.get(b'committer', b'')
+    try:
+        date = int(committer.rsplit(b' ', 2)[1])
+    except (IndexError, ValueError):
+        date = 0
+    return (commit.kvlm[b'tree'].decode("ascii"),
+            [ p.decode("ascii") for p in parents ],
+            date)
+
+# --------------------- walking ---------------------
+#
+# History walks know commits by "nodes": the commit's position when it's
+# in the commit-graph, or its hex SHA when it isn't (eg, commits made
+# since the graph was written).  Following graph commits never touches
+# the objects.
+
+def commit_node(repo, graph, sha):
+    """ Return the node for commit sha """
+    if graph is not None:
+        pos = graph.position(sha)
+        if pos is not None:
+            return pos
+    return sha
+
+def commit_node_sha(graph, node):
+    """ Return the hex SHA of node """
+    return graph.sha(node) if type(node) == int else node
+
+def commit_node_info(repo, graph, node):
+    """ Return (parent nodes, generation, date) of node.  Commits outside
+    the graph are read from the object store, with an infinite
+    generation. """
+    if type(node) == int:
+        _, parents, generation, date = graph.commit(node)
+        return parents, generation, date
+
+    fmt, data = object_read_raw(repo, node)
+    if fmt != b'commit':
+        raise Exception(f"Object {node} is not a commit")
+    _, parents, date = commit_parse(data)
+    return [ commit_node(repo, graph, p) for p in parents ], GENERATION_INFINITY, date
+
+def commit_node_tree(repo, graph, node):
+    """ Return the SHA of the root tree of node """
+    if type(node) == int:
+        tree, _, _, _ = graph.commit(node)
+        return tree
+    _, data = object_read_raw(repo, node)
+    tree, _, _ = commit_parse(data)
+    return tree
+
+def commit_peel(repo, sha):
+    """ Follow tags from object sha.  Return the commit they point to,
+    or None if they don't lead to a commit. """
+    while True:
+        fmt, data = object_read_raw(repo, sha)
+        if fmt == b'commit':
+            return sha
+        if fmt != b'tag':
+            return None
+        sha = GitTag(data).kvlm[b'object'].decode("ascii")
+
+# --------------------- writing ---------------------
+
+def commit_graph_serialize(commits, filters=None):
+    """ Return the content of a commit-graph file.  commits maps the hex
+    SHA of every commit to its (tree SHA, parent SHAs, date), and must
+    include all their parents.  filters, if given, maps each of them
+    to its changed-path Bloom filter. """
+    shas = sorted(commits)
+    position = { sha: i for (i, sha) in enumerate(shas) }
+    parents = [ [ position[p] for p in commits[sha][1] ] for sha in shas ]
+    generations = commit_graph_generations(parents)
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    oids = bytearray()
+    cdat = bytearray()
+    edges = list()
+    for (i, sha) in enumerate(shas):
+        oids += bytes.fromhex(sha)
+
+        tree, _, date = commits[sha]
+        p = parents[i]
+        p1 = p[0] if p else GRAPH_PARENT_NONE
+        if len(p) <= 2:
+            p2 = p[1] if len(p) == 2 else GRAPH_PARENT_NONE
+        else:
+            p2 = GRAPH_EXTRA_EDGES | len(edges)
+            edges += p[1:-1]
+            edges.append(GRAPH_LAST_EDGE | p[-1])
+        gen = min(generations[i], GENERATION_MAX)
+        cdat += COMMIT_GRAPH_DATA.pack(bytes.fromhex(tree), p1, p2,
+                                       (gen << 2) | ((date >> 32) & 0b11),
+                                       date & 0xFFFFFFFF)
+
+    chunks = [ (b"OIDF", struct.pack(">256L", *fanout)),
+               (b"OIDL", oids),
+               (b"CDAT", cdat) ]
+    if edges:
+        chunks.append((b"EDGE", struct.pack(f">{len(edges)}L", *edges)))
+    if filters is not None:
+        ends = list()
+        end = 0
+        for sha in shas:
+            end += len(filters[sha])
+            ends.append(end)
+        chunks.append((b"BIDX", struct.pack(f">{len(ends)}L", *ends)))
+        chunks.append((b"BDAT", bloom_settings_serialize() + b"".join(filters[sha] for sha in shas)))
+
+    out = bytearray(COMMIT_GRAPH_SIGNATURE + bytes([1, 1, len(chunks), 0]))
+    offset = len(out) + 12 * (len(chunks) + 1)
+    for (chunk_id, chunk) in chunks:
+        out += struct.pack(">4sQ", chunk_id, offset)
+        offset += len(chunk)
+    out += struct.pack(">4sQ", bytes(4), offset)
+    for (_, chunk) in chunks:
+        out += chunk
+    out += hashlib.sha1(out).digest()
+    return out
+
+def commit_graph_generations(parents):
+    """ Compute generation numbers (topological levels): 1 for root
+    commits, otherwise 1 + the highest generation of the parents.
+    parents[i] lists the positions of the parents of commit i. """
+    generations = [0] * len(parents)
+    for start in range(len(parents)):
+        if generations[start]:
+            continue
+        # Depth-first, iteratively: histories are much deeper than
+        # Python's recursion limit.
+        stack = [ start ]
+        while stack:
+            i = stack[-1]
+            pending = [ p for p in parents[i] if not generations[p] ]
+            if pending:
+                stack += pending
+                continue
+            stack.pop()
+            generations[i] = 1 + max((generations[p] for p in parents[i]), default=0)
+    return generations
+
+def commit_graph_write(repo, shas, changed_paths=None):
+    """ Write a commit-graph holding every commit reachable from shas
+    (commits or tags).  Commits the current graph holds aren't read
+    again.  Return the number of commits written.
+
+    With changed_paths, it includes changed-path Bloom filters.  By
+    default, it does if the current graph does. """
+    graph = commit_graph(repo)
+    if changed_paths is None:
+        changed_paths = graph is not None and graph.bloom_index is not None
+
+    commits = dict()
+    todo = list()
+    for sha in shas:
+        commit = commit_peel(repo, sha)
+        if commit:
+            todo.append(commit)
+
+    while todo:
+        sha = todo.pop()
+        if sha in commits:
+            continue
+
+        pos = graph.position(sha) if graph is not None else None
+        if pos is not None:
+            tree, parents, _, date = graph.commit(pos)
+            parents = [ graph.sha(p) for p in parents ]
+        else:
+            fmt, data = object_read_raw(repo, sha)
+            tree, parents, date = commit_parse(data)
+        commits[sha] = (tree, parents, date)
+        todo += [ p for p in parents if p not in commits ]
+
+    if not commits:
+        return 0
+
+    filters = None
+    if changed_paths:
+        filters = dict()
+        for (sha, (tree, parents, _)) in commits.items():
+            # Filters the current graph holds are still good.
+            pos = graph.position(sha) if graph is not None else None
+            data = graph.bloom(pos) if pos is not None else None
+            if data is None:
+                parent_tree = commits[parents[0]][0] if parents else None
+                changed = tree_diff_paths(repo, parent_tree, tree, BLOOM_MAX_CHANGED_PATHS)
+                data = bloom_filter(changed) if changed is not None else BLOOM_TRUNCATED
+            filters[sha] = data
+
+    out = commit_graph_serialize(commits, filters)
+    repo_dir(repo, "objects", "info", mkdir=True)
+    with GitLock(repo, "objects", "info", "commit-graph") as lock:
+        lock.write(out)
+        lock.commit()
+    return len(commits)
+
+def tree_diff_paths(repo, old, new, limit=None):
+    """ Return the paths of the files that differ between trees old and
+    new (SHAs, None for an empty tree), like git diff-tree -r.  Subtrees
+    with the same SHA on both sides are skipped without being read.
+    Return None if there are more than limit. """
+    ret = list()
+    # Stack of (old tree, new tree, prefix)
+    todo = [ (old, new, "") ]
+    while todo:
+        old, new, prefix = todo.pop()
+        old_items = tree_items(repo, old)
+        new_items = tree_items(repo, new)
+        for name in old_items.keys() | new_items.keys():
+            a = old_items.get(name)
+            b = new_items.get(name)
+            if a == b:
+                continue
+            path = prefix + name
+            a_tree = a is not None and a[0].startswith(b'04')
+            b_tree = b is not None and b[0].startswith(b'04')
+            if a_tree or b_tree:
+                # A file replaced by a directory (or the other way
+                # around) changes both the file and the directory's
+                # content.
+                if a is not None and not a_tree or b is not None and not b_tree:
+                    ret.append(path)
+                todo.append((a[1] if a_tree else None, b[1] if b_tree else None, path + "/"))
+            else:
+                ret.append(path)
+        if limit is not None and len(ret) > limit:
+            return None
+    return ret
+
+def tree_items(repo, sha):
+    """ Return {name: (mode, sha)} for the entries of tree sha, or an
+    empty dict if sha is None. """
+    if sha is None:
+        return dict()
+    fmt, data = object_read_raw(repo, sha)
+    return { leaf.path: (leaf.mode, leaf.sha) for leaf in GitTree(data).items }
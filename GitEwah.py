@@ -0,0 +1,126 @@
+import struct
+
+# EWAH compressed bitmaps, as git stores them (in the split index link
+# extension and in pack bitmaps, see GitBitmap).  A bitmap is a
+# sequence of 64-bit words.  Marker words describe a run of clean words
+# (all zeros or all ones), followed by a number of literal words stored
+# as is:
+#
+#   bit 0         the bit the run is made of
+#   bits 1-32     the number of clean words in the run
+#   bits 33-63    the number of literal words following the marker
+#
+# Bit i of the bitmap is bit i % 64 of word i // 64.  In memory,
+# bitmaps are either lists of the positions set, or Python ints (bit i
+# of the int is bit i of the bitmap), whose &, | and bit_count() are
+# fast even on millions of bits.
+
+EWAH_RUN_MAX = (1 << 32) - 1
+EWAH_LITERAL_MAX = (1 << 31) - 1
+EWAH_ONES = (1 << 64) - 1
+
+def ewah_words(bits, size):
+    """ Return the uncompressed 64-bit words of a bitmap of size bits,
+    where bits is an iterable of the positions set. """
+    words = [0] * ((size + 63) // 64)
+    for i in bits:
+        words[i >> 6] |= 1 << (i & 63)
+    return words
+
+def ewah_serialize(bits, size):
+    """ Serialize a bitmap of size bits, where bits is an iterable of
+    the positions set: the bit count, the number of words, the words,
+    and the position of the last marker word. """
+    return ewah_serialize_words(ewah_words(bits, size), size)
+
+def ewah_serialize_int(value, size=None):
+    """ Serialize the bitmap of an int.  size defaults to its highest
+    bit set, plus one. """
+    if size is None:
+        size = value.bit_length()
+    count = (size + 63) // 64
+    words = struct.unpack(f"<{count}Q", value.to_bytes(8 * count, "little"))
+    return ewah_serialize_words(words, size)
+
+def ewah_serialize_words(words, size):
+    out = list()
+    marker = 0
+
+    i = 0
+    while i < len(words) or not out:
+        marker = len(out)
+        out.append(0)
+
+        # A run of clean words...
+        run_bit = 0
+        run = 0
+        if i < len(words) and words[i] in (0, EWAH_ONES):
+            run_bit = 1 if words[i] else 0
+            clean = words[i]
+            while i < len(words) and words[i] == clean and run < EWAH_RUN_MAX:
+                run += 1
+                i += 1
+
+        # ...then the literal words up to the next clean one.
+        literals = 0
+        while i < len(words) and words[i] not in (0, EWAH_ONES) and literals < EWAH_LITERAL_MAX:
+            out.append(words[i])
+            literals += 1
+            i += 1
+
+        out[marker] = run_bit | (run << 1) | (literals << 33)
+
+    return struct.pack(f">LL{len(out)}QL", size, len(out), *out, marker)
+
+def ewah_parse_int(data, offset=0):
+    """ Parse the bitmap serialized at offset in data.  Return (an int
+    of the bitmap, the bitmap's size in bits, the offset after it). """
+    size, count = struct.unpack_from(">LL", data, offset)
+    words = struct.unpack_from(f">{count}Q", data, offset + 8)
+    offset += 8 + 8 * count + 4
+
+    # Uncompress into little-endian bytes, and make an int of them.
+    out = bytearray()
+    i = 0
+    while i < count:
+        marker = words[i]
+        i += 1
+        run = (marker >> 1) & EWAH_RUN_MAX
+        literals = marker >> 33
+        out += (b'\xff' if marker & 1 else b'\x00') * (8 * run)
+        out += struct.pack(f"<{literals}Q", *words[i:i + literals])
+        i += literals
+
+    value = int.from_bytes(out, "little")
+    if value.bit_length() > size:
+        value &= (1 << size) - 1
+    return value, size, offset
+
+def ewah_parse(data, offset=0):
+    """ Parse the bitmap serialized at offset in data.  Return (the list
+    of positions set, the bitmap's size in bits, the offset after it). """
+    size, count = struct.unpack_from(">LL", data, offset)
+    words = struct.unpack_from(f">{count}Q", data, offset + 8)
+    offset += 8 + 8 * count + 4
+
+    bits = list()
+    pos = 0
+    i = 0
+    while i < count:
+        marker = words[i]
+        i += 1
+        run = (marker >> 1) & EWAH_RUN_MAX
+        literals = marker >> 33
+        if marker & 1:
+            bits.extend(range(pos, pos + 64 * run))
+        pos += 64 * run
+
+        for word in words[i:i + literals]:
+            while word:
+                low = word & -word
+                bits.append(pos + low.bit_length() - 1)
+                word ^= low
+            pos += 64
+        i += literals
+
+    return [ b for b in bits if b < size ], size, offset
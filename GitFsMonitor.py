@@ -0,0 +1,429 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import socket
+import stat
+import struct
+import time
+from GitRepository import repo_exclude_files, repo_file
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# Past this many distinct changed paths, the daemon forgets them all
+# and starts a new session: clients then fall back to a full scan.
+FSMONITOR_MAX_PATHS = 1000000
+
+# How often the fallback poller rescans the worktree, in seconds.
+FSMONITOR_POLL_INTERVAL = 2.0
+
+# How long the daemon waits for its own cookie file to come back
+# through inotify before giving up on a query.
+FSMONITOR_SYNC_TIMEOUT = 1.0
+
+COOKIE_PREFIX = "fsmonitor-cookie-"
+
+class GitFsMonitor(object):
+    """ The daemon's record of changed paths.
+
+    Every change bumps a sequence number, and we remember the last
+    sequence number each path changed at.  A token is a (session,
+    sequence number) pair: the paths changed since a token are those
+    with a greater sequence number.  A token from another session (an
+    earlier daemon, or before an overflow) can't be answered. """
+
+    def __init__(self):
+        self.changes = dict()
+        self.reset()
+
+    def reset(self):
+        self.session = f"{os.getpid()}.{time.time_ns()}"
+        self.seq = 0
+        self.changes.clear()
+
+    def changed(self, path):
+        self.seq += 1
+        self.changes[path] = self.seq
+        if len(self.changes) > FSMONITOR_MAX_PATHS:
+            self.reset()
+
+    def token(self):
+        return f"{self.session}:{self.seq}"
+
+    def since(self, token):
+        """ Return the sorted paths changed since token, or None if we
+        can't tell. """
+        session, _, seq = (token or "").rpartition(":")
+        if session != self.session:
+            return None
+        seq = int(seq)
+        return sorted(p for (p, s) in self.changes.items() if s > seq)
+
+class InotifyWatcher(object):
+    """ Watch every directory of the worktree with inotify, through
+    ctypes.  Raises OSError where inotify isn't available. """
+
+    def __init__(self, repo, monitor):
+        self.repo = repo
+        self.monitor = monitor
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # Watch descriptor -> directory, relative to the worktree.
+        self.wds = dict()
+        self.watch_tree("")
+
+        # We also watch the gitdir, but only for our cookie files.
+        self.git_wd = self.add_watch(repo.gitdir, IN_CREATE)
+        self.cookies = set()
+        self.cookie_count = 0
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Can't watch {path}")
+        return wd
+
+    def watch_tree(self, rel):
+        """ Watch directory rel and everything below it.  Return the
+        paths found, which the caller may want to report: they may
+        have been created before their directory was watched. """
+        found = list()
+        todo = [ rel ]
+        while todo:
+            rel = todo.pop()
+            path = os.path.join(self.repo.worktree, rel)
+            if path == self.repo.gitdir:
+                continue
+            try:
+                self.wds[self.add_watch(path, WATCH_MASK)] = rel
+                with os.scandir(path) as it:
+                    for de in it:
+                        sub = os.path.join(rel, de.name)
+                        found.append(sub)
+                        if de.is_dir(follow_symlinks=False):
+                            todo.append(sub)
+            except (FileNotFoundError, NotADirectoryError):
+                pass # Gone already; its deletion will be reported.
+        return found
+
+    def process(self):
+        """ Read and record all pending events. """
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+
+            pos = 0
+            while pos < len(buf):
+                # struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+                wd, mask, _, length = struct.unpack_from("iIII", buf, pos)
+                name = buf[pos+16:pos+16+length].rstrip(b'\x00')
+                name = os.fsdecode(name)
+                pos += 16 + length
+
+                if mask & IN_Q_OVERFLOW:
+                    # The kernel dropped events: forget everything.
+                    self.monitor.reset()
+                    continue
+
+                if wd == self.git_wd:
+                    if name.startswith(COOKIE_PREFIX):
+                        self.cookies.add(name)
+                    continue
+
+                if mask & IN_IGNORED:
+                    self.wds.pop(wd, None)
+                    continue
+
+                if wd not in self.wds:
+                    continue
+                rel = self.wds[wd]
+
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if rel:
+                        self.monitor.changed(rel)
+                    continue
+
+                path = os.path.join(rel, name)
+                self.monitor.changed(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    for sub in self.watch_tree(path):
+                        self.monitor.changed(sub)
+
+    def sync(self):
+        """ Make sure every change made before this call has been
+        recorded, by creating a cookie file and waiting for its event
+        to come through.  Return False on timeout. """
+        self.cookie_count += 1
+        name = f"{COOKIE_PREFIX}{os.getpid()}-{self.cookie_count}"
+        path = os.path.join(self.repo.gitdir, name)
+        open(path, "w").close()
+        try:
+            deadline = time.monotonic() + FSMONITOR_SYNC_TIMEOUT
+            while name not in self.cookies:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                select.select([ self.fd ], [], [], remaining)
+                self.process()
+            return True
+        finally:
+            os.unlink(path)
+            self.cookies.discard(name)
+
+    def close(self):
+        os.close(self.fd)
+
+class PollWatcher(object):
+    """ Fallback for systems without inotify: periodically rescan the
+    worktree and compare stat data with the previous scan. """
+
+    def __init__(self, repo, monitor):
+        self.repo = repo
+        self.monitor = monitor
+        self.snapshot = self.scan()
+
+    def fileno(self):
+        return None
+
+    def scan(self):
+        ret = dict()
+        todo = [ "" ]
+        while todo:
+            rel = todo.pop()
+            try:
+                it = os.scandir(os.path.join(self.repo.worktree, rel))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            with it:
+                for de in it:
+                    if de.path == self.repo.gitdir:
+                        continue
+                    sub = os.path.join(rel, de.name)
+                    try:
+                        st = de.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    ret[sub] = (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode)
+                    if stat.S_ISDIR(st.st_mode):
+                        todo.append(sub)
+        return ret
+
+    def process(self):
+        new = self.scan()
+        old = self.snapshot
+        for path in old.keys() | new.keys():
+            if old.get(path) != new.get(path):
+                self.monitor.changed(path)
+        self.snapshot = new
+
+    def sync(self):
+        self.process()
+        return True
+
+    def close(self):
+        pass
+
+def fsmonitor_socket_path(repo):
+    return repo_file(repo, "fsmonitor--daemon.ipc")
+
+def fsmonitor_run(repo):
+    """ Run the daemon in the foreground, until asked to stop. """
+    monitor = GitFsMonitor()
+    try:
+        watcher = InotifyWatcher(repo, monitor)
+    except OSError:
+        watcher = PollWatcher(repo, monitor)
+
+    path = fsmonitor_socket_path(repo)
+    if os.path.exists(path):
+        if fsmonitor_request(repo, { "command": "status" }):
+            raise Exception("fsmonitor daemon is already running")
+        os.unlink(path) # Stale socket
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    try:
+        running = True
+        next_poll = time.monotonic() + FSMONITOR_POLL_INTERVAL
+        while running:
+            rlist = [ server ]
+            if watcher.fileno() is not None:
+                rlist.append(watcher)
+            ready, _, _ = select.select(rlist, [], [], FSMONITOR_POLL_INTERVAL)
+
+            if watcher in ready:
+                watcher.process()
+            elif watcher.fileno() is None and time.monotonic() >= next_poll:
+                watcher.process()
+                next_poll = time.monotonic() + FSMONITOR_POLL_INTERVAL
+
+            if server in ready:
+                conn, _ = server.accept()
+                with conn:
+                    running = fsmonitor_handle(conn, monitor, watcher)
+    finally:
+        server.close()
+        os.unlink(path)
+        watcher.close()
+
+def fsmonitor_handle(conn, monitor, watcher):
+    """ Answer one request.  Return False if the daemon should stop. """
+    request = json.loads(fsmonitor_recv(conn))
+    match request.get("command"):
+        case "query":
+            if watcher.sync():
+                paths = monitor.since(request.get("token"))
+            else:
+                paths = None
+            reply = { "token": monitor.token(), "paths": paths }
+        case "status":
+            reply = { "token": monitor.token(),
+                      "backend": "inotify" if isinstance(watcher, InotifyWatcher) else "poll",
+                      "pid": os.getpid(),
+                      "paths": len(monitor.changes) }
+        case "stop":
+            conn.sendall(json.dumps({ "stopping": True }).encode() + b"\n")
+            return False
+        case _:
+            reply = { "error": "unknown command" }
+    conn.sendall(json.dumps(reply).encode() + b"\n")
+    return True
+
+def fsmonitor_recv(conn):
+    data = b''
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode("utf8")
+
+def fsmonitor_request(repo, request):
+    """ Send request to repo's daemon.  Return the decoded reply, or
+    None if no daemon answers. """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(fsmonitor_socket_path(repo))
+            conn.sendall(json.dumps(request).encode() + b"\n")
+            return json.loads(fsmonitor_recv(conn))
+    except (OSError, ValueError):
+        return None
+
+# --------------------- client state ---------------------
+#
+# A client (status) remembers, in .git/fsmonitor-state, the token it got
+# from its last query, the paths that weren't clean at that time
+# (modified, deleted, untracked), and the index's stat data.  Next time,
+# only those paths and the ones the daemon saw change need looking at
+# --- provided the index hasn't been replaced behind our back.
+
+def fsmonitor_enabled(repo):
+    return repo.conf.getboolean("core", "fsmonitor", fallback=False)
+
+def fsmonitor_index_stat(repo):
+    try:
+        st = os.stat(repo_file(repo, "index"))
+    except FileNotFoundError:
+        return None
+    return [ st.st_mtime_ns, st.st_size ]
+
+def fsmonitor_ignore_stat(repo):
+    """ Return the stat data of the ignore files outside the worktree.
+    fsmonitor doesn't watch them, but when they change, files that were
+    ignored may not be anymore. """
+    ret = list()
+    for path in repo_exclude_files(repo):
+        try:
+            st = os.stat(path)
+            ret.append([ path, st.st_ino, st.st_mtime_ns, st.st_size ])
+        except FileNotFoundError:
+            ret.append([ path, None ])
+    return ret
+
+def fsmonitor_state_read(repo):
+    try:
+        with open(repo_file(repo, "fsmonitor-state"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def fsmonitor_state_write(repo, token, dirty, ignore):
+    """ Record the state of the worktree as of token: every path not in
+    dirty was clean, with the ignore files as ignore says (see
+    fsmonitor_ignore_stat). """
+    state = { "token": token,
+              "index": fsmonitor_index_stat(repo),
+              "ignore": ignore,
+              "dirty": sorted(dirty) }
+    path = repo_file(repo, "fsmonitor-state")
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+def fsmonitor_index_written(repo):
+    """ Called after wyag itself rewrites the index, which doesn't make
+    the recorded state stale: refresh the index stat data it holds. """
+    state = fsmonitor_state_read(repo)
+    if state is not None:
+        fsmonitor_state_write(repo, state["token"], state["dirty"], state.get("ignore"))
+
+def fsmonitor_query(repo):
+    """ Ask the daemon what may have changed since the recorded state.
+
+    Return (token, paths).  token is the daemon's current token, or
+    None if fsmonitor is disabled or no daemon answers.  paths is the
+    set of paths that may not be clean, or None if the caller must scan
+    the whole worktree. """
+    if not fsmonitor_enabled(repo):
+        return None, None
+
+    state = fsmonitor_state_read(repo)
+    reply = fsmonitor_request(repo, { "command": "query",
+                                      "token": state["token"] if state else None })
+    if reply is None or "token" not in reply:
+        return None, None
+
+    if state is None or reply["paths"] is None \
+       or state["index"] != fsmonitor_index_stat(repo):
+        return reply["token"], None
+
+    # Untracked files ignored last time aren't in the state.  If the
+    # rules changed, they may not be ignored anymore: scan them all.
+    if state.get("ignore") != fsmonitor_ignore_stat(repo) \
+       or any(os.path.basename(path) == ".gitignore" for path in reply["paths"]):
+        return reply["token"], None
+
+    return reply["token"], set(reply["paths"]) | set(state["dirty"])
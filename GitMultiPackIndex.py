@@ -0,0 +1,218 @@
+import hashlib
+import mmap
+import os
+import struct
+from GitRepository import GitLock
+
+# The multi-pack-index (objects/pack/multi-pack-index), in git's format.
+# One sorted SHA table for the objects of many packs, telling for each
+# which pack holds it and where: a lookup is one binary search, however
+# many packs there are, instead of one per pack index.
+#
+# A 12-byte header ("MIDX", version 1, hash version 1, chunk count,
+# number of base files, number of packs), then a table of (4-byte chunk
+# id, 8-byte offset) ending with a zero id, the chunks, and a SHA-1 of
+# it all:
+#
+#   PNAM  the names of the pack indexes, sorted, NUL-terminated; a
+#         pack's position in this list is its id
+#   OIDF  256-entry fanout table, as in pack indexes
+#   OIDL  the sorted SHAs of the objects
+#   OOFF  for each object: pack id, offset in the pack
+#   LOFF  64-bit offsets, for packs larger than 2GB
+
+MIDX_SIGNATURE = b"MIDX"
+# On an OOFF offset, the other bits are an index into LOFF.
+MIDX_LARGE_OFFSET = 0x80000000
+
+class GitMultiPackIndex(object):
+    """ A multi-pack-index file, memory-mapped """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Don't leave the file mapped if it turns out to be broken.
+        try:
+            self.parse()
+        except Exception:
+            self.data.close()
+            raise
+
+        # The GitPack of each pack id, and the packs it doesn't cover,
+        # set by GitPack.pack_list()
+        self.packs = None
+        self.others = None
+
+    def parse(self):
+        """ Check the header, checksum and chunks, and find the
+        tables. """
+        path = self.path
+        data = self.data
+
+        if len(data) < 12 + 12 + 20 or data[0:4] != MIDX_SIGNATURE:
+            raise Exception(f"Not a multi-pack-index file: {path}")
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            raise Exception(f"Corrupt multi-pack-index {path}: bad checksum")
+        version, hash_version, chunk_count, base_count = data[4], data[5], data[6], data[7]
+        if version != 1:
+            raise Exception(f"Unsupported multi-pack-index version {version} in {path}")
+        if hash_version != 1:
+            raise Exception(f"Unsupported hash version {hash_version} in {path}: only SHA-1 is supported")
+        if base_count != 0:
+            raise Exception(f"Unsupported multi-pack-index chain in {path}")
+        pack_count = struct.unpack_from(">L", data, 8)[0]
+
+        # Chunks we don't know about (reverse index, bitmapped packs)
+        # are optional: skip them.
+        self.chunks = dict()
+        end = len(data) - 20
+        table_end = 12 + 12 * (chunk_count + 1)
+        if table_end > end:
+            raise Exception(f"Malformed multi-pack-index {path}: truncated chunk table")
+        for i in range(chunk_count):
+            chunk_id, offset = struct.unpack_from(">4sQ", data, 12 + 12 * i)
+            next_offset = struct.unpack_from(">Q", data, 12 + 12 * (i + 1) + 4)[0]
+            if not (table_end <= offset <= next_offset <= end):
+                raise Exception(f"Malformed multi-pack-index {path}: bad chunk offset")
+            self.chunks[chunk_id] = (offset, next_offset - offset)
+
+        for required in (b"PNAM", b"OIDF", b"OIDL", b"OOFF"):
+            if required not in self.chunks:
+                raise Exception(f"Malformed multi-pack-index {path}: no {required.decode('ascii')} chunk")
+
+        offset, size = self.chunks[b"PNAM"]
+        self.names = [ name.decode("utf8") for name in data[offset:offset+size].split(b"\0") if name ]
+        if len(self.names) != pack_count:
+            raise Exception(f"Malformed multi-pack-index {path}: expected {pack_count} pack names")
+
+        if self.chunks[b"OIDF"][1] < 256 * 4:
+            raise Exception(f"Malformed multi-pack-index {path}: truncated chunk")
+        self.fanout = struct.unpack_from(">256L", data, self.chunks[b"OIDF"][0])
+        self.count = self.fanout[255]
+        self.oid_table = self.chunks[b"OIDL"][0]
+        self.offset_table = self.chunks[b"OOFF"][0]
+        self.offset64_table = self.chunks[b"LOFF"][0] if b"LOFF" in self.chunks else None
+        if self.chunks[b"OIDL"][1] < 20 * self.count \
+           or self.chunks[b"OOFF"][1] < 8 * self.count:
+            raise Exception(f"Malformed multi-pack-index {path}: truncated chunk")
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def sha(self, pos):
+        """ Return the hex SHA of the pos-th object """
+        start = self.oid_table + 20 * pos
+        return self.data[start:start+20].hex()
+
+    def location(self, pos):
+        """ Return (pack id, offset in the pack) of the pos-th object """
+        pack_id, offset = struct.unpack_from(">LL", self.data, self.offset_table + 8 * pos)
+        if offset & MIDX_LARGE_OFFSET and self.offset64_table is not None:
+            i = offset & ~MIDX_LARGE_OFFSET
+            offset = struct.unpack_from(">Q", self.data, self.offset64_table + 8 * i)[0]
+        return pack_id, offset
+
+    def bisect(self, sha):
+        """ Binary search for binary sha.  Return the position of the
+        first object whose SHA isn't smaller. """
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        data = self.data
+        base = self.oid_table
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + 20 * mid
+            if data[start:start+20] < sha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, sha):
+        """ Binary search for binary sha.  Return its position, or
+        None. """
+        pos = self.bisect(sha)
+        start = self.oid_table + 20 * pos
+        if pos < self.count and self.data[start:start+20] == sha:
+            return pos
+        return None
+
+def midx_pack_name(pack):
+    """ Return the name the multi-pack-index knows pack by: its index's
+    file name. """
+    return os.path.basename(pack.path)[:-len(".pack")] + ".idx"
+
+def midx_serialize(packs):
+    """ Return the content of a multi-pack-index covering packs (a list
+    of GitPack), and the number of objects in it. """
+    packs = sorted(packs, key=midx_pack_name)
+
+    # An object in several packs is taken from the most recently
+    # modified one, as git does.
+    newest = sorted(range(len(packs)), key=lambda i: os.stat(packs[i].path).st_mtime_ns,
+                    reverse=True)
+    objects = dict()
+    for pack_id in newest:
+        pack = packs[pack_id]
+        table = pack.idx[pack.sha_table:pack.sha_table + 20 * len(pack)]
+        for pos in range(len(pack)):
+            sha = table[20 * pos:20 * pos + 20]
+            if sha not in objects:
+                objects[sha] = (pack_id, pack.offset(pos))
+    shas = sorted(objects)
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[sha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    # Offsets that don't fit on 32 bits go to LOFF, and then so do
+    # those that don't fit on 31.
+    large_needed = any(offset > 0xFFFFFFFF for (_, offset) in objects.values())
+    offsets = bytearray()
+    large = list()
+    for sha in shas:
+        pack_id, offset = objects[sha]
+        if large_needed and offset >= MIDX_LARGE_OFFSET:
+            offsets += struct.pack(">LL", pack_id, MIDX_LARGE_OFFSET | len(large))
+            large.append(offset)
+        else:
+            offsets += struct.pack(">LL", pack_id, offset)
+
+    names = b"".join(midx_pack_name(pack).encode("utf8") + b"\0" for pack in packs)
+    names += bytes(-len(names) % 4)
+
+    chunks = [ (b"PNAM", names),
+               (b"OIDF", struct.pack(">256L", *fanout)),
+               (b"OIDL", b"".join(shas)),
+               (b"OOFF", offsets) ]
+    if large:
+        chunks.append((b"LOFF", struct.pack(f">{len(large)}Q", *large)))
+
+    out = bytearray(MIDX_SIGNATURE + bytes([1, 1, len(chunks), 0]))
+    out += struct.pack(">L", len(packs))
+    offset = len(out) + 12 * (len(chunks) + 1)
+    for (chunk_id, chunk) in chunks:
+        out += struct.pack(">4sQ", chunk_id, offset)
+        offset += len(chunk)
+    out += struct.pack(">4sQ", bytes(4), offset)
+    for (_, chunk) in chunks:
+        out += chunk
+    out += hashlib.sha1(out).digest()
+    return out, len(shas)
+
+def midx_write(repo, packs):
+    """ Write repo's multi-pack-index, covering packs.  Return the
+    number of objects in it. """
+    out, count = midx_serialize(packs)
+    with GitLock(repo, "objects", "pack", "multi-pack-index") as lock:
+        lock.write(out)
+        lock.commit()
+    return count
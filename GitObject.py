@@ -1,9 +1,14 @@
 import zlib
 import hashlib
+import io
 import os
 import re
-from GitRepository import repo_file
-from git_commands import ref_resolve
+import tempfile
+from collections import OrderedDict
+from GitRepository import config_size, repo_dir, repo_file
+from GitPack import pack_find, pack_info, pack_read
+from GitOidIndex import oid_index
+from GitRefs import ref_resolve
 
 class GitObject:
     def __init__(self, data=None):
@@ -47,14 +52,22 @@ class GitTreeLeaf(GitObject):
         self.path = path
         self.sha = sha
         
-class GitTag(GitObject):
+class GitTag(GitCommit):
     fmt = b'tag'
 
 class GitIndexEntry(object):
+    # Large indexes have hundreds of thousands of entries: no
+    # per-instance __dict__.
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms",
+                 "uid", "gid", "fsize", "sha", "flag_assume_valid",
+                 "flag_stage", "flag_skip_worktree", "flag_intent_to_add",
+                 "name")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None, 
-                 flag_stage=None, name=None):
+                 flag_stage=None, name=None, flag_skip_worktree=False,
+                 flag_intent_to_add=False):
         # The last time a file's metadata changed. This is a pair
         # (timestamp in seconds, nanoseconds)
         self.ctime = ctime
@@ -89,6 +102,10 @@ class GitIndexEntry(object):
         self.sha = sha
         self.flag_assume_valid = flag_assume_valid
         self.flag_stage = flag_stage
+
+        # Extended flags, only stored by index version 3 and later
+        self.flag_skip_worktree = flag_skip_worktree
+        self.flag_intent_to_add = flag_intent_to_add
         
         # Name of the object (full path this time!)
         self.name = name
@@ -96,15 +113,129 @@ class GitIndexEntry(object):
 class GitIndex(object):
     version = None
     entries = []
-    # ext = None
-    # sha = None
+    # The root of the cache tree (TREE extension), or None
+    cache_tree = None
+    # The file content and entry offsets, when index_read was asked to
+    # keep them for GitIndexColumns
+    raw = None
+    offsets = None
+    # The checksum of the file the index was read from, in hex
+    sha = None
+    # For a split index, the shared GitIndex it stores changes to
+    shared = None
     
-    def __init__(self, version=2, entries=None):
+    def __init__(self, version=2, entries=None, cache_tree=None):
         if not entries:
             entries = list()
         self.version = version
         self.entries = entries
+        self.cache_tree = cache_tree
+
+class GitCacheTree(object):
+    """ A node of the cache tree, which remembers the SHA of the tree
+    object for a directory of the index.  entry_count is the number of
+    index entries under this directory, or -1 if the node has been
+    invalidated and its tree must be written again. """
+    def __init__(self, entry_count=-1, sha=None):
+        self.entry_count = entry_count
+        self.sha = sha
+        # Child nodes, by directory basename
+        self.subtrees = dict()
         
+class GitIndexColumns(object):
+    """ A columnar view of an index: the stat data and SHAs of its
+    entries as NumPy arrays, so that they can be compared with a whole
+    batch of lstat() results at once.
+
+    The view is gathered straight from the index file content, when
+    index_read kept it; otherwise it is built from the entries.  Either
+    way the entries remain the reference, and the view doesn't follow
+    later changes to them. """
+    def __init__(self, index):
+        import numpy as np
+        n = len(index.entries)
+
+        if index.raw is not None and len(index.offsets) == n:
+            # Copy the fixed 62-byte part of each entry into a row, and
+            # read the rows as big-endian records.
+            buf = np.frombuffer(index.raw, dtype=np.uint8)
+            offsets = np.frombuffer(index.offsets, dtype=np.uint64).astype(np.intp)
+            rows = buf[offsets[:, None] + np.arange(62)]
+            rec = rows.view(np.dtype([ ("ctime_s", ">u4"), ("ctime_ns", ">u4"),
+                                       ("mtime_s", ">u4"), ("mtime_ns", ">u4"),
+                                       ("dev", ">u4"), ("ino", ">u4"), ("mode", ">u4"),
+                                       ("uid", ">u4"), ("gid", ">u4"), ("size", ">u4"),
+                                       ("sha", "u1", (20,)), ("flags", ">u2") ])).reshape(n)
+            ctime = (rec["ctime_s"], rec["ctime_ns"])
+            mtime = (rec["mtime_s"], rec["mtime_ns"])
+            columns = { f: rec[f] for f in ("dev", "ino", "mode", "uid", "gid", "size") }
+            self.sha = rec["sha"]
+        else:
+            e = index.entries
+            ctime = (np.fromiter((x.ctime[0] for x in e), np.int64, n), np.fromiter((x.ctime[1] for x in e), np.int64, n))
+            mtime = (np.fromiter((x.mtime[0] for x in e), np.int64, n), np.fromiter((x.mtime[1] for x in e), np.int64, n))
+            columns = { "dev": np.fromiter((x.dev for x in e), np.uint64, n),
+                        "ino": np.fromiter((x.ino for x in e), np.uint64, n),
+                        "mode": np.fromiter(((x.mode_type << 12) | x.mode_perms for x in e), np.uint64, n),
+                        "uid": np.fromiter((x.uid for x in e), np.uint64, n),
+                        "gid": np.fromiter((x.gid for x in e), np.uint64, n),
+                        "size": np.fromiter((x.fsize for x in e), np.uint64, n) }
+            # One row of 20 bytes per entry
+            self.sha = np.frombuffer(bytes.fromhex("".join(x.sha for x in e)), np.uint8).reshape(n, 20)
+
+        # Times are nanoseconds, with seconds on 32 bits as stored.
+        self.ctime = ctime[0].astype(np.int64) * 10**9 + ctime[1]
+        self.mtime = mtime[0].astype(np.int64) * 10**9 + mtime[1]
+        self.dev = columns["dev"].astype(np.uint64)
+        self.ino = columns["ino"].astype(np.uint64)
+        self.mode = columns["mode"].astype(np.uint64)
+        self.uid = columns["uid"].astype(np.uint64)
+        self.gid = columns["gid"].astype(np.uint64)
+        self.fsize = columns["size"].astype(np.uint64)
+
+    def compare(self, positions, stats, index_mtime):
+        """ Compare the entries at positions with stats, their
+        os.lstat() results.  Return (matches, racy), two boolean
+        arrays: whether each entry's stat data matches, and whether it
+        is racily clean (see index_entry_is_racy). """
+        import numpy as np
+        positions = np.asarray(positions, dtype=np.intp)
+        st = np.array([ (s.st_mode, s.st_ctime_ns, s.st_mtime_ns, s.st_size,
+                         s.st_ino, s.st_dev, s.st_uid, s.st_gid) for s in stats ],
+                      dtype=[ ("mode", np.uint64), ("ctime", np.int64), ("mtime", np.int64),
+                              ("size", np.uint64), ("ino", np.uint64), ("dev", np.uint64),
+                              ("uid", np.uint64), ("gid", np.uint64) ])
+
+        def stored_time(ns):
+            # What the index stores: seconds on 32 bits, nanoseconds
+            return ((ns // 10**9) & 0xFFFFFFFF) * 10**9 + ns % 10**9
+
+        mask = np.uint64(0xFFFFFFFF)
+        matches = (st["mode"] >> np.uint64(12) == self.mode[positions] >> np.uint64(12)) \
+            & (stored_time(st["mtime"]) == self.mtime[positions]) \
+            & (stored_time(st["ctime"]) == self.ctime[positions]) \
+            & (st["size"] & mask == self.fsize[positions]) \
+            & (st["ino"] & mask == self.ino[positions]) \
+            & (st["dev"] & mask == self.dev[positions]) \
+            & (st["uid"] & mask == self.uid[positions]) \
+            & (st["gid"] & mask == self.gid[positions])
+
+        if index_mtime is None:
+            racy = np.ones(len(positions), dtype=bool)
+        else:
+            racy = self.mtime[positions] >= index_mtime
+
+        return matches, racy
+
+def index_columns(index):
+    """ Return a GitIndexColumns view of index, or None when NumPy
+    isn't installed. """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return GitIndexColumns(index)
+
 class GitIgnore(object):
     absolute = None
     scoped = None
@@ -113,35 +244,295 @@ class GitIgnore(object):
         self.absolute = absolute
         self.scoped = scoped
         
+class GitObjectCache(object):
+    """ A bounded LRU cache of objects, keyed by SHA.
+
+    Each entry holds the inflated data and, once someone asked for it,
+    the parsed object.  Objects returned from the cache are shared, so
+    callers must not modify them.  The cache evicts least recently used
+    entries when the total size exceeds limit bytes.  Blobs larger than
+    blob_limit are never cached: they would evict everything else for
+    little gain. """
+
+    def __init__(self, limit, blob_limit):
+        self.limit = limit
+        self.blob_limit = blob_limit
+        self.size = 0
+        # sha -> [fmt, data, parsed object or None, charged size]
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def peek(self, sha):
+        """ Return the entry for sha, or None, without touching the
+        LRU order or the counters. """
+        return self.entries.get(sha)
+
+    def get(self, sha):
+        entry = self.entries.get(sha)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(sha)
+        return entry
+
+    def put(self, sha, fmt, data):
+        """ Cache data.  Return the new entry, or None if it is too big
+        to be cached. """
+        size = len(data)
+        if size > self.limit or (fmt == b'blob' and size > self.blob_limit):
+            return None
+        entry = [fmt, data, None, size]
+        self.entries[sha] = entry
+        self.charge(size)
+        return entry
+
+    def attach(self, entry, obj):
+        """ Store the parsed form of entry's object. """
+        entry[2] = obj
+        if obj.fmt != b'blob':
+            # Parsed trees and commits roughly double the footprint;
+            # blobs share their data.
+            entry[3] += len(entry[1])
+            self.charge(len(entry[1]))
+
+    def charge(self, size):
+        self.size += size
+        while self.size > self.limit and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry[3]
+            self.evictions += 1
+
+    def stats(self):
+        return { "entries"   : len(self.entries),
+                 "size"      : self.size,
+                 "hits"      : self.hits,
+                 "misses"    : self.misses,
+                 "evictions" : self.evictions }
+
+class GitObjectReader(io.RawIOBase):
+    """ A file-like reader over an object's data.
+
+    The data is inflated incrementally from read_compressed, which must
+    return the next chunk of the zlib stream each time it's called.
+    pending holds data inflated ahead of time (eg, along with the
+    header); if read_compressed is None, pending is the whole data.  At
+    EOF, we check that we produced exactly the declared size. """
+
+    def __init__(self, fmt, size, read_compressed, pending=b'', on_close=None):
+        self.fmt = fmt
+        self.size = size
+        self.read_compressed = read_compressed
+        self.decompressor = zlib.decompressobj() if read_compressed else None
+        self.pending = pending
+        self.position = 0
+        self.on_close = on_close
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = len(b)
+        while not self.pending and self.decompressor and not self.decompressor.eof:
+            chunk = self.decompressor.unconsumed_tail or self.read_compressed()
+            if not chunk:
+                raise Exception("Truncated object: compressed stream ended early")
+            # Bound the output, so a highly compressible object can't
+            # inflate to something huge in one call.
+            self.pending = self.decompressor.decompress(chunk, max(n, OBJECT_CHUNK_SIZE))
+
+        data = self.pending[:n]
+        self.pending = self.pending[n:]
+        self.position += len(data)
+
+        if self.position > self.size or (not data and n and self.position != self.size):
+            raise Exception(f"Malformed object: bad length (expected {self.size} bytes)")
+
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.on_close:
+            self.on_close()
+        super().close()
+
 # --------------------- object helpers ---------------------
+def object_cache(repo):
+    """ Return repo's object cache, creating it on first use.  Its
+    budget is core.objectCacheLimit (default 64m), and blobs larger
+    than core.objectCacheBlobLimit (default 1m) aren't cached. """
+    if repo.object_cache is None:
+        limit = config_size(repo.conf.get("core", "objectcachelimit", fallback="64m"))
+        blob_limit = config_size(repo.conf.get("core", "objectcachebloblimit", fallback="1m"))
+        repo.object_cache = GitObjectCache(limit, blob_limit)
+    return repo.object_cache
+
 def object_read(repo, sha):
     """ Read object sha from Git repository repo. Return a 
-    GitObject whose exact type depends on the object."""
-    
+    GitObject whose exact type depends on the object.
+
+    Objects come from the repository's cache when possible, and are
+    shared: don't modify them. """
+
+    cache = object_cache(repo)
+    entry = cache.get(sha)
+    if entry is None:
+        fmt, data = object_read_uncached(repo, sha)
+        entry = cache.put(sha, fmt, data)
+    elif entry[2] is not None:
+        return entry[2]
+    else:
+        fmt, data = entry[0], entry[1]
+
+    match fmt:
+        case b'commit' : c = GitCommit
+        case b'tree'   : c = GitTree
+        case b'tag'    : c = GitTag
+        case b'blob'   : c = GitBlob
+        case _:
+            raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
+
+    # Call constructor and return object
+    obj = c(data)
+    if entry is not None:
+        cache.attach(entry, obj)
+    return obj
+
+def object_read_raw(repo, sha):
+    """ Read object sha from Git repository repo, as a (fmt, data)
+    pair, going through the repository's cache. """
+    cache = object_cache(repo)
+    entry = cache.get(sha)
+    if entry is not None:
+        return entry[0], entry[1]
+
+    fmt, data = object_read_uncached(repo, sha)
+    cache.put(sha, fmt, data)
+    return fmt, data
+
+def object_read_uncached(repo, sha):
+    """ Read object sha from Git repository repo, as a (fmt, data)
+    pair.  Loose objects are tried first, then packfiles. """
+
     path = repo_file(repo, "objects", sha[0:2], sha[2:])
-    
+
+    if not os.path.isfile(path):
+        # Not a loose object: it may have been packed.
+        ret = pack_read(repo, sha, lambda base: object_read_raw(repo, base))
+        if ret is None:
+            raise Exception(f"No such object {sha}")
+        return ret
+
     with open(path, "rb") as f:
         raw = zlib.decompress(f.read())
-        
+
         x = raw.find(b' ')
         fmt = raw[0:x]
-        
+
         y = raw.find(b'\x00', x)
         size = int(raw[x:y].decode('ascii'))
-        
+
         if size != len(raw) - y - 1:
             raise Exception(f"Malformed object {sha}: bad length")
-        match fmt:
-            case b'commit' : c = GitCommit
-            case b'tree'   : c = GitTree
-            case b'tag'    : c = GitTag
-            case b'blob'   : c = GitBlob
-            case _: 
-                raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
-        
-        # Call constructor and return object
-        return c(raw[y+1:])
-    
+
+        return fmt, raw[y+1:]
+
+def object_info(repo, sha):
+    """ Return the (fmt, size) of object sha, without reading all of it.
+
+    For a loose object we only inflate as much as the header needs; for
+    a packed object we read entry headers. """
+
+    entry = object_cache(repo).peek(sha)
+    if entry is not None:
+        return entry[0], len(entry[1])
+
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+
+    if not os.path.isfile(path):
+        ret = pack_info(repo, sha, lambda base: object_info(repo, base))
+        if ret is None:
+            raise Exception(f"No such object {sha}")
+        return ret
+
+    d = zlib.decompressobj()
+    header = b''
+    with open(path, "rb") as f:
+        # The header is "<fmt> <size>\x00", a few dozen bytes at most.
+        while b'\x00' not in header:
+            chunk = d.unconsumed_tail or f.read(64)
+            if not chunk or len(header) > 32:
+                raise Exception(f"Malformed object {sha}: bad header")
+            header += d.decompress(chunk, 32)
+
+    x = header.find(b' ')
+    y = header.find(b'\x00', x)
+    return header[0:x], int(header[x:y].decode('ascii'))
+
+def object_open(repo, sha):
+    """ Open object sha for reading.  Return a GitObjectReader, whose
+    fmt and size attributes describe the object.
+
+    Loose objects and undeltified packed objects are inflated as they're
+    read, so memory use doesn't depend on the object's size.  Deltified
+    objects have to be rebuilt in memory first. """
+
+    entry = object_cache(repo).peek(sha)
+    if entry is not None:
+        return GitObjectReader(entry[0], len(entry[1]), None, entry[1])
+
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+
+    if os.path.isfile(path):
+        f = open(path, "rb")
+        try:
+            # Inflate up to the end of the header.  Whatever follows
+            # it is the beginning of the data.
+            d = zlib.decompressobj()
+            raw = b''
+            while b'\x00' not in raw:
+                chunk = d.unconsumed_tail or f.read(64)
+                if not chunk or len(raw) > 32:
+                    raise Exception(f"Malformed object {sha}: bad header")
+                raw += d.decompress(chunk, 32)
+        except:
+            f.close()
+            raise
+
+        x = raw.find(b' ')
+        y = raw.find(b'\x00', x)
+        reader = GitObjectReader(raw[0:x], int(raw[x:y].decode('ascii')),
+                                 lambda: f.read(OBJECT_CHUNK_SIZE),
+                                 raw[y+1:],
+                                 on_close=f.close)
+        # We already started inflating this stream.
+        reader.decompressor = d
+        return reader
+
+    found = pack_find(repo, bytes.fromhex(sha))
+    if found is None:
+        raise Exception(f"No such object {sha}")
+
+    pack, offset = found
+    ret = pack.stream_at(offset)
+    if ret is None:
+        fmt, data = pack.read_at(offset, lambda base: object_read_raw(repo, base))
+        return GitObjectReader(fmt, len(data), None, data)
+
+    fmt, size, offset = ret
+    def read_compressed():
+        nonlocal offset
+        chunk = pack.pack[offset:offset+OBJECT_CHUNK_SIZE]
+        offset += len(chunk)
+        return chunk
+    return GitObjectReader(fmt, size, read_compressed)
+
 def object_write(obj, repo=None):
     # Serialize object data
     data = obj.serialize()
@@ -150,16 +541,78 @@ def object_write(obj, repo=None):
     # Compute hash
     sha = hashlib.sha1(result).hexdigest()
     
+    if repo and not os.path.exists(repo_file(repo, "objects", sha[0:2], sha[2:])):
+        fd, tmp_path = object_tmp_file(repo)
+        with os.fdopen(fd, "wb") as f:
+            # Compress and write
+            f.write(zlib.compress(result))
+        object_install(repo, tmp_path, sha)
+    return sha
+
+# Size of the chunks large objects are hashed and compressed by.
+OBJECT_CHUNK_SIZE = 1024 * 1024
+
+def object_write_stream(fd, size, fmt, repo=None):
+    """ Hash the size bytes read from fd as an object of type fmt,
+    writing it to repo if provided.  Return its SHA.
+
+    Data is hashed and compressed in OBJECT_CHUNK_SIZE chunks, so memory
+    use doesn't depend on the object size.  Since we only know the SHA
+    (hence the object's path) at the end, the object is written to a
+    temporary file which is then renamed into place. """
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    sha = hashlib.sha1(header)
+
+    out = None
     if repo:
-        # Compute path
-        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
-        
-        if not os.path.exists(path):
-            with open(path, "wb") as f:
-                # Compress and write
-                f.write(zlib.compress(result))
+        tmp_fd, tmp_path = object_tmp_file(repo)
+        out = os.fdopen(tmp_fd, "wb")
+        compressor = zlib.compressobj()
+        out.write(compressor.compress(header))
+
+    try:
+        total = 0
+        while True:
+            chunk = fd.read(OBJECT_CHUNK_SIZE)
+            if not chunk:
+                break
+            total += len(chunk)
+            sha.update(chunk)
+            if out:
+                out.write(compressor.compress(chunk))
+
+        if total != size:
+            raise Exception(f"Size changed while hashing: expected {size} bytes, read {total}")
+
+        if out:
+            out.write(compressor.flush())
+            out.close()
+    except:
+        if out:
+            out.close()
+            os.unlink(tmp_path)
+        raise
+
+    sha = sha.hexdigest()
+    if out:
+        object_install(repo, tmp_path, sha)
     return sha
 
+def object_tmp_file(repo):
+    """ Create a temporary file for a new loose object.  Return (fd,
+    path) """
+    return tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects", mkdir=True))
+
+def object_install(repo, tmp_path, sha):
+    """ Move the loose object written at tmp_path to its final place.
+    The rename is atomic: readers never see a partial object. """
+    path = os.path.join(repo_dir(repo, "objects", sha[0:2], mkdir=True), sha[2:])
+    if os.path.exists(path):
+        # Someone wrote it already.
+        os.unlink(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
 def object_find(repo, name, fmt=None, follow=True):
     sha = object_resolve(repo, name)
 
@@ -167,7 +620,8 @@ def object_find(repo, name, fmt=None, follow=True):
         raise Exception(f"No such reference {name}.")
 
     if len(sha) > 1:
-        raise Exception("Ambiguous reference {name}: Candidates are:\n - {'\n - '.join(sha)}.")
+        candidates = "\n - ".join(sha)
+        raise Exception(f"Ambiguous reference {name}: Candidates are:\n - {candidates}.")
 
     sha = sha[0]
 
@@ -175,23 +629,21 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
 
     while True:
-        obj = object_read(repo, sha)
-        #     ^^^^^^^^^^^ < this is a bit agressive: we're reading
-        # the full object just to get its type.  And we're doing
-        # that in a loop, albeit normally short.  Don't expect
-        # high performance here.
+        # Only the header is read to learn the type: the full object
+        # is read only when we have to follow it.
+        obj_fmt, _ = object_info(repo, sha)
 
-        if obj.fmt == fmt:
+        if obj_fmt == fmt:
             return sha
 
         if not follow:
             return None
 
         # Follow tags
-        if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode("ascii")
-        elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.kvlm[b'tree'].decode("ascii")
+        if obj_fmt == b'tag':
+            sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+        elif obj_fmt == b'commit' and fmt == b'tree':
+            sha = object_read(repo, sha).kvlm[b'tree'].decode("ascii")
         else:
             return None
 
@@ -206,26 +658,19 @@ def object_resolve(repo, name):
     - remote branches
     """
     candidates = list()
-    hashRE = re.compile(r"^([0-9a-Fa-f]{4,40})$")
+    hashRE = re.compile(r"^([0-9a-fA-F]{4,40})$")
     
     # empty string? Abort.    
     if not name.strip():
         return None
     
     if name == "HEAD":
-        return { ref_resolve(repo, "HEAD") }
+        return [ ref_resolve(repo, "HEAD") ]
     
     if hashRE.match(name):
-        
-        name = name.lower()
-        prefix = name[0:2]
-        path = repo_file(repo, "objects", prefix, mkdir=False)
-        
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    candidates.append(prefix + f)
+        # Binary searches over loose and packed objects, see GitOidIndex
+        candidates += oid_index(repo).lookup(name.lower())
+
     # try for refrerences
     as_tag = ref_resolve(repo, "refs/tags/" + name)
     if as_tag: # did we find a tag?
@@ -239,6 +684,10 @@ def object_resolve(repo, name):
         
 def object_hash(fd, fmt, repo=None):
     """ Hash object, writing it to repo if provided."""
+    if fmt == b'blob':
+        # Blobs don't need parsing, so we can stream them.
+        return object_write_stream(fd, os.fstat(fd.fileno()).st_size, fmt, repo)
+
     data = fd.read()
     
     match fmt:
@@ -304,14 +753,15 @@ def kvlm_serialize(kvlm):
         for v in val:
             ret += k + b' ' + v.replace(b'\n', b'\n ') + b'\n'
     
-    ret += '\n' + kvlm[None]
+    ret += b'\n' + kvlm[None]
     return ret
 
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
     ret = b''
-    for i in obj.items():
-        ret += i.mode
+    for i in obj.items:
+        # Git writes tree modes without the leading zero ("40000")
+        ret += i.mode.lstrip(b"0")
         ret += b' '
         ret += i.path.encode("utf8")
         ret += b'\x00'
@@ -341,7 +791,7 @@ def tree_parse_one(raw, start=0):
     # find the NULL terminator of the path
     y = raw.find(b'\x00', x)
     # and read the path
-    path = raw[x+1:y]
+    path = raw[x+1:y].decode("utf8")
     
     # read the SHA
     raw_sha = int.from_bytes(raw[y+1:y+21], "big")
@@ -360,7 +810,9 @@ def tree_parse(raw, start=0):
     return ret
 
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b"10"):
-        return leaf.path
+    # Git sorts entries by their raw bytes, with directories compared
+    # as if their name had a trailing slash.
+    if leaf.mode.startswith(b"04"):
+        return leaf.path.encode("utf8") + b"/"
     else:
-        return leaf.path
\ No newline at end of file
+        return leaf.path.encode("utf8")
\ No newline at end of file
@@ -0,0 +1,123 @@
+import bisect
+import os
+import re
+import time
+from GitPack import pack_indexes
+
+# Resolving an abbreviated SHA, and finding the shortest abbreviation
+# that's still unique, are binary searches over the sorted SHAs of the
+# repository's objects.  Packs are sorted already: their indexes, or
+# the multi-pack-index, are searched directly.  Loose objects are listed
+# one fanout directory (objects/ab/) at a time, as needed, and the
+# sorted list is kept until the directory's mtime changes, ie until an
+# object is added to it or removed.
+
+LOOSE_NAME = re.compile(r"[0-9a-f]{38}")
+# A directory changed this close to when we listed it may change again
+# without its mtime moving (timestamps have a granularity): don't keep
+# such a listing.
+OID_RACY_NS = 2 * 10**9
+
+class GitOidIndex(object):
+    """ The SHAs of a repository's objects, loose and packed """
+
+    def __init__(self, repo):
+        self.repo = repo
+        # Fanout directory ("ab") -> (mtime, sorted binary SHAs)
+        self.loose = dict()
+
+    def loose_dir(self, fanout):
+        """ Return the sorted binary SHAs of the loose objects in fanout
+        directory fanout ("ab"). """
+        path = os.path.join(self.repo.gitdir, "objects", fanout)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self.loose.pop(fanout, None)
+            return list()
+
+        cached = self.loose.get(fanout)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        now = time.time_ns()
+        shas = sorted(bytes.fromhex(fanout + f) for f in os.listdir(path)
+                      if LOOSE_NAME.fullmatch(f))
+        if now - mtime > OID_RACY_NS:
+            self.loose[fanout] = (mtime, shas)
+        else:
+            self.loose.pop(fanout, None)
+        return shas
+
+    def lookup(self, prefix):
+        """ Return the sorted hex SHAs of the objects whose SHA starts
+        with prefix, a lowercase hex string of at least 2 digits. """
+        lo = bytes.fromhex(prefix.ljust(40, "0"))
+        found = set()
+
+        shas = self.loose_dir(prefix[:2])
+        i = bisect.bisect_left(shas, lo)
+        while i < len(shas) and shas[i].hex().startswith(prefix):
+            found.add(shas[i].hex())
+            i += 1
+
+        for pack in pack_indexes(self.repo):
+            pos = pack.bisect(lo)
+            while pos < len(pack):
+                sha = pack.sha(pos)
+                if not sha.startswith(prefix):
+                    break
+                found.add(sha)
+                pos += 1
+
+        return sorted(found)
+
+    def abbrev(self, sha, minimum=7):
+        """ Return the shortest prefix of hex SHA sha, at least minimum
+        digits long, that no other object's SHA starts with. """
+        sha_bin = bytes.fromhex(sha)
+        # The SHAs sharing the longest prefix with sha are right before
+        # or after it in sorted order: look at those in each source.
+        neighbours = list()
+
+        shas = self.loose_dir(sha[:2])
+        i = bisect.bisect_left(shas, sha_bin)
+        if i > 0:
+            neighbours.append(shas[i - 1].hex())
+        if i < len(shas) and shas[i] == sha_bin:
+            i += 1
+        if i < len(shas):
+            neighbours.append(shas[i].hex())
+
+        for pack in pack_indexes(self.repo):
+            pos = pack.bisect(sha_bin)
+            if pos > 0:
+                neighbours.append(pack.sha(pos - 1))
+            if pos < len(pack) and pack.sha(pos) == sha:
+                pos += 1
+            if pos < len(pack):
+                neighbours.append(pack.sha(pos))
+
+        value = int(sha, 16)
+        common = 0
+        for other in neighbours:
+            # Leading zero hex digits of the XOR are the shared ones.
+            diff = value ^ int(other, 16)
+            common = max(common, 40 - (diff.bit_length() + 3) // 4)
+        return sha[:min(40, max(minimum, common + 1))]
+
+def oid_index(repo):
+    """ Return repo's GitOidIndex, created once per repository """
+    if repo.oid_index is None:
+        repo.oid_index = GitOidIndex(repo)
+    return repo.oid_index
+
+def oid_abbrev(repo, sha):
+    """ Return the abbreviated name of sha, as long as core.abbrev says
+    (7 by default, "no" for the full SHA), or longer if that's
+    ambiguous. """
+    value = repo.conf.get("core", "abbrev", fallback="7")
+    if value in ("no", "false"):
+        return sha
+    minimum = max(4, min(40, int(value))) if value.isdigit() else 7
+    return oid_index(repo).abbrev(sha, minimum)
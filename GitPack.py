@@ -0,0 +1,726 @@
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from GitRepository import repo_dir
+from GitMultiPackIndex import GitMultiPackIndex, midx_pack_name
+
+# Object types, as stored in the 3-bit type field of a pack entry
+# header.  5 is reserved.
+OBJ_COMMIT    = 1
+OBJ_TREE      = 2
+OBJ_BLOB      = 3
+OBJ_TAG       = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+PACK_TYPES = { OBJ_COMMIT : b'commit',
+               OBJ_TREE   : b'tree',
+               OBJ_BLOB   : b'blob',
+               OBJ_TAG    : b'tag' }
+
+class GitPack(object):
+    """ A packfile and its version 2 index, both memory-mapped.
+
+    The index starts with a 256-entry fanout table: entry N holds the
+    number of objects whose first SHA byte is <= N, which narrows the
+    binary search over the sorted SHA table to a single bucket. """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path[:-len(".pack")] + ".idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:4] != b"\377tOc":
+            raise Exception(f"Unsupported pack index {path}: only version 2 is supported")
+        version = int.from_bytes(self.idx[4:8], "big")
+        if version != 2:
+            raise Exception(f"Unsupported pack index version {version} in {path}")
+
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
+
+        # Offsets of the different tables inside the index file.
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.offset64_table = self.offset_table + 4 * self.count
+
+        if self.pack[0:4] != b"PACK":
+            raise Exception(f"Not a packfile: {path}")
+        version = int.from_bytes(self.pack[4:8], "big")
+        if version not in (2, 3):
+            raise Exception(f"Unsupported pack version {version} in {path}")
+        if int.from_bytes(self.pack[8:12], "big") != self.count:
+            raise Exception(f"Pack {path} and its index disagree on object count")
+
+        # Reverse index, computed on first use by revindex()
+        self.order = None
+        self.positions = None
+        # GitBitmap, loaded by GitBitmap.pack_bitmap()
+        self.bitmap = None
+
+    def close(self):
+        if self.bitmap is not None:
+            self.bitmap.close()
+        self.idx.close()
+        self.pack.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, sha):
+        return self.find(bytes.fromhex(sha)) is not None
+
+    def sha(self, pos):
+        """ Return the hex SHA of the pos-th object in index order """
+        start = self.sha_table + 20 * pos
+        return self.idx[start:start+20].hex()
+
+    def offset(self, pos):
+        """ Return the pack offset of the pos-th object in index order """
+        offset = int.from_bytes(self.idx[self.offset_table + 4 * pos:
+                                         self.offset_table + 4 * pos + 4], "big")
+        if offset & 0x80000000:
+            # The MSB means this is an index into the table of 64-bit
+            # offsets, used for packs larger than 2GB.
+            start = self.offset64_table + 8 * (offset & 0x7fffffff)
+            offset = int.from_bytes(self.idx[start:start+8], "big")
+        return offset
+
+    def revindex(self):
+        """ Return the reverse index: the index positions of the
+        objects, in the order they appear in the pack.  Reachability
+        bitmaps number objects in this order. """
+        if self.order is None:
+            offsets = struct.unpack_from(f">{self.count}L", self.idx, self.offset_table)
+            if any(o & 0x80000000 for o in offsets):
+                offsets = [ self.offset(i) for i in range(self.count) ]
+            self.order = array("L", sorted(range(self.count), key=offsets.__getitem__))
+        return self.order
+
+    def pack_position(self, sha):
+        """ Return the position in the pack (see revindex()) of object
+        sha (binary), or None """
+        pos = self.find(sha)
+        if pos is None:
+            return None
+        if self.positions is None:
+            positions = array("L", [0]) * self.count
+            for (i, p) in enumerate(self.revindex()):
+                positions[p] = i
+            self.positions = positions
+        return self.positions[pos]
+
+    def bisect(self, sha):
+        """ Binary search for binary sha.  Return the position in the
+        index of the first object whose SHA isn't smaller. """
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        idx = self.idx
+        base = self.sha_table
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + 20 * mid
+            if idx[start:start+20] < sha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, sha):
+        """ Binary search for binary sha.  Return its position in the
+        index, or None. """
+        pos = self.bisect(sha)
+        start = self.sha_table + 20 * pos
+        if pos < self.count and self.idx[start:start+20] == sha:
+            return pos
+        return None
+
+    def entry_header(self, offset):
+        """ Parse the entry header at offset.  Return (type, size,
+        data_offset) where size is the *inflated* size of the entry's
+        data (for deltas, the size of the delta itself). """
+        pack = self.pack
+        c = pack[offset]
+        offset += 1
+        type = (c >> 4) & 0b111
+        size = c & 0b1111
+        shift = 4
+        while c & 0x80:
+            c = pack[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type, size, offset
+
+    def inflate(self, offset, size):
+        """ Inflate the zlib stream starting at offset, which must
+        produce exactly size bytes. """
+        d = zlib.decompressobj()
+        out = list()
+        # Compressed data is usually smaller than its inflated size,
+        # but tiny or incompressible objects may not be, so we feed
+        # the decompressor until it reports the end of the stream.
+        step = max(size, 4096)
+        end = len(self.pack)
+        while not d.eof:
+            if offset >= end:
+                raise Exception(f"Truncated object in pack {self.path}")
+            out.append(d.decompress(self.pack[offset:offset+step]))
+            offset += step
+        data = b''.join(out)
+        if len(data) != size:
+            raise Exception(f"Malformed pack entry in {self.path}: bad length")
+        return data
+
+    def ofs_delta_base(self, offset):
+        """ Parse the negative base offset of an OFS_DELTA entry, at
+        offset.  Return (relative offset, data_offset) """
+        c = self.pack[offset]
+        offset += 1
+        rel = c & 0x7f
+        while c & 0x80:
+            c = self.pack[offset]
+            offset += 1
+            rel = ((rel + 1) << 7) | (c & 0x7f)
+        return rel, offset
+
+    def delta_target_size(self, offset):
+        """ Return the target size of the delta whose zlib stream starts
+        at offset.  Only the first few bytes are inflated. """
+        d = zlib.decompressobj()
+        head = b''
+        # Two varints of at most 10 bytes each.
+        while len(head) < 20 and not d.eof:
+            head += d.decompress(self.pack[offset:offset+256], 20 - len(head))
+            offset += 256
+        _, pos = delta_varint(head, 0)
+        size, _ = delta_varint(head, pos)
+        return size
+
+    def info_at(self, offset, base_info=None):
+        """ Return the (fmt, size) of the entry at offset.
+
+        This reads entry headers down the delta chain to find the type,
+        but only inflates the header of the outermost delta, which holds
+        the size. """
+        size = None
+        while True:
+            type, entry_size, data_offset = self.entry_header(offset)
+
+            if type == OBJ_OFS_DELTA:
+                rel, data_offset = self.ofs_delta_base(data_offset)
+                if size is None:
+                    size = self.delta_target_size(data_offset)
+                offset -= rel
+            elif type == OBJ_REF_DELTA:
+                base_sha = self.pack[data_offset:data_offset+20]
+                if size is None:
+                    size = self.delta_target_size(data_offset + 20)
+                pos = self.find(base_sha)
+                if pos is not None:
+                    offset = self.offset(pos)
+                elif base_info:
+                    fmt, _ = base_info(base_sha.hex())
+                    return fmt, size
+                else:
+                    raise Exception(f"Missing delta base {base_sha.hex()} for pack {self.path}")
+            elif type in PACK_TYPES:
+                return PACK_TYPES[type], entry_size if size is None else size
+            else:
+                raise Exception(f"Unknown pack entry type {type} at {offset} in {self.path}")
+
+    def stream_at(self, offset):
+        """ If the entry at offset is a full object (not a delta), return
+        (fmt, size, data_offset), so that its zlib stream can be inflated
+        incrementally from data_offset.  Return None for deltas, which
+        can only be rebuilt whole. """
+        type, size, data_offset = self.entry_header(offset)
+        if type not in PACK_TYPES:
+            return None
+        return PACK_TYPES[type], size, data_offset
+
+    def read_at(self, offset, base_read=None):
+        """ Read the entry at offset, resolving delta chains.  Return a
+        (fmt, data) pair.
+
+        REF_DELTA bases that aren't in this pack (as in a thin pack) are
+        looked up with base_read(sha), which should return a (fmt,
+        data) pair. """
+
+        # Walk down the delta chain until we meet a full object,
+        # stacking up deltas as we go.  This is iterative, since delta
+        # chains can be much deeper than Python's recursion limit.
+        deltas = list()
+        while True:
+            type, size, data_offset = self.entry_header(offset)
+
+            if type == OBJ_OFS_DELTA:
+                rel, data_offset = self.ofs_delta_base(data_offset)
+                deltas.append(self.inflate(data_offset, size))
+                offset -= rel
+            elif type == OBJ_REF_DELTA:
+                base_sha = self.pack[data_offset:data_offset+20]
+                deltas.append(self.inflate(data_offset + 20, size))
+                pos = self.find(base_sha)
+                if pos is not None:
+                    offset = self.offset(pos)
+                elif base_read:
+                    fmt, data = base_read(base_sha.hex())
+                    break
+                else:
+                    raise Exception(f"Missing delta base {base_sha.hex()} for pack {self.path}")
+            elif type in PACK_TYPES:
+                fmt = PACK_TYPES[type]
+                data = self.inflate(data_offset, size)
+                break
+            else:
+                raise Exception(f"Unknown pack entry type {type} at {offset} in {self.path}")
+
+        # Apply the deltas, innermost (closest to the base) first.
+        for delta in reversed(deltas):
+            data = delta_apply(data, delta)
+        return fmt, data
+
+    def info(self, sha, base_info=None):
+        """ Return the (fmt, size) of object sha (hex), or None if the
+        pack doesn't hold it."""
+        pos = self.find(bytes.fromhex(sha))
+        if pos is None:
+            return None
+        return self.info_at(self.offset(pos), base_info)
+
+    def read(self, sha, base_read=None):
+        """ Read object sha (hex) from this pack.  Return a (fmt, data)
+        pair, or None if the pack doesn't hold it."""
+        pos = self.find(bytes.fromhex(sha))
+        if pos is None:
+            return None
+        return self.read_at(self.offset(pos), base_read)
+
+def delta_varint(delta, pos):
+    """ Read one of the two size headers of a delta: a little-endian
+    base-128 varint.  Return (value, new_pos) """
+    value = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
+
+def delta_apply(base, delta):
+    """ Apply a git delta to base, returning the target bytes.
+
+    A delta is two varints (the base and target sizes) followed by a
+    stream of instructions: either "copy size bytes at offset from the
+    base", or "insert the next N literal bytes". """
+    src_size, pos = delta_varint(delta, 0)
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch")
+    dst_size, pos = delta_varint(delta, pos)
+
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            # Copy from base.  The low four bits say which offset
+            # bytes are present, the next three which size bytes are.
+            offset = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset+size]
+        elif cmd:
+            # Insert cmd literal bytes.
+            out += delta[pos:pos+cmd]
+            pos += cmd
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(out) != dst_size:
+        raise Exception("Delta target size mismatch")
+    return bytes(out)
+
+def pack_list(repo):
+    """ Return the packs in repo's objects/pack directory.
+
+    The list is cached on the repository, and reloaded when the
+    directory's mtime changes (eg, after a repack), along with the
+    multi-pack-index. """
+    path = repo_dir(repo, "objects", "pack")
+    if not path:
+        return list()
+
+    mtime = os.stat(path).st_mtime_ns
+    if repo.packs is not None and repo.packs_mtime == mtime:
+        return repo.packs
+
+    # Keep the packs we already have mapped open.
+    old = { p.path: p for p in (repo.packs or list()) }
+    packs = list()
+    for f in sorted(os.listdir(path)):
+        if not f.endswith(".pack"):
+            continue
+        full_path = os.path.join(path, f)
+        if full_path in old:
+            packs.append(old.pop(full_path))
+        elif os.path.exists(full_path[:-len(".pack")] + ".idx"):
+            packs.append(GitPack(full_path))
+    for p in old.values():
+        p.close()
+
+    if repo.midx is not None:
+        repo.midx.close()
+    repo.midx = pack_midx(repo, path, packs)
+    repo.packs = packs
+    repo.packs_mtime = mtime
+    return packs
+
+def pack_midx(repo, path, packs):
+    """ Load the multi-pack-index of pack directory path, and tie it to
+    packs.  Return None if there's none, if it's corrupt or stale (it
+    names packs that were deleted since), or if core.multiPackIndex is
+    false. """
+    if not repo.conf.getboolean("core", "multipackindex", fallback=True):
+        return None
+    midx_path = os.path.join(path, "multi-pack-index")
+    if not os.path.exists(midx_path):
+        return None
+
+    # A broken one is ignored too: the pack indexes still work.
+    try:
+        midx = GitMultiPackIndex(midx_path)
+    except Exception:
+        return None
+    by_name = { midx_pack_name(p): p for p in packs }
+    if not all(name in by_name for name in midx.names):
+        midx.close()
+        return None
+    midx.packs = [ by_name[name] for name in midx.names ]
+    # Packs written after it are looked up one by one.
+    covered = set(midx.names)
+    midx.others = [ p for p in packs if midx_pack_name(p) not in covered ]
+    return midx
+
+def pack_indexes(repo):
+    """ Return the sorted SHA tables to search for repo's packed
+    objects: the multi-pack-index and the packs it doesn't cover, or
+    the pack indexes.  They all have len(), sha(pos) and bisect(sha). """
+    packs = pack_list(repo)
+    if repo.midx is None:
+        return packs
+    return [ repo.midx ] + repo.midx.others
+
+def pack_find(repo, sha):
+    """ Look binary sha up in repo's packs.  Return the (GitPack, offset)
+    of the object, or None. """
+    packs = pack_list(repo)
+    midx = repo.midx
+    if midx is not None:
+        pos = midx.find(sha)
+        if pos is not None:
+            pack_id, offset = midx.location(pos)
+            return midx.packs[pack_id], offset
+        packs = midx.others
+
+    for pack in packs:
+        pos = pack.find(sha)
+        if pos is not None:
+            return pack, pack.offset(pos)
+    return None
+
+def pack_read(repo, sha, base_read=None):
+    """ Look object sha up in repo's packs.  Return a (fmt, data) pair,
+    or None. """
+    found = pack_find(repo, bytes.fromhex(sha))
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.read_at(offset, base_read)
+
+def pack_info(repo, sha, base_info=None):
+    """ Look object sha up in repo's packs.  Return its (fmt, size), or
+    None. """
+    found = pack_find(repo, bytes.fromhex(sha))
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.info_at(offset, base_info)
+
+# --------------------- pack writing ---------------------
+
+# Deltas are found by indexing the base in blocks of this many bytes.
+DELTA_BLOCK = 16
+
+# Objects larger than this are stored whole: delta search on them is
+# too slow to be worth it.
+DELTA_MAX_SIZE = 16 * 1024 * 1024
+
+def delta_header_varint(value):
+    """ Encode value as a delta size header (little-endian base-128) """
+    out = bytearray()
+    while True:
+        c = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(c | 0x80)
+        else:
+            out.append(c)
+            return bytes(out)
+
+def delta_copy_op(offset, size):
+    """ Encode a "copy size bytes at offset" delta instruction.  Only
+    non-zero bytes of offset and size are stored. """
+    cmd = 0x80
+    args = bytearray()
+    for i in range(4):
+        c = (offset >> (8 * i)) & 0xff
+        if c:
+            cmd |= 1 << i
+            args.append(c)
+    for i in range(3):
+        c = (size >> (8 * i)) & 0xff
+        if c:
+            cmd |= 0x10 << i
+            args.append(c)
+    return bytes([cmd]) + args
+
+def delta_create(base, target, max_size=None):
+    """ Compute a delta turning base into target, or None if it would be
+    larger than max_size.
+
+    We index the base in DELTA_BLOCK-sized blocks, then slide over the
+    target looking for blocks we know.  Matches are extended in both
+    directions, and everything between matches is inserted literally. """
+    out = bytearray(delta_header_varint(len(base)))
+    out += delta_header_varint(len(target))
+
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[i:i+DELTA_BLOCK], i)
+
+    literal = bytearray()
+    def flush():
+        # Insert instructions carry at most 127 bytes.
+        for i in range(0, len(literal), 127):
+            chunk = literal[i:i+127]
+            out.append(len(chunk))
+            out.extend(chunk)
+        literal.clear()
+
+    pos = 0
+    end = len(target)
+    while pos < end:
+        match = index.get(target[pos:pos+DELTA_BLOCK]) if pos + DELTA_BLOCK <= end else None
+        if match is None:
+            literal.append(target[pos])
+            pos += 1
+        else:
+            size = DELTA_BLOCK
+            # Extend forward...
+            while pos + size < end and match + size < len(base) \
+                  and target[pos + size] == base[match + size]:
+                size += 1
+            # ...and backward, eating into the pending literal.
+            while literal and match > 0 and base[match - 1] == literal[-1]:
+                literal.pop()
+                match -= 1
+                pos -= 1
+                size += 1
+            flush()
+            pos += size
+            # Copy instructions carry at most 0x10000 bytes.
+            while size:
+                n = min(size, 0x10000)
+                out += delta_copy_op(match, n)
+                match += n
+                size -= n
+
+        if max_size is not None and len(out) + len(literal) > max_size:
+            return None
+    flush()
+
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+def pack_name_hash(name):
+    """ Git's pack name hash: it mostly depends on the last characters of
+    the path, so that files with the same name or extension sort close
+    to each other and get a chance to be deltified together. """
+    hash = 0
+    for c in name:
+        if c.isspace():
+            continue
+        hash = (hash >> 2) + (ord(c) << 24)
+    return hash & 0xffffffff
+
+def pack_entry_header(type, size):
+    """ Encode a pack entry header: 3 bits of type, then the size as a
+    little-endian base-128 varint, starting with 4 bits. """
+    c = (type << 4) | (size & 0b1111)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    out.append(c)
+    return bytes(out)
+
+def pack_ofs_encode(rel):
+    """ Encode a negative OFS_DELTA offset.  This is big-endian, and
+    each continuation implicitly adds one, so that no two encodings
+    represent the same offset. """
+    out = [rel & 0x7f]
+    rel >>= 7
+    while rel:
+        rel -= 1
+        out.append(0x80 | (rel & 0x7f))
+        rel >>= 7
+    return bytes(reversed(out))
+
+def pack_write(repo, objects, read, window=10, depth=50):
+    """ Write objects into a new packfile and its index.
+
+    objects is a list of (sha, fmt, size, name) tuples, where name may
+    also be the name's hash, and read(sha) must return the object's
+    (fmt, data).  Each object is tried as a delta against the window
+    previous objects of the same type, sorted by type, name hash and
+    decreasing size, as git does; delta chains never get deeper than
+    depth.
+
+    Return (pack path, number of objects, number of deltas). """
+    fmt_types = { v: k for k, v in PACK_TYPES.items() }
+
+    # Objects listed from bitmaps come with a name hash instead of a
+    # name.
+    objects = sorted(objects,
+                     key=lambda o: (fmt_types[o[1]],
+                                    o[3] if type(o[3]) == int else pack_name_hash(o[3]),
+                                    -o[2]))
+
+    path = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp_path = os.path.join(path, f"tmp_pack_{os.getpid()}")
+
+    entries = list() # (binary sha, crc32, offset)
+    candidates = list() # Delta window: (fmt, data, depth, offset)
+    deltas = 0
+    checksum = hashlib.sha1()
+
+    with open(tmp_path, "wb") as f:
+        def emit(data):
+            checksum.update(data)
+            f.write(data)
+
+        emit(b"PACK" + (2).to_bytes(4, "big") + len(objects).to_bytes(4, "big"))
+        offset = 12
+
+        for (sha, fmt, size, _) in objects:
+            fmt, data = read(sha)
+
+            # Find the best delta base in the window.
+            best = None
+            if window and depth and len(data) <= DELTA_MAX_SIZE:
+                # A delta that isn't at least twice smaller than the
+                # object isn't worth the indirection.
+                max_size = len(data) // 2 - 20
+                for (base_fmt, base_data, base_depth, base_offset) in candidates:
+                    if base_fmt != fmt or base_depth >= depth:
+                        continue
+                    # Sizes too far apart can't give a small delta.
+                    if abs(len(base_data) - len(data)) > max_size:
+                        continue
+                    delta = delta_create(base_data, data, max_size)
+                    if delta is not None:
+                        best = (delta, base_depth, base_offset)
+                        max_size = len(delta) - 1
+
+            if best:
+                delta, base_depth, base_offset = best
+                entry = pack_entry_header(OBJ_OFS_DELTA, len(delta)) \
+                    + pack_ofs_encode(offset - base_offset) \
+                    + zlib.compress(delta)
+                obj_depth = base_depth + 1
+                deltas += 1
+            else:
+                entry = pack_entry_header(fmt_types[fmt], len(data)) + zlib.compress(data)
+                obj_depth = 0
+
+            emit(entry)
+            entries.append((bytes.fromhex(sha), zlib.crc32(entry), offset))
+
+            if window and len(data) <= DELTA_MAX_SIZE:
+                candidates.append((fmt, data, obj_depth, offset))
+                if len(candidates) > window:
+                    candidates.pop(0)
+
+            offset += len(entry)
+
+        pack_sha = checksum.digest()
+        f.write(pack_sha)
+
+    name = os.path.join(path, "pack-" + pack_sha.hex())
+    idx_write(name + ".idx", entries, pack_sha)
+    os.replace(tmp_path, name + ".pack")
+
+    return name + ".pack", len(objects), deltas
+
+def idx_write(path, entries, pack_sha):
+    """ Write a version 2 pack index.  entries is a list of (binary sha,
+    crc32, offset) tuples. """
+    entries = sorted(entries)
+
+    fanout = [0] * 256
+    for (sha, _, _) in entries:
+        fanout[sha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    out = bytearray(b"\377tOc" + (2).to_bytes(4, "big"))
+    out += struct.pack(">256I", *fanout)
+    for (sha, _, _) in entries:
+        out += sha
+    for (_, crc, _) in entries:
+        out += crc.to_bytes(4, "big")
+
+    # Offsets that don't fit on 31 bits go to a second table of 64-bit
+    # offsets, and the first table points to them.
+    large = list()
+    for (_, _, offset) in entries:
+        if offset < 0x80000000:
+            out += offset.to_bytes(4, "big")
+        else:
+            out += (0x80000000 | len(large)).to_bytes(4, "big")
+            large.append(offset)
+    for offset in large:
+        out += offset.to_bytes(8, "big")
+
+    out += pack_sha
+    out += hashlib.sha1(out).digest()
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(out)
+    os.replace(tmp_path, path)
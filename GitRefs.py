@@ -0,0 +1,272 @@
+import os
+from GitRepository import GitLock, repo_file
+from GitReftable import GitReftable
+
+# Refs go through a backend, chosen by extensions.wyagRefStorage: "files"
+# (the default, GitRefsFiles below) or "reftable" (see GitReftable).
+# Backends have the same methods:
+#
+#   read(ref)                  the value of ref: a SHA, "ref: <ref>" for
+#                              a symbolic ref, or None
+#   list(prefix)               (name, value) for the refs whose name
+#                              starts with prefix, sorted
+#   update(changes)            apply (ref, sha, old) changes, checking
+#                              that each ref still points to old
+#   pack(everything, peel)     consolidate storage, see refs_pack
+#
+# Backends only hold the refs under refs/.  HEAD and other pseudo-refs
+# are always files.
+#
+# The files backend stores refs as git does: loose refs are files under
+# refs/, and packed-refs lists many refs in one file, sorted by name:
+#
+#   # pack-refs with: peeled fully-peeled sorted
+#   <sha> refs/heads/main
+#   <sha> refs/tags/v1.0
+#   ^<sha>
+#
+# A "^" line gives the object the annotated tag above points to.  A
+# loose ref takes precedence over a packed ref of the same name: refs
+# are updated by writing loose files, and pack-refs moves them back to
+# packed-refs.
+
+PACKED_REFS_HEADER = "# pack-refs with: peeled fully-peeled sorted \n"
+
+class GitPackedRefs(object):
+    """ The refs of a packed-refs file """
+
+    def __init__(self, data=""):
+        # Ref name -> SHA
+        self.refs = dict()
+        # Ref name -> what the tag it points to points to, for tags
+        self.peeled = dict()
+        # Whether all refs are peeled: refs missing from self.peeled
+        # then don't point to tags.
+        self.fully_peeled = False
+
+        name = None
+        for line in data.splitlines():
+            if line.startswith("#"):
+                self.fully_peeled = " fully-peeled " in line + " "
+            elif line.startswith("^"):
+                if name is None:
+                    raise Exception("Malformed packed-refs: peeled line without a ref")
+                self.peeled[name] = line[1:].strip()
+            elif line:
+                sha, _, name = line.partition(" ")
+                if len(sha) != 40 or not name:
+                    raise Exception(f"Malformed packed-refs line: {line}")
+                self.refs[name] = sha
+
+    def get(self, name):
+        return self.refs.get(name)
+
+def packed_refs(repo):
+    """ Return repo's GitPackedRefs.  It's cached on the repository, and
+    reloaded when the file is replaced. """
+    path = repo_file(repo, "packed-refs")
+    try:
+        st = os.stat(path)
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        stamp = None
+
+    if repo.packed_refs is not None and repo.packed_refs_stamp == stamp:
+        return repo.packed_refs
+
+    data = ""
+    if stamp is not None:
+        with open(path, "r") as f:
+            data = f.read()
+    repo.packed_refs = GitPackedRefs(data)
+    repo.packed_refs_stamp = stamp
+    return repo.packed_refs
+
+def packed_refs_serialize(refs, peeled):
+    """ Return the content of a packed-refs file for refs ({name: sha}),
+    with the peeled values of the tags among them. """
+    out = [ PACKED_REFS_HEADER ]
+    for name in sorted(refs):
+        out.append(f"{refs[name]} {name}\n")
+        if name in peeled:
+            out.append(f"^{peeled[name]}\n")
+    return "".join(out)
+
+def ref_read_loose(repo, ref):
+    """ Return the content of loose ref ref (a path relative to the
+    gitdir), or None if there's no such file. """
+    try:
+        with open(repo_file(repo, ref), "r") as fp:
+            return fp.read().strip()
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return None
+
+def ref_update_loose(repo, ref, sha, old=None, current=None):
+    """ Point loose ref ref at sha.  The file is replaced atomically,
+    under its lock.  If old is given, the ref must still point at it
+    ("" meaning it doesn't exist yet) once we hold the lock; otherwise
+    someone else updated it, and we fail.  current(ref) returns the
+    ref's value, by default its file's content. """
+    with GitLock(repo, ref, component="reference") as lock:
+        if old is not None:
+            value = (current(ref) if current else ref_read_loose(repo, ref)) or ""
+            if value != old:
+                raise Exception(f"Cannot update {ref}: it points to {value or 'nothing'}, expected {old or 'nothing'}.")
+        lock.write((sha + "\n").encode("ascii"))
+        lock.commit()
+
+def refs_loose(repo, prefix="refs"):
+    """ Walk the loose refs under prefix.  Return a {name: content}
+    dict.  Lock files are skipped. """
+    refs = dict()
+    todo = [ prefix ]
+    while todo:
+        path = todo.pop()
+        try:
+            entries = list(os.scandir(repo_file(repo, path)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            name = path + "/" + entry.name
+            if entry.is_dir():
+                todo.append(name)
+            elif not entry.name.endswith(".lock"):
+                data = ref_read_loose(repo, name)
+                if data is not None:
+                    refs[name] = data
+    return refs
+
+class GitRefsFiles(object):
+    """ The files ref backend: loose refs over packed-refs """
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def read(self, ref):
+        data = ref_read_loose(self.repo, ref)
+        if data is None:
+            data = packed_refs(self.repo).get(ref)
+        return data
+
+    def list(self, prefix="refs/"):
+        refs = { name: sha for (name, sha) in packed_refs(self.repo).refs.items()
+                 if name.startswith(prefix) }
+        # Only walk the directories that can hold matches.
+        path = prefix.rstrip("/") if prefix.endswith("/") else os.path.dirname(prefix)
+        for (name, data) in refs_loose(self.repo, path).items():
+            if name.startswith(prefix):
+                refs[name] = data
+        for name in sorted(refs):
+            yield name, refs[name]
+
+    def update(self, changes):
+        for (ref, sha, old) in changes:
+            ref_update_loose(self.repo, ref, sha, old, current=self.read)
+
+    def pack(self, everything=False, peel=None):
+        """ Move loose refs into packed-refs, like git pack-refs: the
+        tags and the refs already packed, or with everything, all refs
+        but symbolic ones.  peel(sha) returns what the tag sha points
+        to, or None if sha isn't a tag.  Return the number of refs
+        packed. """
+        repo = self.repo
+        with GitLock(repo, "packed-refs", component="reference") as lock:
+            packed = packed_refs(repo)
+            refs = dict(packed.refs)
+            peeled = dict(packed.peeled)
+
+            moved = dict()
+            for (name, data) in refs_loose(repo).items():
+                if data.startswith("ref: "):
+                    continue
+                if everything or name.startswith("refs/tags/") or name in packed.refs:
+                    moved[name] = data
+                    refs[name] = data
+                    peeled.pop(name, None)
+
+            # Record what tags point to, so that readers don't have to.
+            # If the file didn't say which refs are tags, check them all.
+            if peel is not None:
+                for name in (moved if packed.fully_peeled else refs):
+                    if name not in peeled:
+                        target = peel(refs[name])
+                        if target is not None:
+                            peeled[name] = target
+
+            lock.write(packed_refs_serialize(refs, peeled).encode("utf8"))
+            lock.commit()
+
+        # Now that they're packed, drop the loose files, unless they
+        # were updated in the meantime.
+        for (name, sha) in moved.items():
+            with GitLock(repo, name, component="reference") as lock:
+                if ref_read_loose(repo, name) == sha:
+                    os.unlink(lock.path)
+            # And the directories left empty, below refs/heads or
+            # refs/tags
+            path = os.path.dirname(name)
+            while path.count("/") >= 2:
+                try:
+                    os.rmdir(repo_file(repo, path))
+                except OSError:
+                    break # Not empty
+                path = os.path.dirname(path)
+
+        return len(moved)
+
+def ref_backend(repo):
+    """ Return repo's ref backend, as extensions.wyagRefStorage says """
+    if repo.refs is None:
+        storage = repo.conf.get("extensions", "wyagrefstorage", fallback="files")
+        match storage:
+            case "files"    : repo.refs = GitRefsFiles(repo)
+            case "reftable" : repo.refs = GitReftable(repo)
+            case _          : raise Exception(f"Unknown ref storage {storage}")
+    return repo.refs
+
+def ref_read(repo, ref):
+    """ Return the content of ref: a SHA or "ref: <other ref>", or
+    None. """
+    if not ref.startswith("refs/"):
+        return ref_read_loose(repo, ref)
+    return ref_backend(repo).read(ref)
+
+def ref_resolve(repo, ref):
+    """ Return the SHA ref (eg "HEAD" or "refs/heads/main") points to,
+    following symbolic refs, or None. """
+    data = ref_read(repo, ref)
+    if data is not None and data.startswith("ref: "):
+        return ref_resolve(repo, data[5:])
+    return data
+
+def ref_list(repo):
+    """ Return the refs as a nested dict sorted as git shows them:
+    { "heads": { "main": sha, ... }, "tags": { ... } } """
+    refs = list()
+    for (name, data) in ref_backend(repo).list("refs/"):
+        refs.append((name, ref_resolve(repo, name) if data.startswith("ref: ") else data))
+    refs.sort(key=lambda r: r[0].split("/"))
+
+    ret = dict()
+    for (name, sha) in refs:
+        parts = name.split("/")[1:]
+        node = ret
+        for part in parts[:-1]:
+            node = node.setdefault(part, dict())
+        node[parts[-1]] = sha
+    return ret
+
+def ref_update(repo, ref, sha, old=None):
+    """ Point ref, a path relative to the gitdir, at sha.  If old is
+    given, the ref must still point at it ("" meaning it doesn't exist
+    yet); otherwise someone else updated it, and we fail. """
+    if not ref.startswith("refs/"):
+        ref_update_loose(repo, ref, sha, old)
+    else:
+        ref_backend(repo).update([ (ref, sha, old) ])
+
+def refs_pack(repo, everything=False, peel=None):
+    """ Consolidate repo's refs: with the files backend, move loose refs
+    into packed-refs; with reftable, merge the tables.  Return the
+    number of refs packed. """
+    return ref_backend(repo).pack(everything, peel)
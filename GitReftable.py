@@ -0,0 +1,451 @@
+import heapq
+import mmap
+import os
+import struct
+import zlib
+from GitRepository import GitLock, repo_dir, repo_file
+from GitPack import pack_ofs_encode
+
+# A ref storage backend modeled on git's reftable (version 1), for
+# repositories with millions of refs: with extensions.wyagRefStorage set
+# to "reftable", refs live in reftable/ instead of loose files and
+# packed-refs.
+#
+# reftable/tables.list names a stack of tables, oldest first.  A table
+# is never modified: an update writes a new, small table with the refs
+# it changes (O(changes), whatever the number of refs), and appends it
+# to the stack.  A ref's value is the one in the newest table that has
+# it.  To keep the stack short, adjacent tables are merged
+# ("compacted") when the newer ones get as large as the older ones, so
+# that table sizes form a geometric sequence.
+#
+# A table is a header, blocks of ref records sorted by name, an
+# optional index of those blocks, and a footer:
+#
+#   header   "REFT", version, block size (24 bits), min and max update
+#            index (64 bits each): the updates the table records
+#   block    type ("r" or "i"), length (24 bits), records, then the
+#            offsets of the restart records (24 bits each) and their
+#            count (16 bits).  Ref blocks are padded to the block size,
+#            and the first one includes the header.
+#   footer   the header again, the index position, unused positions
+#            (objects and logs, which we don't write) and a CRC-32
+#
+# Each record only stores the part of its name that differs from the
+# previous one: a varint of the length of the prefix shared with it, a
+# varint of (suffix length << 3 | value type), the suffix, then the
+# value.  Every REFTABLE_RESTART_INTERVAL records, a restart record
+# stores its whole name, so that a block is binary searched on its
+# restarts, then scanned forward.  The index has a record per ref
+# block, named after the block's last ref, whose value is the block's
+# position.  A lookup is a binary search in the index, then in a block.
+#
+# Unlike git, HEAD stays a file: only refs under refs/ are in tables.
+# Tables record no reflogs, and have a single level of index.
+
+REFTABLE_MAGIC = b"REFT"
+REFTABLE_VERSION = 1
+REFTABLE_BLOCK_SIZE = 4096
+REFTABLE_RESTART_INTERVAL = 16
+# Tables with more ref blocks than this get an index
+REFTABLE_INDEX_MIN_BLOCKS = 3
+REFTABLE_HEADER = struct.Struct(">4sB3sQQ")
+REFTABLE_FOOTER = struct.Struct(">24sQQQQQL")
+
+# Value types of ref records
+REFTABLE_DELETION = 0
+REFTABLE_VAL1 = 1 # A SHA
+REFTABLE_VAL2 = 2 # A SHA, and what the tag it points to points to
+REFTABLE_SYMREF = 3 # "ref: <other ref>"
+
+def reftable_varint(data, pos):
+    """ Decode the varint at pos in data (the same encoding as pack
+    OFS_DELTA offsets).  Return (value, position after it). """
+    c = data[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+class GitReftableFile(object):
+    """ A table of the stack, memory-mapped """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+
+        if len(data) < REFTABLE_HEADER.size + REFTABLE_FOOTER.size:
+            raise Exception(f"Malformed reftable {path}: truncated")
+        magic, version, block_size, self.min_index, self.max_index = \
+            REFTABLE_HEADER.unpack_from(data, 0)
+        if magic != REFTABLE_MAGIC:
+            raise Exception(f"Not a reftable: {path}")
+        if version != REFTABLE_VERSION:
+            raise Exception(f"Unsupported reftable version {version} in {path}")
+        self.block_size = int.from_bytes(block_size, "big")
+
+        footer_pos = len(data) - REFTABLE_FOOTER.size
+        header, self.index_pos, _, _, _, _, crc = REFTABLE_FOOTER.unpack_from(data, footer_pos)
+        if header != data[0:REFTABLE_HEADER.size]:
+            raise Exception(f"Malformed reftable {path}: footer doesn't match header")
+        if crc != zlib.crc32(data[footer_pos:len(data) - 4]):
+            raise Exception(f"Malformed reftable {path}: bad footer checksum")
+        # Where the ref blocks end
+        self.ref_end = self.index_pos or footer_pos
+
+    def close(self):
+        self.data.close()
+
+    def block(self, pos):
+        """ Return (type, position of the first record, position of the
+        restart table, number of restarts) for the block at pos. """
+        header = pos + REFTABLE_HEADER.size if pos == 0 else pos
+        kind = self.data[header:header+1]
+        end = pos + int.from_bytes(self.data[header+1:header+4], "big")
+        count = int.from_bytes(self.data[end-2:end], "big")
+        return kind, header + 4, end - 2 - 3 * count, count
+
+    def next_block(self, pos):
+        """ Return the position of the ref block after the one at pos, or
+        None """
+        header = pos + REFTABLE_HEADER.size if pos == 0 else pos
+        end = pos + int.from_bytes(self.data[header+1:header+4], "big")
+        # Skip the padding
+        end = -(-end // self.block_size) * self.block_size
+        return end if end < self.ref_end else None
+
+    def record(self, pos, prev):
+        """ Decode the name of the record at pos, following a record
+        named prev.  Return (name, value type, position of the value). """
+        prefix, pos = reftable_varint(self.data, pos)
+        n, pos = reftable_varint(self.data, pos)
+        name = prev[:prefix] + self.data[pos:pos + (n >> 3)]
+        return name, n & 7, pos + (n >> 3)
+
+    def ref_value(self, vtype, pos):
+        """ Decode the value of a ref record at pos.  Return (update index,
+        value, position after it): the value is a hex SHA, "ref: <ref>",
+        or None for a deletion. """
+        delta, pos = reftable_varint(self.data, pos)
+        match vtype:
+            case 0:
+                value = None
+            case 1:
+                value = self.data[pos:pos+20].hex()
+                pos += 20
+            case 2:
+                value = self.data[pos:pos+20].hex()
+                pos += 40
+            case 3:
+                size, pos = reftable_varint(self.data, pos)
+                value = "ref: " + self.data[pos:pos+size].decode("utf8")
+                pos += size
+            case _:
+                raise Exception(f"Malformed reftable {self.path}: bad value type {vtype}")
+        return self.min_index + delta, value, pos
+
+    def block_seek(self, pos, key):
+        """ Yield (name, value type, position of the value) for the
+        records of the block at pos named key or after it. """
+        kind, start, restarts, count = self.block(pos)
+
+        # Last restart whose name is <= key: restarts store whole names.
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = pos + int.from_bytes(self.data[restarts + 3*mid:restarts + 3*mid + 3], "big")
+            name, _, _ = self.record(offset, b"")
+            if name <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo:
+            start = pos + int.from_bytes(self.data[restarts + 3*(lo-1):restarts + 3*lo], "big")
+
+        name = b""
+        offset = start
+        while offset < restarts:
+            name, vtype, offset = self.record(offset, name)
+            value_pos = offset
+            if kind == b"i":
+                _, offset = reftable_varint(self.data, offset)
+            else:
+                _, _, offset = self.ref_value(vtype, offset)
+            if name >= key:
+                yield name, vtype, value_pos
+
+    def seek(self, key):
+        """ Yield (name, update index, value) for the refs named key (bytes)
+        or after it, in order. """
+        pos = 0 if self.ref_end > REFTABLE_HEADER.size else None
+        if self.index_pos:
+            # The first block whose last ref is >= key
+            pos = None
+            for (_, _, value_pos) in self.block_seek(self.index_pos, key):
+                pos, _ = reftable_varint(self.data, value_pos)
+                break
+
+        while pos is not None:
+            for (name, vtype, value_pos) in self.block_seek(pos, key):
+                index, value, _ = self.ref_value(vtype, value_pos)
+                yield name.decode("utf8"), index, value
+            pos = self.next_block(pos)
+
+    def get(self, name):
+        """ Return (update index, value) of ref name, or None if the table
+        doesn't have it.  A None value means it was deleted. """
+        key = name.encode("utf8")
+        for (found, index, value) in self.seek(key):
+            if found == name:
+                return index, value
+            return None
+        return None
+
+def reftable_block(kind, records, start, block_size, first=False):
+    """ Pack records[start:], a list of (name, value type, value bytes)
+    sorted by name, into a block.  Take as many as fit in block_size (at
+    least one).  Return (the block, the number of records taken). """
+    out = bytearray(b"\0" * REFTABLE_HEADER.size if first else b"")
+    out += kind + b"\0\0\0"
+    restarts = list()
+    prev = b""
+    taken = 0
+    for i in range(start, len(records)):
+        name, vtype, value = records[i]
+        restart = taken % REFTABLE_RESTART_INTERVAL == 0
+        prefix = 0
+        if not restart:
+            # The leading zero bytes of the XOR of the names are their
+            # common prefix.
+            n = min(len(prev), len(name))
+            diff = int.from_bytes(prev[:n], "big") ^ int.from_bytes(name[:n], "big")
+            prefix = n - (diff.bit_length() + 7) // 8
+        record = pack_ofs_encode(prefix) \
+            + pack_ofs_encode(((len(name) - prefix) << 3) | vtype) \
+            + name[prefix:] + value
+        if taken and len(out) + len(record) + 3 * (len(restarts) + restart) + 2 > block_size:
+            break
+        if restart:
+            restarts.append(len(out))
+        out += record
+        prev = name
+        taken += 1
+
+    for r in restarts:
+        out += r.to_bytes(3, "big")
+    out += len(restarts).to_bytes(2, "big")
+    header = REFTABLE_HEADER.size if first else 0
+    out[header+1:header+4] = len(out).to_bytes(3, "big")
+    return out, taken
+
+def reftable_serialize(refs, min_index, max_index, block_size=REFTABLE_BLOCK_SIZE):
+    """ Return a table of refs, a list of (name, update index, value)
+    sorted by name, where value is a hex SHA, "ref: <ref>", or None for
+    a deletion. """
+    records = list()
+    for (name, index, value) in refs:
+        delta = pack_ofs_encode(index - min_index)
+        if value is None:
+            records.append((name.encode("utf8"), REFTABLE_DELETION, delta))
+        elif value.startswith("ref: "):
+            target = value[5:].encode("utf8")
+            records.append((name.encode("utf8"), REFTABLE_SYMREF,
+                            delta + pack_ofs_encode(len(target)) + target))
+        else:
+            records.append((name.encode("utf8"), REFTABLE_VAL1, delta + bytes.fromhex(value)))
+
+    header = REFTABLE_HEADER.pack(REFTABLE_MAGIC, REFTABLE_VERSION,
+                                  block_size.to_bytes(3, "big"), min_index, max_index)
+    out = bytearray(header)
+    index = list()
+    i = 0
+    while i < len(records):
+        pos = 0 if i == 0 else len(out)
+        block, taken = reftable_block(b"r", records, i, block_size, first=(i == 0))
+        if i == 0:
+            out[:] = block
+            out[0:REFTABLE_HEADER.size] = header
+        else:
+            out += block
+        i += taken
+        index.append((records[i-1][0], 0, pack_ofs_encode(pos)))
+        if i < len(records):
+            out += bytes(-len(out) % block_size)
+
+    # Small tables are scanned block by block instead.
+    index_pos = 0
+    if len(index) > REFTABLE_INDEX_MIN_BLOCKS:
+        index_pos = len(out)
+        block, _ = reftable_block(b"i", index, 0, len(index) * 1024 + block_size)
+        out += block
+
+    footer = REFTABLE_FOOTER.pack(header, index_pos, 0, 0, 0, 0, 0)[:-4]
+    out += footer + zlib.crc32(footer).to_bytes(4, "big")
+    return bytes(out)
+
+class GitReftable(object):
+    """ The reftable ref backend: the stack of tables in reftable/ """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.tables = list()
+        self.stamp = None
+
+    def load(self):
+        """ (Re)load the stack if tables.list changed, and return it """
+        path = repo_file(self.repo, "reftable", "tables.list")
+        try:
+            st = os.stat(path)
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self.stamp:
+            return self.tables
+
+        names = list()
+        if stamp is not None:
+            with open(path, "r") as f:
+                names = f.read().split()
+        # Keep the tables we already have mapped: they never change.
+        old = { os.path.basename(t.path): t for t in self.tables }
+        tables = list()
+        try:
+            for name in names:
+                if name in old:
+                    tables.append(old[name])
+                else:
+                    tables.append(GitReftableFile(repo_file(self.repo, "reftable", name)))
+        except FileNotFoundError:
+            # A compaction removed the table since we read the list:
+            # read the new one.
+            for t in tables:
+                if t not in old.values():
+                    t.close()
+            return self.load()
+        for t in old.values():
+            if t not in tables:
+                t.close()
+
+        self.tables = tables
+        self.stamp = stamp
+        return tables
+
+    def read(self, ref):
+        """ Return the value of ref (a SHA or "ref: <ref>"), or None """
+        for table in reversed(self.load()):
+            ret = table.get(ref)
+            if ret is not None:
+                return ret[1]
+        return None
+
+    def list(self, prefix="refs/"):
+        """ Yield (name, value) for the refs whose name starts with
+        prefix, sorted. """
+        for (name, _, value) in self.merge(self.load(), prefix):
+            if value is not None:
+                yield name, value
+
+    def merge(self, tables, prefix):
+        """ Yield (name, update index, value) for the records of tables
+        whose name starts with prefix, sorted.  The newest table has the
+        final say on each ref: its record may be a deletion. """
+        key = prefix.encode("utf8")
+
+        def walk(i, table):
+            for (name, index, value) in table.seek(key):
+                if not name.startswith(prefix):
+                    break
+                yield name, -i, index, value
+
+        last = None
+        for (name, _, index, value) in heapq.merge(*[ walk(i, t) for (i, t) in enumerate(tables) ]):
+            if name != last:
+                last = name
+                yield name, index, value
+
+    def update(self, changes):
+        """ Apply changes, a list of (ref, sha, old) tuples, as a single
+        new table.  If old isn't None, ref must point to it ("" meaning
+        it doesn't exist) or nothing is changed. """
+        repo_dir(self.repo, "reftable", mkdir=True)
+        with GitLock(self.repo, "reftable", "tables.list", component="reference") as lock:
+            tables = self.load()
+            for (ref, _, old) in changes:
+                if old is None:
+                    continue
+                current = self.read(ref) or ""
+                if current != old:
+                    raise Exception(f"Cannot update {ref}: it points to {current or 'nothing'}, expected {old or 'nothing'}.")
+
+            index = tables[-1].max_index + 1 if tables else 1
+            refs = dict((ref, sha) for (ref, sha, _) in changes)
+            name = self.write([ (ref, index, refs[ref]) for ref in sorted(refs) ], index, index)
+            names = [ os.path.basename(t.path) for t in tables ] + [ name ]
+            lock.write("".join(n + "\n" for n in names).encode("utf8"))
+            lock.commit()
+        self.compact(auto=True)
+
+    def pack(self, everything=False, peel=None):
+        """ Merge all the tables into one.  Return the number of refs in
+        it. """
+        self.compact()
+        return sum(1 for _ in self.list(""))
+
+    def write(self, refs, min_index, max_index):
+        """ Write a table of refs (see reftable_serialize).  Return its
+        path. """
+        path = repo_dir(self.repo, "reftable", mkdir=True)
+        name = f"0x{min_index:012x}-0x{max_index:012x}-{os.urandom(4).hex()}.ref"
+        tmp_path = os.path.join(path, "tmp_" + name)
+        with open(tmp_path, "wb") as f:
+            f.write(reftable_serialize(refs, min_index, max_index))
+        os.replace(tmp_path, os.path.join(path, name))
+        return name
+
+    def compact(self, auto=False):
+        """ Merge tables of the stack into one.  With auto, only the
+        newest tables whose sizes break the geometric sequence, if any;
+        otherwise all of them.  Return the number of refs in the merged
+        table, or None if there was nothing to merge. """
+        # Automatic compaction is only an optimization: skip it if
+        # another process is updating the stack.
+        repo_dir(self.repo, "reftable", mkdir=True)
+        lock = GitLock(self.repo, "reftable", "tables.list", component="reference",
+                       timeout=0 if auto else None)
+        if not lock.acquire(required=not auto):
+            return None
+        try:
+            tables = self.load()
+            sizes = [ len(t.data) for t in tables ]
+
+            start = 0
+            if auto:
+                start = len(tables) - 1
+                total = sizes[-1] if tables else 0
+                while start > 0 and sizes[start - 1] <= 2 * total:
+                    start -= 1
+                    total += sizes[start]
+            if len(tables) - start < 2:
+                return None
+
+            # Deletions only need to hide refs from older tables: when
+            # the oldest one is merged too, they can go.
+            merged = tables[start:]
+            refs = [ r for r in self.merge(merged, "") if start or r[2] is not None ]
+            names = [ os.path.basename(t.path) for t in tables[:start] ]
+            if refs:
+                names.append(self.write(refs, merged[0].min_index, merged[-1].max_index))
+            lock.write("".join(n + "\n" for n in names).encode("utf8"))
+            lock.commit()
+        finally:
+            lock.rollback()
+
+        for t in merged:
+            os.unlink(t.path)
+        self.load()
+        return len(refs)
@@ -1,11 +1,30 @@
 import os
 import configparser
+import random
+import time
 
 class GitRepository:
     """ A git repository """
     worktree = None
     gitdir = None
     conf = None
+    # Packfiles, loaded lazily by GitPack.pack_list()
+    packs = None
+    packs_mtime = None
+    # And the multi-pack-index, loaded with them
+    midx = None
+    # Object cache, created lazily by GitObject.object_cache()
+    object_cache = None
+    # Commit-graph, loaded lazily by GitCommitGraph.commit_graph()
+    commit_graph = None
+    commit_graph_stamp = None
+    # packed-refs, loaded lazily by GitRefs.packed_refs()
+    packed_refs = None
+    packed_refs_stamp = None
+    # Ref backend, created lazily by GitRefs.ref_backend()
+    refs = None
+    # Object SHA index, created lazily by GitOidIndex.oid_index()
+    oid_index = None
 
     def __init__(self, path, force=False):
         self.worktree = path
@@ -24,13 +43,39 @@ class GitRepository:
         
         if not force:
             version = int(self.conf.get("core", "repositoryformatversion"))
-            if version != 0:
+            if version not in (0, 1):
                 raise ValueError(f"Unsupported repositoryformatversion {version}")
+            # Version 1 repositories list the extensions one must know
+            # to use them.
+            if version == 1 and self.conf.has_section("extensions"):
+                for name in self.conf["extensions"]:
+                    if name not in REPO_EXTENSIONS:
+                        raise ValueError(f"Unsupported repository extension {name}")
+
+# Repository extensions (core.repositoryformatversion 1) we support.
+# Our reftable isn't byte-compatible with git's, so it goes under a name
+# of our own: git refuses the repository instead of misreading it.
+REPO_EXTENSIONS = [ "wyagrefstorage" ]
 
 def repo_file(repo, *path):
     """ Compute path under repo's gitdir """
     return os.path.join(repo.gitdir, *path)
 
+def repo_exclude_files(repo):
+    """ Return the paths of the ignore files that apply to the whole
+    worktree, existing or not: .git/info/exclude, and core.excludesFile
+    ($XDG_CONFIG_HOME/git/ignore by default). """
+    global_file = repo.conf.get("core", "excludesfile", fallback=None)
+    if global_file:
+        global_file = os.path.expanduser(global_file)
+    else:
+        if "XDG_CONFIG_HOME" in os.environ:
+            config_home = os.environ["XDG_CONFIG_HOME"]
+        else:
+            config_home = os.path.expanduser("~/.config")
+        global_file = os.path.join(config_home, "git/ignore")
+    return [ repo_file(repo, "info", "exclude"), global_file ]
+
 def repo_dir(repo, *path, mkdir=False):
 
     """ Same as repo_file, but mkdir *path if absent.
@@ -51,6 +96,105 @@ def repo_dir(repo, *path, mkdir=False):
     else:
         return None
 
+def config_size(value):
+    """ Parse a size from the configuration, with an optional k, m or g
+    suffix, as git does. """
+    value = value.strip().lower()
+    units = { "k": 1024, "m": 1024**2, "g": 1024**3 }
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+# Components of core.fsync, and the values that include them
+FSYNC_COMPONENTS = {
+    "index": ("index", "added", "all"),
+    "reference": ("reference", "committed", "added", "all"),
+}
+
+def repo_fsync(repo, component):
+    """ Return True if files of component (index or reference) must be
+    fsync()ed before they're renamed into place, per core.fsync. """
+    value = repo.conf.get("core", "fsync", fallback="")
+    values = [ v.strip().lower() for v in value.split(",") ]
+    return any(v in FSYNC_COMPONENTS[component] for v in values)
+
+class GitLock(object):
+    """ A lock on a file of the repository, the way git does it.  The
+    new content is written to path.lock, created exclusively, then
+    renamed over path.  Readers never see a partial file, and only one
+    writer at a time holds the lock.
+
+    Take the lock before reading the file to update, so that no other
+    writer's change is lost in between.  Used as a context manager, the
+    lock is released without changing anything unless commit() was
+    called. """
+    def __init__(self, repo, *path, component=None, timeout=None):
+        self.path = repo_file(repo, *path)
+        self.lock_path = self.path + ".lock"
+        self.fsync = repo_fsync(repo, component) if component else False
+        # How long to wait for another writer, in seconds
+        if timeout is None:
+            timeout = repo.conf.getint("core", "locktimeout", fallback=LOCK_TIMEOUT_MS) / 1000
+        self.timeout = timeout
+        self.fd = None
+
+    def acquire(self, required=True):
+        """ Create the lock file, retrying with backoff while another
+        writer holds it.  On timeout, raise, or return False if not
+        required. """
+        deadline = time.monotonic() + self.timeout
+        delay = LOCK_BACKOFF_MIN
+        while True:
+            try:
+                self.fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                return True
+            except FileExistsError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if not required:
+                        return False
+                    raise Exception(f"Unable to create {self.lock_path}: another wyag process seems to be running in this repository.")
+            # Randomized, so that waiting writers don't all retry at
+            # once.
+            time.sleep(min(remaining, delay * random.uniform(0.5, 1.5)))
+            delay = min(delay * 2, LOCK_BACKOFF_MAX)
+
+    def write(self, data):
+        """ Set the new content of the file """
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.ftruncate(self.fd, 0)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def commit(self):
+        """ Move the new content into place, and release the lock """
+        if self.fsync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.lock_path, self.path)
+
+    def rollback(self):
+        """ Release the lock, leaving the file as it was """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            os.unlink(self.lock_path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.rollback()
+
+# Default for core.lockTimeout, in milliseconds
+LOCK_TIMEOUT_MS = 10000
+# Bounds of the wait between attempts to take a lock, in seconds
+LOCK_BACKOFF_MIN = 0.001
+LOCK_BACKOFF_MAX = 0.1
+
 def repo_default_config():
     """ Return a default configuration object """
     settings = configparser.ConfigParser()
@@ -61,8 +205,9 @@ def repo_default_config():
     settings.set("core", "bare", "false")
     return settings
 
-def repo_create(path):
-    """ Create a new repository at path """
+def repo_create(path, ref_format="files"):
+    """ Create a new repository at path.  ref_format is how refs are
+    stored: "files" or "reftable" (see GitRefs). """
     repo = GitRepository(path, True)
 
     if os.path.exists(repo.worktree):
@@ -89,6 +234,10 @@ def repo_create(path):
     # .git/config
     with open(repo_file(repo, "config"), "w") as f:
         config = repo_default_config()
+        if ref_format != "files":
+            config.set("core", "repositoryformatversion", "1")
+            config.add_section("extensions")
+            config.set("extensions", "wyagrefstorage", ref_format)
         config.write(f)
 
     return repo
@@ -1,25 +1,50 @@
+import gc
+import heapq
+import shutil
+import stat
+import struct
+import subprocess
 import sys
+import time
 from math import ceil
+from itertools import islice
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import pwd
 import grp
 from fnmatch import fnmatch
 from GitRepository import *
 from GitObject import *
+from GitPack import pack_list, pack_name_hash, pack_ofs_encode, pack_write
+from GitFsMonitor import *
+from GitEwah import ewah_parse, ewah_serialize
+from GitRefs import *
+from GitBitmap import BITMAP_TYPES, bitmap_positions, bitmap_write, pack_bitmap
+from GitCommitGraph import *
+from GitOidIndex import oid_abbrev
+from GitMultiPackIndex import midx_write
 
 def cmd_init(args):
     """ Create a new repository """
-    repo_create(args.path)
+    repo_create(args.path, args.ref_format)
 
 def cmd_cat_file(args):
     """ Provide content of repository objects """
     repo = repo_find()
-    cat_file(repo, args.object, fmt=args.type.encode())
+    if args.show_type or args.show_size:
+        fmt, size = object_info(repo, object_find(repo, args.object))
+        print(fmt.decode("ascii") if args.show_type else size)
+    elif args.type:
+        cat_file(repo, args.object, fmt=args.type.encode())
+    else:
+        raise Exception("cat-file needs a type, or one of -t and -s")
 
 def cat_file(repo, obj, fmt=None):
     """ Provide content of repository objects """
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    # Copy through a reader, so that huge blobs never sit in memory.
+    with object_open(repo, object_find(repo, obj, fmt=fmt)) as reader:
+        shutil.copyfileobj(reader, sys.stdout.buffer, OBJECT_CHUNK_SIZE)
     
 def cmd_hash_object(args):
     """ Compute object ID and optionally creates a blob from a file """
@@ -35,11 +60,89 @@ def cmd_hash_object(args):
 def cmd_log(args):
     """ Display history of a given commit """
     repo = repo_find()
-    print("digraph wyaglog{")
-    print("    node [shape=rect];")
-    
-    log_graphviz(repo, object_find(repo, args.commit), set())
-    
+    graph = commit_graph(repo)
+
+    start = commit_node(repo, graph, object_find(repo, args.commit, b"commit"))
+    since = date_parse(args.since) if args.since else None
+    until = date_parse(args.until) if args.until else None
+    walk = commit_walk_topo if args.topo_order else commit_walk
+    nodes = walk(repo, graph, [ start ], since, until)
+
+    # Limited to paths, list the commits that changed them.
+    paths = list()
+    for arg in args.path:
+        path = os.path.relpath(os.path.abspath(arg), repo.worktree)
+        if path == os.pardir or path.startswith(os.pardir + os.sep):
+            raise Exception(f"Path outside of the worktree: {arg}")
+        if path == os.curdir:
+            path = ""
+        else:
+            path = path.replace(os.sep, "/")
+            # As with git, a trailing slash only matches directories.
+            if arg.endswith(("/", os.sep)):
+                path += "/"
+        paths.append(path)
+    if paths:
+        nodes = log_paths(repo, graph, nodes, paths)
+
+    # Everything is a generator: we only walk as far as we print.
+    if args.max_count is not None:
+        nodes = islice(nodes, max(0, args.max_count))
+
+    try:
+        if args.oneline or paths:
+            for node in nodes:
+                sha = commit_node_sha(graph, node)
+                print(oid_abbrev(repo, sha) if args.oneline else sha, commit_subject(object_read(repo, sha)))
+        else:
+            log_graphviz(repo, graph, nodes)
+    except BrokenPipeError:
+        # Output piped to a pager or head, which stopped reading.  Don't
+        # complain, and don't let Python complain at exit either.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+def cmd_rev_list(args):
+    repo = repo_find()
+    include = list()
+    exclude = list()
+    # With --objects, tags are listed too: don't peel them.
+    fmt = None if args.objects else b"commit"
+    for name in args.commit:
+        if name.startswith("^"):
+            exclude.append(object_find(repo, name[1:], fmt))
+        else:
+            include.append(object_find(repo, name, fmt))
+
+    if args.count:
+        print(rev_list_count(repo, include, exclude, args.objects))
+    elif args.objects:
+        for (sha, name) in rev_list_objects(repo, include, exclude):
+            print(f"{sha} {name}" if name else sha)
+    else:
+        for sha in rev_list(repo, include, exclude):
+            print(sha)
+
+def cmd_merge_base(args):
+    repo = repo_find()
+    bases = merge_bases(repo,
+                        object_find(repo, args.one, b"commit"),
+                        object_find(repo, args.two, b"commit"))
+    if not bases:
+        sys.exit(1)
+    for sha in (bases if args.all else bases[:1]):
+        print(sha)
+
+def cmd_commit_graph(args):
+    repo = repo_find()
+    count = commit_graph_write(repo, repo_roots(repo), args.changed_paths)
+    print(f"Wrote a commit-graph of {count} commits.")
+
+def cmd_multi_pack_index(args):
+    repo = repo_find()
+    packs = pack_list(repo)
+    count = midx_write(repo, packs)
+    print(f"Wrote a multi-pack-index of {count} objects in {len(packs)} packs.")
+
 def cmd_ls_tree(args):
     """ Pretty-print a tree object """
     repo = repo_find()
@@ -64,13 +167,18 @@ def cmd_checkout(args):
     else:
         os.mkdir(args.path)
         
-    tree_checkout(repo, obj, obj.path.realpath(args.path))
+    tree_checkout(repo, obj, os.path.realpath(args.path))
 
 def cmd_show_ref(args):
     repo = repo_find()
     refs = ref_list(repo)
     show_ref(repo, refs, prefix="refs")
     
+def cmd_pack_refs(args):
+    repo = repo_find()
+    count = refs_pack(repo, args.all, lambda sha: tag_peel(repo, sha))
+    print(f"Packed {count} refs.")
+
 def cmd_tag(args):
     repo = repo_find()
     if args.name:
@@ -80,7 +188,7 @@ def cmd_tag(args):
                    create_tag_object=args.create_tag_object)
     else:
         refs = ref_list(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        show_ref(repo, refs.get("tags", dict()), with_hash=False)
 
 def cmd_rev_parse(args):
     if args.type:
@@ -113,19 +221,15 @@ def cmd_ls_files(args):
 
 def cmd_check_ignore(args):
     repo = repo_find()
-    rules = gitignore_read(repo)
-    for path in args.path:
-        if check_ignore(rules, path):
-            print(path)
+    with GitSession(repo, lock=False) as session:
+        for path in args.path:
+            if session.check_ignore(path):
+                print(path)
 
 def cmd_status(_):
     repo = repo_find()
-    index = index_read(repo)
-
-    cmd_status_branch(repo)
-    cmd_status_head_index(repo, index)
-    print()
-    cmd_status_index_worktree(repo, index)
+    with GitSession(repo, lock=False) as session:
+        session.status()
     
 def cmd_status_branch(repo):
     branch = branch_get_active(repo)
@@ -137,7 +241,8 @@ def cmd_status_branch(repo):
 def cmd_status_head_index(repo, index):
     print("Changes to be committed:")
 
-    head = tree_to_dict(repo, "HEAD")
+    # On an unborn branch, everything in the index is new.
+    head = tree_to_dict(repo, "HEAD") if ref_resolve(repo, "HEAD") else dict()
     for entry in index.entries:
         if entry.name in head:
             if head[entry.name] != entry.sha:
@@ -151,62 +256,191 @@ def cmd_status_head_index(repo, index):
     for entry in head.keys():
         print("  deleted: ", entry)
     
-def cmd_status_index_worktree(repo, index):
+def cmd_status_index_worktree(repo, index, ignore, index_mtime):
+    """ Print the differences between the index and the worktree.
+    Entries whose stat data was found stale, but whose content didn't
+    change, are refreshed in index: return True if there were any. """
     print("Changes not staged for commit:")
 
-    ignore = gitignore_read(repo)
+    # Directories holding at least one tracked file.  Every other
+    # directory is entirely untracked.
+    tracked_dirs = set()
+    for entry in index.entries:
+        parent = os.path.dirname(entry.name)
+        while parent and parent not in tracked_dirs:
+            tracked_dirs.add(parent)
+            parent = os.path.dirname(parent)
+
+    # If an fsmonitor daemon runs, it tells us which paths may have
+    # changed, and we only look at those.  Otherwise we list the whole
+    # worktree.
+    ignore_stat = fsmonitor_ignore_stat(repo)
+    token, changed = fsmonitor_query(repo)
+    if changed is None:
+        files = worktree_list(repo, tracked_dirs, ignore)
+        entries = list(enumerate(index.entries))
+    else:
+        files, entries = worktree_list_changed(repo, index, changed, tracked_dirs, ignore)
+
+    # Both sides sorted the same way (by path bytes, as git does), so
+    # we can compare them in a single merge pass.  Entries are kept
+    # with their position in the index.
+    entries.sort(key=lambda e: e[1].name.encode("utf8"))
+
+    refreshed = False
+    untracked = list()
+    # Paths that aren't clean, for the fsmonitor state.
+    dirty = list()
+
+    # Match entries and worktree files.  Entries found on both sides
+    # are kept aside, to compare their stat data in one batch.
+    matched = list()
+    both = list()
+    i = 0
+    j = 0
+    while i < len(entries) or j < len(files):
+        position, entry = entries[i] if i < len(entries) else (None, None)
+        name, st = files[j] if j < len(files) else (None, None)
+
+        if name is None or (entry and entry.name.encode("utf8") < name.encode("utf8")):
+            # In the index, not in the worktree.
+            matched.append((position, entry, None, None))
+            i += 1
+        elif entry is None or name.encode("utf8") < entry.name.encode("utf8"):
+            # In the worktree, not in the index.
+            matched.append((None, None, name, st))
+            j += 1
+        else:
+            matched.append((position, entry, name, st))
+            both.append((position, st))
+            i += 1
+            j += 1
 
-    gitdir_prefix = repo.gitdir + os.path.sep
+    # If all the stat data matches, a file hasn't changed and we don't
+    # need to read it --- unless the entry is racy.
+    unclean = iter(index_entries_unclean(index, both, index_mtime))
 
-    all_files = list()
+    for (position, entry, name, st) in matched:
+        if name is None:
+            print("  deleted: ", entry.name)
+            dirty.append(entry.name)
+        elif entry is None:
+            if not check_ignore(ignore, name.rstrip("/")):
+                untracked.append(name)
+                dirty.append(name.rstrip("/"))
+        elif next(unclean):
+            # Deep compare.
+            full_path = os.path.join(repo.worktree, name)
+            if entry.sha != worktree_file_hash(full_path, st):
+                print("  modified:", entry.name)
+                dirty.append(entry.name)
+            else:
+                # Same content: cache the new stat data, so that
+                # next time we don't have to read the file.
+                index.entries[position] = index_entry_refresh(entry, st)
+                refreshed = True
 
-    # We begin by walking the filesystem
-    for (root, _, files) in os.walk(repo.worktree, True):
-        if root==repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+    if refreshed:
+        # The raw file content has stale stat data now.
+        index.raw = index.offsets = None
 
-    # We now traverse the index, and compare real files with the cached
-    # versions.
+    if token:
+        fsmonitor_state_write(repo, token, dirty, ignore_stat)
 
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
+    print()
+    print("Untracked files:")
 
-        # That file *name* is in the index
+    for f in untracked:
+        print(" ", f)
 
-        if not os.path.exists(full_path):
-            print("  deleted: ", entry.name)
-        else:
-            stat = os.stat(full_path)
+    return refreshed
 
-            # Compare metadata
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
-                # If different, deep compare.
-                # @FIXME This *will* crash on symlinks to dir.
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    # If the hashes are the same, the files are actually the same.
-                    same = entry.sha == new_sha
+def worktree_list_changed(repo, index, changed, tracked_dirs, ignore):
+    """ Like worktree_list, restricted to the paths in changed, as
+    reported by fsmonitor.  Return (files, entries): the worktree files
+    and the index entries to compare, as (position in the index, entry)
+    pairs. """
+    files = dict()
 
-                    if not same:
-                        print("  modified:", entry.name)
+    # Index entries at a changed path, or below a changed directory.
+    entries = list()
+    for (position, entry) in enumerate(index.entries):
+        path = entry.name
+        while path and path not in changed:
+            path = os.path.dirname(path)
+        if path:
+            entries.append((position, entry))
+
+    for path in set(changed) | set(e.name for (_, e) in entries):
+        # Paths inside an untracked directory are reported as that
+        # directory.
+        top = None
+        parent = os.path.dirname(path)
+        while parent:
+            if parent not in tracked_dirs:
+                top = parent
+            parent = os.path.dirname(parent)
+        if top:
+            if not top + "/" in files and not check_ignore(ignore, top) \
+               and worktree_dir_has_untracked(repo, top, ignore):
+                files[top + "/"] = None
+            continue
 
-        if entry.name in all_files:
-            all_files.remove(entry.name)
+        try:
+            st = os.lstat(os.path.join(repo.worktree, path))
+        except FileNotFoundError:
+            continue
 
-    print()
-    print("Untracked files:")
+        if stat.S_ISDIR(st.st_mode):
+            # Changed files in tracked directories are reported one by
+            # one; new directories are collapsed.
+            if path not in tracked_dirs and not check_ignore(ignore, path) \
+               and worktree_dir_has_untracked(repo, path, ignore):
+                files[path + "/"] = None
+        else:
+            files[path] = st
+
+    files = sorted(files.items(), key=lambda f: f[0].encode("utf8"))
+    return files, entries
 
-    for f in all_files:
-        # @TODO If a full directory is untracked, we should display
-        # its name without its contents.
-        if not check_ignore(ignore, f):
-            print(" ", f)
+def worktree_list(repo, tracked_dirs, ignore):
+    """ List the worktree, as a list of (relative path, lstat) sorted
+    by path bytes.
+
+    Directories not in tracked_dirs aren't descended into: they're
+    listed once, as "dir/" with no stat, if they hold anything that
+    isn't ignored. """
+    ret = list()
+    todo = [ "" ]
+    while todo:
+        rel = todo.pop()
+        with os.scandir(os.path.join(repo.worktree, rel)) as it:
+            for de in it:
+                path = os.path.join(rel, de.name)
+                if de.is_dir(follow_symlinks=False):
+                    if de.path == repo.gitdir:
+                        continue
+                    if path in tracked_dirs:
+                        todo.append(path)
+                    elif not check_ignore(ignore, path) \
+                         and worktree_dir_has_untracked(repo, path, ignore):
+                        ret.append((path + "/", None))
+                else:
+                    ret.append((path, de.stat(follow_symlinks=False)))
+
+    ret.sort(key=lambda f: f[0].encode("utf8"))
+    return ret
+
+def worktree_dir_has_untracked(repo, rel, ignore):
+    """ Return True if the untracked directory rel holds at least one
+    file that isn't ignored.  Stops at the first one. """
+    for (root, dirs, files) in os.walk(os.path.join(repo.worktree, rel)):
+        root_rel = os.path.relpath(root, repo.worktree)
+        for f in files:
+            if not check_ignore(ignore, os.path.join(root_rel, f)):
+                return True
+        dirs[:] = [ d for d in dirs if not check_ignore(ignore, os.path.join(root_rel, d)) ]
+    return False
 
 def cmd_rm(args):
     repo = repo_find()
@@ -214,78 +448,145 @@ def cmd_rm(args):
     
 def cmd_add(args):
     repo = repo_find()
-    add(repo, args.path)
+    add(repo, args.path, jobs=args.jobs)
     
 def cmd_commit(args):
     repo = repo_find()
-    index = index_read(repo)
-    # Create trees, grab back SHA for the root tree.
-    tree = tree_from_index(repo, index)
-
-    # Create the commit object itself
-    commit = commit_create(repo,
-                           tree,
-                           object_find(repo, "HEAD"),
-                           gitconfig_user_get(gitconfig_read()),
-                           datetime.now(),
-                           args.message)
-
-    # Update HEAD so our commit is now the tip of the active branch.
-    active_branch = branch_get_active(repo)
-    if active_branch: # If we're on a branch, we update refs/heads/BRANCH
-        with open(repo_file(repo, os.path.join("refs/heads", active_branch)), "w") as fd:
-            fd.write(commit + "\n")
-    else: # Otherwise, we update HEAD itself.
-        with open(repo_file(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
-            
+    with GitSession(repo) as session:
+        session.commit(args.message)
+
+def cmd_fsmonitor(args):
+    repo = repo_find()
+    match args.action:
+        case "run":
+            fsmonitor_run(repo)
+        case "start":
+            if fsmonitor_request(repo, { "command": "status" }):
+                print("fsmonitor daemon is already running.")
+                return
+            wyag = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wyag")
+            subprocess.Popen([ sys.executable, wyag, "fsmonitor", "run" ],
+                             cwd=repo.worktree,
+                             start_new_session=True,
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL)
+            # Wait for it to answer.
+            for _ in range(50):
+                if fsmonitor_request(repo, { "command": "status" }):
+                    break
+                time.sleep(0.1)
+            else:
+                raise Exception("fsmonitor daemon failed to start")
+            print("fsmonitor daemon started.")
+            if not fsmonitor_enabled(repo):
+                print("hint: set core.fsmonitor to true for status and add to use it.")
+        case "stop":
+            if fsmonitor_request(repo, { "command": "stop" }):
+                print("fsmonitor daemon stopped.")
+            else:
+                print("fsmonitor daemon is not running.")
+        case "status":
+            reply = fsmonitor_request(repo, { "command": "status" })
+            if reply:
+                print(f"fsmonitor daemon is watching {repo.worktree} (pid {reply['pid']}, {reply['backend']} backend, {reply['paths']} changed paths)")
+            else:
+                print("fsmonitor daemon is not running.")
+
+def cmd_repack(args):
+    repo = repo_find()
+
+    window = args.window
+    if window is None:
+        window = repo.conf.getint("pack", "window", fallback=10)
+    depth = args.depth
+    if depth is None:
+        depth = repo.conf.getint("pack", "depth", fallback=50)
+
+    repack(repo, window, depth)
+
 # ------------------ Helpers ------------------
 
-def log_graphviz(repo, sha, seen):
-    """ Generate a graphviz file for the commit history """
-    if sha in seen:
-        return
-    seen.add(sha)
-    
-    commit = object_read(repo, sha)
-    message = commit.kvlm[None].decode('utf-8').strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace("\"", "\\\"")
-    if "\n" in message:
-        message = message[:message.index("\n")]
-    
-    print(f'    c_"{sha}" [label="{sha}: {message}"];')
-    assert commit.fmt==b'commit'
-    if not b'parent' in commit.kvlm.keys:
-        # Base case: the initial commit
-        return
-    
-    parents = commit.kvlm[b'parent']
-    
-    if type(parents) != list:
-        parents = [ parents ]
-        
-    for p in parents:
-        p = p.decode('ascii')
-        print(f'    c_{sha} -> c_{p};')
-        log_graphviz(repo, p, seen)
-        
+def log_graphviz(repo, graph, nodes):
+    """ Print a graphviz file for the commits in nodes, as they come """
+    print("digraph wyaglog{")
+    print("    node [shape=rect];")
+
+    for node in nodes:
+        sha = commit_node_sha(graph, node)
+        message = commit_subject(object_read(repo, sha))
+        message = message.replace("\\", "\\\\")
+        message = message.replace("\"", "\\\"")
+        print(f'    c_{sha} [label="{sha}: {message}"];')
+
+        parents, _, _ = commit_node_info(repo, graph, node)
+        for p in parents:
+            print(f'    c_{sha} -> c_{commit_node_sha(graph, p)};')
+
+    print("}")
+
+def log_paths(repo, graph, nodes, paths):
+    """ Yield the commits of nodes (walk nodes, see GitCommitGraph) that
+    changed one of paths (files or directories).
+
+    A commit changed a path if it differs from one of its parents',
+    as with git log --full-history.  Changed-path Bloom filters tell
+    which commits definitely didn't change anything compared to their
+    first parent: for most commits, that's enough to skip them without
+    reading a tree. """
+    keys = None
+    if graph is not None and graph.bloom_index is not None and all(paths):
+        keys = [ bloom_path_keys(path.rstrip("/"), graph.bloom_hashes) for path in paths ]
+
+    for node in nodes:
+        parents, _, _ = commit_node_info(repo, graph, node)
+
+        same_as_first = False
+        if keys and type(node) == int:
+            data = graph.bloom(node)
+            same_as_first = data is not None and not any(
+                all(bloom_contains(data, k) for k in path_keys) for path_keys in keys)
+        if same_as_first and len(parents) == 1:
+            continue
+
+        tree = commit_node_tree(repo, graph, node)
+        entries = [ tree_path_entry(repo, tree, path) for path in paths ]
+        if not parents:
+            changed = any(e is not None for e in entries)
+        else:
+            changed = False
+            for (i, p) in enumerate(parents):
+                if i == 0 and same_as_first:
+                    continue
+                parent_tree = commit_node_tree(repo, graph, p)
+                if [ tree_path_entry(repo, parent_tree, path) for path in paths ] != entries:
+                    changed = True
+                    break
+        if changed:
+            yield node
+
+def commit_subject(commit):
+    """ Return the first line of commit's message """
+    message = commit.kvlm[None].decode("utf8").strip()
+    return message.split("\n", 1)[0]
+
 def tree_checkout(repo, tree, path):
-    for item in tree.items():
-        obj = object_read(repo, item.sha)
+    for item in tree.items:
         dest = os.path.join(path, item.path)
-        if obj.fmt == b'tree':
+        # The mode tells us the type, no need to read the object.
+        if item.mode.startswith(b'04'):
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
+            tree_checkout(repo, object_read(repo, item.sha), dest)
+        elif item.mode.startswith(b'10') or item.mode.startswith(b'12'):
             # @TODO: Support symlinks (mode 12)
-            with open(dest, "wb") as f:
-                f.write(obj.blobdata)        
+            # Copy in bounded chunks: blobs may be larger than memory.
+            with object_open(repo, item.sha) as reader, open(dest, "wb") as f:
+                shutil.copyfileobj(reader, f, OBJECT_CHUNK_SIZE)
 
 def ls_tree(repo, ref, recursive = None, prefix=""):
     sha = object_find(repo, ref, fmt=b'tree')
     obj = object_read(repo, sha)
-    for item in obj.items():
+    for item in obj.items:
         if len(item.mode) == 5:
             type = item.mode[0:1]
         else:
@@ -303,36 +604,6 @@ def ls_tree(repo, ref, recursive = None, prefix=""):
             ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
             
 
-def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
-    
-    if not os.path.isfile(path):
-        return None
-    
-    with open(path, "r") as fp:
-        data = fp.read()[::-1]
-        # Drop the final \n
-        
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
-    
-def ref_list(repo, path=None):
-    if not path:
-        path = repo_dir(repo, "refs")
-    ret = dict()
-    
-    # Git shows refs sorted. To do the same, we sort the output of listdir
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.islink(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
-            
-    return ret
-
 def show_ref(repo, refs, with_hash = True, prefix=""):
     if prefix:
         prefix += "/"
@@ -363,13 +634,32 @@ def tag_create(repo, name, ref, create_tag_object=False):
         ref_create(repo, "tags/" + name, tag_sha)
     else:
         # Create a lightweight tag
-        ref_create(repo, "tags/" + name, tag_sha)
+        ref_create(repo, "tags/" + name, sha)
         
 def ref_create(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), "w") as fp:
-        fp.write(sha + "\n")
-        
-def index_read(repo):
+    ref_update(repo, "refs/" + ref_name, sha)
+
+def tag_peel(repo, sha):
+    """ Return what tag sha points to, following tags, or None if sha
+    isn't a tag. """
+    fmt, _ = object_info(repo, sha)
+    if fmt != b'tag':
+        return None
+    while fmt == b'tag':
+        sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+        fmt, _ = object_info(repo, sha)
+    return sha
+
+# The fixed part of an index entry: ctime and mtime (seconds and
+# nanoseconds), dev, ino, mode, uid, gid and size, all on 32 bits, then
+# the binary SHA and 16 bits of flags.
+INDEX_ENTRY = struct.Struct(">10L20sH")
+# The NULs after a name, by entry length modulo 8
+INDEX_PADDING = [ bytes(8 - i) for i in range(8) ]
+
+def index_read(repo, keep_raw=False):
+    """ Read the index.  With keep_raw, the file content and the
+    offsets of the entries stay attached to it, for index_columns(). """
     index_file = repo_file(repo, "index")
     
     # New repos have no index
@@ -378,68 +668,144 @@ def index_read(repo):
     
     with open(index_file, 'rb') as f:
         raw = f.read()
-        
+
+    index, link = index_parse(raw, keep_raw)
+
+    # A split index only holds the changes to a shared index, which
+    # we merge in.
+    if link is not None:
+        shared_sha, delete, replace = link
+        if shared_sha != "0" * 40:
+            with open(repo_file(repo, "sharedindex." + shared_sha), 'rb') as f:
+                shared, _ = index_parse(f.read())
+            index_split_merge(index, shared, delete, replace)
+
+    return index
+
+def index_parse(raw, keep_raw=False):
+    """ Parse raw, the content of an index file.  Return (the GitIndex,
+    the content of its link extension or None).  The link extension is
+    (shared index SHA, positions deleted, positions replaced). """
     header = raw[:12]
     signature = header[:4]
     assert signature == b"DIRC" # stands for DirCache
     version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "wyag only supports index file version 2"
+    assert version in (2, 3, 4), "wyag only supports index file versions 2 to 4"
     count = int.from_bytes(header[8:12], "big")
+
+    # The last 20 bytes are the SHA-1 of everything before them (or
+    # zeros, if git was told to skip it).  Indexes written by older
+    # versions of wyag had no checksum, nor extensions.
+    checksum = raw[-20:]
+    checksummed = checksum == bytes(20) or checksum == hashlib.sha1(raw[:-20]).digest()
     
+    # Parsing allocates a lot of objects, none of which can be part
+    # of a reference cycle: the cycle collector would spend most of
+    # the time scanning them over and over.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        entries, offsets, idx = index_read_entries(raw, version, count)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    if not checksummed and idx != len(raw):
+        raise Exception("Index file is corrupt: bad checksum")
+
+    # Extensions follow the entries, up to the trailing checksum.
+    # Each is a 4-byte signature, a 4-byte size, then its data.
+    cache_tree = None
+    link = None
+    while idx < len(raw) - 20:
+        signature = raw[idx:idx+4]
+        size = int.from_bytes(raw[idx+4:idx+8], "big")
+        data = raw[idx+8:idx+8+size]
+        idx += 8 + size
+
+        if signature == b"TREE":
+            cache_tree = cache_tree_parse(data)
+        elif signature == b"link":
+            # Split index: the shared index SHA, then two bitmaps.
+            delete, _, pos = ewah_parse(data, 20)
+            replace, _, _ = ewah_parse(data, pos)
+            link = (data[:20].hex(), delete, replace)
+        elif not 0x41 <= signature[0] <= 0x5A:
+            # Extensions whose signature starts with an uppercase
+            # letter are optional, and can be dropped.  The others
+            # can't.
+            raise Exception(f"Unsupported index extension: {signature}")
+
+    index = GitIndex(version=version, entries=entries, cache_tree=cache_tree)
+    index.sha = checksum.hex() if checksummed else None
+    if keep_raw:
+        index.raw = raw
+        index.offsets = offsets
+    return index, link
+
+def index_split_merge(index, shared, delete, replace):
+    """ Rebuild the entries of index, a split index, from those of its
+    shared index.  The entries at positions in replace are replaced, in
+    order, by the first entries of index; those at positions in delete
+    are dropped; the remaining entries of index are added. """
+    changes = index.entries
+    entries = list(shared.entries)
+
+    for (k, pos) in enumerate(replace):
+        entry = changes[k]
+        # Replacements are stored without their name.
+        if not entry.name:
+            entry.name = shared.entries[pos].name
+        entries[pos] = entry
+
+    if delete:
+        deleted = set(delete)
+        entries = [ e for (i, e) in enumerate(entries) if i not in deleted ]
+
+    added = changes[len(replace):]
+    if added:
+        entries += added
+        entries.sort(key=lambda e: e.name.encode("utf8"))
+
+    index.entries = entries
+    index.shared = shared
+    # The raw content is the split index's, which doesn't match the
+    # entries any more.
+    index.raw = None
+    index.offsets = None
+
+def index_read_entries(raw, version, count):
+    """ Parse the count entries of raw, the content of an index file.
+    Return (entries, their offsets, offset of what follows them). """
     entries = list()
-    
-    content = raw[12:]
-    idx = 0
+    append = entries.append
+    offsets = array("Q")
+    unpack = INDEX_ENTRY.unpack_from
+
+    idx = 12
+    # Version 4 names are relative to the previous one
+    previous_name = b""
     for i in range(0, count):
-        # read creation time, Unix timestamp 
-        # (seconds since 1970-01-01 00:00:00, the "epoch")
-        ctime_s = int.from_bytes(content[idx:idx+4], "big")
+        start = idx
+        offsets.append(start)
 
-        # read creation time, as nano seconds after that timestamp for precision
-        ctime_ns = int.from_bytes(content[idx+4:idx+8], "big")
-        
-        # Same for modification time 
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        
-        # Then extra nanoseconds
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        
-        # Device ID
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        
-        # Inode
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        
-        # Ignored.
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
-        assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
+        # The fixed part of the entry.  Times are (seconds since the
+        # epoch, extra nanoseconds).  The SHA is stored as a lowercase
+        # hex string for consistency.
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode,
+         uid, gid, fsize, sha, flags) = unpack(raw, idx)
+        idx += INDEX_ENTRY.size
+
+        # The top 16 bits of the mode are unused, and must be zero.
         mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
+        assert mode_type in (0b1000, 0b1010, 0b1110)
         mode_perms = mode & 0b0000000111111111
-        
-        # User ID
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        
-        # Group ID
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        
-        # Size
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-        
-        # SHA (object ID).  We'll store it as a lowercase hex string
-        # for consistency.
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-        
-        # Flags we're going to ignore
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
-        
+
         # Parse flags
         flag_assume_valid = (flags & 0b1000000000000000) != 0
         flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
         flag_stage =  flags & 0b0011000000000000
-        
+
         # Length of the name.  This is stored on 12 bits, some max
         # value is 0xFFF, 4095.  Since names can occasionally go
         # beyond that length, git treats 0xFFF as meaning at least
@@ -448,106 +814,317 @@ def index_read(repo):
         # cost.
         name_length = flags & 0b0000111111111111
 
-        # We've read 62 bytes so far.
-        idx += 62
-
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx:idx+name_length]
-            idx += name_length + 1
-        else:
-            print(f"Notice: Name is 0x{name_length:X} bytes long.")
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
+        # Version 3 adds a second flags field to extended entries.
+        flag_skip_worktree = False
+        flag_intent_to_add = False
+        if flag_extended:
+            assert version >= 3, "Extended entry flags need index version 3"
+            extended = int.from_bytes(raw[idx:idx+2], "big")
+            flag_skip_worktree = (extended & 0b0100000000000000) != 0
+            flag_intent_to_add = (extended & 0b0010000000000000) != 0
+            idx += 2
+
+        if version == 4:
+            # Names are prefix-compressed: a varint tells how many
+            # bytes to strip from the end of the previous name, then
+            # comes the NUL-terminated suffix to append.  Same varint
+            # as pack OFS_DELTA offsets.
+            c = raw[idx]
+            idx += 1
+            strip = c & 0x7f
+            while c & 0x80:
+                c = raw[idx]
+                idx += 1
+                strip = ((strip + 1) << 7) | (c & 0x7f)
+            null_idx = raw.index(b'\x00', idx)
+            raw_name = previous_name[:len(previous_name) - strip] + raw[idx:null_idx]
+            previous_name = raw_name
+            name = raw_name.decode("utf8")
             idx = null_idx + 1
+        else:
+            if name_length < 0xFFF:
+                null_idx = idx + name_length
+                assert raw[null_idx] == 0x00
+            else:
+                null_idx = raw.index(b'\x00', idx + 0xFFF)
+            name = raw[idx:null_idx].decode("utf8")
 
-        # Just parse the name as utf8.
-        name = raw_name.decode("utf8")
-
-        # Data is padded on multiples of eight bytes for pointer
-        # alignment, so we skip as many bytes as we need for the next
-        # read to start at the right position.
-
-        idx = 8 * ceil(idx / 8)
+            # Data is padded on multiples of eight bytes for pointer
+            # alignment (with at least one NUL), so we skip as many
+            # bytes as we need for the next read to start at the
+            # right position.
+            idx = start + ((null_idx - start + 8) & ~7)
 
         # And we add this entry to our list.
-        entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s,  mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
-
-    return GitIndex(version=version, entries=entries)
-
-def index_write(repo, index):
-    with open(repo_file(repo, "index"), "wb") as f:
-
-        # HEADER
-
-        # Write the magic bytes.
-        f.write(b"DIRC")
-        # Write version number.
-        f.write(index.version.to_bytes(4, "big"))
-        # Write the number of entries.
-        f.write(len(index.entries).to_bytes(4, "big"))
-
-        # ENTRIES
-
-        idx = 0
+        append(GitIndexEntry((ctime_s, ctime_ns), (mtime_s, mtime_ns),
+                             dev, ino, mode_type, mode_perms,
+                             uid, gid, fsize, sha.hex(),
+                             flag_assume_valid, flag_stage, name,
+                             flag_skip_worktree, flag_intent_to_add))
+
+    return entries, offsets, idx
+
+def cache_tree_parse(data):
+    """ Parse the data of the TREE index extension, and return the
+    root GitCacheTree.
+
+    Each node is its path component, NUL, its entry count and number
+    of subtrees in ASCII, a newline, then its tree SHA unless it's
+    invalid (count of -1).  Subtrees follow their parent. """
+    root = None
+    # Stack of (node, number of subtrees still to read)
+    stack = list()
+    pos = 0
+    while pos < len(data):
+        nul = data.index(b'\x00', pos)
+        name = data[pos:nul].decode("utf8")
+        eol = data.index(b'\n', nul)
+        count, subtrees = data[nul+1:eol].split(b' ')
+        pos = eol + 1
+
+        node = GitCacheTree(entry_count=int(count))
+        if node.entry_count >= 0:
+            node.sha = data[pos:pos+20].hex()
+            pos += 20
+
+        if stack:
+            parent = stack[-1]
+            parent[0].subtrees[name] = node
+            parent[1] -= 1
+        else:
+            root = node
+
+        stack.append([node, int(subtrees)])
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+
+    return root
+
+def cache_tree_serialize(node, name=""):
+    ret = name.encode("utf8") + b'\x00'
+    ret += f"{node.entry_count} {len(node.subtrees)}\n".encode("ascii")
+    if node.entry_count >= 0:
+        ret += bytes.fromhex(node.sha)
+    # Git orders subtrees by name length, then by name.
+    for sub in sorted(node.subtrees, key=lambda n: (len(n.encode("utf8")), n.encode("utf8"))):
+        ret += cache_tree_serialize(node.subtrees[sub], sub)
+    return ret
+
+def cache_tree_invalidate(index, path):
+    """ Invalidate the cache tree nodes of every directory containing
+    path, a file whose index entry is being added or removed. """
+    node = index.cache_tree
+    if node is None:
+        return
+    node.entry_count = -1
+    for component in path.split("/")[:-1]:
+        node = node.subtrees.get(component)
+        if node is None:
+            return
+        node.entry_count = -1
+
+def index_lock(repo):
+    """ Return a GitLock on the index.  Take it before reading the
+    index to update, and pass it to index_write. """
+    return GitLock(repo, "index", component="index")
+
+def index_write(repo, index, lock=None):
+    """ Write index.  lock is the index lock the caller took before
+    reading the index, which this commits; without one, the index is
+    only locked while it's written. """
+    # index.version in the configuration picks the format to write.
+    # Version 4 compresses paths, which makes the index much smaller
+    # on large trees.  Extended flags need at least version 3.
+    version = index.version
+    if repo.conf.has_option("index", "version"):
+        version = int(repo.conf.get("index", "version"))
+    if version == 2 and any(e.flag_skip_worktree or e.flag_intent_to_add for e in index.entries):
+        version = 3
+    if not version in (2, 3, 4):
+        raise Exception(f"Unsupported index version: {version}")
+    index.version = version
+
+    if repo.conf.getboolean("core", "splitindex", fallback=False):
+        out = index_serialize_split(repo, index, version)
+    else:
+        index.shared = None
+        out = index_serialize(version, index.entries, index.cache_tree)
+
+    if lock is None:
+        lock = index_lock(repo)
+        lock.acquire()
+    try:
+        lock.write(out)
+        lock.commit()
+    except BaseException:
+        lock.rollback()
+        raise
+
+    # Our own index writes don't invalidate what fsmonitor knows.
+    fsmonitor_index_written(repo)
+
+def index_serialize(version, entries, cache_tree=None, link=None, shared_count=0, replaced=0):
+    """ Return the content of an index file holding entries.  For a
+    split index, link is (shared index SHA, positions deleted,
+    positions replaced) in the shared index of shared_count entries,
+    and the first replaced entries are the replacements. """
+    # The index ends with the SHA-1 of its content, so we build it in
+    # memory, to be written all at once.
+    out = bytearray()
+
+    # HEADER
+
+    # The magic bytes, the version number and the number of entries.
+    out += b"DIRC"
+    out += version.to_bytes(4, "big")
+    out += len(entries).to_bytes(4, "big")
+
+    # ENTRIES
+
+    pack = INDEX_ENTRY.pack
+    previous_name = b""
+    for (i, e) in enumerate(entries):
+        # Split index replacements are stored without their name.
+        name_bytes = e.name.encode("utf8") if i >= replaced else b""
+        name_length = len(name_bytes)
+        if name_length > 0xFFF:
+            name_length = 0xFFF
+
+        extended = 0
+        if e.flag_skip_worktree:
+            extended |= 0x1 << 14
+        if e.flag_intent_to_add:
+            extended |= 0x1 << 13
+
+        # We merge back four pieces of data (three flags and the
+        # length of the name) on the same two bytes.
+        flags = e.flag_stage | name_length
+        if e.flag_assume_valid:
+            flags |= 0x1 << 15
+        if extended:
+            flags |= 0x1 << 14
+
+        out += pack(e.ctime[0], e.ctime[1], e.mtime[0], e.mtime[1],
+                    e.dev, e.ino, (e.mode_type << 12) | e.mode_perms,
+                    e.uid, e.gid, e.fsize, bytes.fromhex(e.sha), flags)
+
+        if extended:
+            out += extended.to_bytes(2, "big")
+
+        if version == 4:
+            # Only write what differs from the previous name.
+            common = 0
+            limit = min(len(name_bytes), len(previous_name))
+            while common < limit and name_bytes[common] == previous_name[common]:
+                common += 1
+            out += pack_ofs_encode(len(previous_name) - common)
+            out += name_bytes[common:]
+            out += b'\x00'
+            previous_name = name_bytes
+        else:
+            # Write back the name, then NULs up to the next multiple
+            # of eight bytes: at least one, to terminate the name.
+            out += name_bytes
+            out += INDEX_PADDING[(len(name_bytes) + (64 if extended else 62)) % 8]
+
+    # EXTENSIONS
+
+    if link is not None:
+        shared_sha, delete, replace = link
+        data = bytes.fromhex(shared_sha)
+        data += ewah_serialize(delete, shared_count)
+        data += ewah_serialize(replace, shared_count)
+        out += b"link"
+        out += len(data).to_bytes(4, "big")
+        out += data
+
+    if cache_tree is not None:
+        data = cache_tree_serialize(cache_tree)
+        out += b"TREE"
+        out += len(data).to_bytes(4, "big")
+        out += data
+
+    out += hashlib.sha1(out).digest()
+    return out
+
+def index_serialize_split(repo, index, version):
+    """ Return the content of index as a split index: only the entries
+    that changed since its shared index are stored.  A new shared index
+    is written first if there's none yet, or if more than
+    splitIndex.maxPercentChange percent (20 by default) of its entries
+    changed. """
+    shared = index.shared
+    if shared is not None and os.path.exists(repo_file(repo, "sharedindex." + shared.sha)):
+        # Entries are never changed in place: those of the shared
+        # index that are still in the index are the very same objects.
+        position = { id(e): i for (i, e) in enumerate(shared.entries) }
+        by_name = None
+        kept = bytearray(len(shared.entries))
+        replaced = dict()
+        added = list()
         for e in index.entries:
-            f.write(e.ctime[0].to_bytes(4, "big"))
-            f.write(e.ctime[1].to_bytes(4, "big"))
-            f.write(e.mtime[0].to_bytes(4, "big"))
-            f.write(e.mtime[1].to_bytes(4, "big"))
-            f.write(e.dev.to_bytes(4, "big"))
-            f.write(e.ino.to_bytes(4, "big"))
-
-            # Mode
-            mode = (e.mode_type << 12) | e.mode_perms
-            f.write(mode.to_bytes(4, "big"))
-
-            f.write(e.uid.to_bytes(4, "big"))
-            f.write(e.gid.to_bytes(4, "big"))
-
-            f.write(e.fsize.to_bytes(4, "big"))
-            # @FIXME Convert back to int.
-            f.write(int(e.sha, 16).to_bytes(20, "big"))
-
-            flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
-
-            name_bytes = e.name.encode("utf8")
-            bytes_len = len(name_bytes)
-            if bytes_len >= 0xFFF:
-                name_length = 0xFFF
+            i = position.get(id(e))
+            if i is not None:
+                kept[i] = 1
+                continue
+            if by_name is None:
+                by_name = { s.name: i for (i, s) in enumerate(shared.entries) }
+            i = by_name.get(e.name)
+            if i is None:
+                added.append(e)
             else:
-                name_length = bytes_len
-
-            # We merge back three pieces of data (two flags and the
-            # length of the name) on the same two bytes.
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
-
-            # Write back the name, and a final 0x00.
-            f.write(name_bytes)
-            f.write((0).to_bytes(1, "big"))
-
-            idx += 62 + len(name_bytes) + 1
-
-            # Add padding if necessary.
-            if idx % 8 != 0:
-                pad = 8 - (idx % 8)
-                f.write((0).to_bytes(pad, "big"))
-                idx += pad
+                kept[i] = 1
+                replaced[i] = e
+
+        deleted = list()
+        i = kept.find(0)
+        while i != -1:
+            deleted.append(i)
+            i = kept.find(0, i + 1)
+
+        changed = len(replaced) + len(added) + len(deleted)
+        max_percent = repo.conf.getint("splitIndex", "maxpercentchange", fallback=20)
+        if changed * 100 <= max_percent * len(shared.entries):
+            # Keep the shared index from expiring while we use it.
+            os.utime(repo_file(repo, "sharedindex." + shared.sha))
+            replace = sorted(replaced)
+            return index_serialize(version, [ replaced[i] for i in replace ] + added,
+                                   index.cache_tree, link=(shared.sha, deleted, replace),
+                                   shared_count=len(shared.entries), replaced=len(replace))
+
+    # Write a new shared index, named after its checksum, and point a
+    # split index with no changes at it.
+    data = index_serialize(version, index.entries)
+    sha = data[-20:].hex()
+    with GitLock(repo, "sharedindex." + sha, component="index") as lock:
+        lock.write(data)
+        lock.commit()
+
+    shared = GitIndex(version=version, entries=list(index.entries))
+    shared.sha = sha
+    index.shared = shared
+    index_shared_expire(repo, sha)
+
+    return index_serialize(version, [], index.cache_tree, link=(sha, [], []),
+                           shared_count=len(shared.entries))
+
+# Shared indexes unused for this long are deleted, as git's default
+# splitIndex.sharedIndexExpire.
+SHARED_INDEX_EXPIRE = 14 * 24 * 3600
+
+def index_shared_expire(repo, current):
+    """ Delete the shared indexes other than current that nobody used
+    for SHARED_INDEX_EXPIRE seconds. """
+    now = time.time()
+    for name in os.listdir(repo.gitdir):
+        if not name.startswith("sharedindex.") or name == "sharedindex." + current:
+            continue
+        path = repo_file(repo, name)
+        try:
+            if now - os.stat(path).st_mtime > SHARED_INDEX_EXPIRE:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
 
 def gitignore_parse1(raw):
     raw = raw.strip() # Remove leading/trailing spaces
@@ -571,28 +1148,20 @@ def gitignore_parse(lines):
 
     return ret
 
-def gitignore_read(repo):
+def gitignore_read(repo, index=None):
+    """ Read the ignore rules.  The scoped ones come from the
+    .gitignore files in index, which is read if not given. """
     ret = GitIgnore(absolute=list(), scoped=dict())
 
-    # Read local configuration in .git/info/exclude
-    repo_file = os.path.join(repo.gitdir, "info/exclude")
-    if os.path.exists(repo_file):
-        with open(repo_file, "r") as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
-
-    # Global configuration
-    if "XDG_CONFIG_HOME" in os.environ:
-        config_home = os.environ["XDG_CONFIG_HOME"]
-    else:
-        config_home = os.path.expanduser("~/.config")
-    global_file = os.path.join(config_home, "git/ignore")
-
-    if os.path.exists(global_file):
-        with open(global_file, "r") as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
+    # .git/info/exclude, then the global file
+    for path in repo_exclude_files(repo):
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                ret.absolute.append(gitignore_parse(f.readlines()))
 
     # .gitignore files in the index
-    index = index_read(repo)
+    if index is None:
+        index = index_read(repo)
 
     for entry in index.entries:
         if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
@@ -648,6 +1217,29 @@ def branch_get_active(repo):
     else:
         return False
 
+def tree_path_entry(repo, tree, path):
+    """ Return the (mode, sha) of path in tree (a SHA), or None if it's
+    not there.  Only the trees along path are read.  With a trailing
+    slash, path must be a directory. """
+    if not path:
+        return (b'40000', tree)
+    if path.endswith("/"):
+        entry = tree_path_entry(repo, tree, path[:-1])
+        return entry if entry is not None and entry[0].startswith(b'04') else None
+    entry = None
+    for component in path.split("/"):
+        if entry is not None:
+            if not entry[0].startswith(b'04'):
+                return None
+            tree = entry[1]
+        for leaf in object_read(repo, tree).items:
+            if leaf.path == component:
+                entry = (leaf.mode, leaf.sha)
+                break
+        else:
+            return None
+    return entry
+
 def tree_to_dict(repo, ref, prefix=""):
     ret = dict()
     tree_sha = object_find(repo, ref, fmt=b"tree")
@@ -656,9 +1248,7 @@ def tree_to_dict(repo, ref, prefix=""):
     for leaf in tree.items:
         full_path = os.path.join(prefix, leaf.path)
 
-        # We read the object to extract its type (this is uselessly
-        # expensive: we could just open it as a file and read the
-        # first few bytes)
+        # The mode tells us the type, no need to read the object.
         is_subtree = leaf.mode.startswith(b'04')
 
         # Depending on the type, we either store the path (if it's a
@@ -670,10 +1260,156 @@ def tree_to_dict(repo, ref, prefix=""):
             ret[full_path] = leaf.sha
     return ret
 
-def rm(repo, paths, delete=True, skip_missing=False):
-    # Find and read the index
-    index = index_read(repo)
+class GitSession(object):
+    """ A batch of operations on a repository, sharing one in-memory
+    copy of the index.  The index is read the first time it's needed,
+    and written back once, when the session ends, if anything changed
+    it:
+
+        with GitSession(repo) as session:
+            session.add(["a.txt", "b.txt"])
+            session.rm(["c.txt"])
+            session.commit("Message")
+
+    The session holds the index lock from start to end, so that no
+    other writer's change is lost in between.  If the block raises,
+    the index is left as it was.
+
+    With lock=False, the session is read-only (status, check-ignore).
+    The stat data status refreshes is still written back, like a
+    plain status does, unless someone else wrote the index since. """
+    def __init__(self, repo, lock=True):
+        self.repo = repo
+        self.lock = index_lock(repo) if lock else None
+        self.index = None
+        # The index file's mtime when we read it
+        self.index_mtime = None
+        self.ignore = None
+        # Files rm removed from the index, deleted once it's written
+        self.unlink = list()
+        # Whether the index must be written back: changed by add, rm
+        # or commit, or only stat data refreshed by status.
+        self.changed = False
+        self.refreshed = False
+
+    def __enter__(self):
+        if self.lock:
+            self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.flush()
+        elif self.lock:
+            self.lock.rollback()
+
+    def index_get(self):
+        """ Return the index, reading it the first time """
+        if self.index is None:
+            # The index was read under the lock, or the mtime tells
+            # whether someone wrote it since.
+            self.index_mtime = index_mtime_ns(self.repo)
+            self.index = index_read(self.repo, keep_raw=True)
+        return self.index
+
+    def writable(self):
+        if self.lock is None:
+            raise Exception("Cannot change the index in a read-only session")
+        self.changed = True
+        return self.index_get()
+
+    def ignore_get(self):
+        """ Return the ignore rules, read from the index once """
+        if self.ignore is None:
+            self.ignore = gitignore_read(self.repo, self.index_get())
+        return self.ignore
+
+    def add(self, paths, jobs=None):
+        index_add(self.repo, self.writable(), paths, jobs)
+        # A .gitignore may have been added or changed.
+        self.ignore = None
+
+    def rm(self, paths, delete=True, skip_missing=False):
+        removed = index_rm(self.repo, self.writable(), paths, False, skip_missing)
+        if delete:
+            self.unlink += removed
+        self.ignore = None
+
+    def commit(self, message):
+        """ Commit the index, and return the commit's SHA. """
+        repo = self.repo
+        index = self.writable()
+        # Create trees, grab back SHA for the root tree.  This updates
+        # the cache tree, which is saved with the index.
+        tree = tree_from_index(repo, index)
+
+        # Create the commit object itself
+        parent = object_find(repo, "HEAD")
+        commit = commit_create(repo,
+                               tree,
+                               parent,
+                               gitconfig_user_get(gitconfig_read()),
+                               datetime.now(),
+                               message)
+
+        # Update HEAD so our commit is now the tip of the active
+        # branch.  If another commit got there first, we fail rather
+        # than drop it.
+        active_branch = branch_get_active(repo)
+        if active_branch: # If we're on a branch, we update refs/heads/BRANCH
+            ref_update(repo, "refs/heads/" + active_branch, commit, old=parent or "")
+        else: # Otherwise, we update HEAD itself.
+            ref_update(repo, "HEAD", commit, old=parent or "")
+
+        return commit
+
+    def status(self):
+        repo = self.repo
+        index = self.index_get()
+        cmd_status_branch(repo)
+        cmd_status_head_index(repo, index)
+        print()
+        if cmd_status_index_worktree(repo, index, self.ignore_get(), self.index_mtime):
+            self.refreshed = True
+
+    def check_ignore(self, path):
+        return check_ignore(self.ignore_get(), path)
+
+    def flush(self):
+        """ Write the index back if needed, and release the lock.  This
+        ends the session. """
+        if self.lock:
+            if self.changed or self.refreshed:
+                index_write(self.repo, self.index, self.lock)
+            else:
+                self.lock.rollback()
+            # Like git rm, delete files only once they're out of the
+            # index.
+            for path in self.unlink:
+                if os.path.lexists(path):
+                    os.unlink(path)
+            self.unlink = list()
+        elif self.refreshed:
+            # Like git update-index --refresh.  It's only an
+            # optimization: skip it if another process is writing the
+            # index, or wrote it since we read it.
+            lock = GitLock(self.repo, "index", component="index", timeout=0)
+            if lock.acquire(required=False):
+                if index_mtime_ns(self.repo) == self.index_mtime:
+                    index_write(self.repo, self.index, lock)
+                else:
+                    lock.rollback()
+        self.changed = self.refreshed = False
 
+def rm(repo, paths, delete=True, skip_missing=False):
+    with GitSession(repo) as session:
+        session.rm(paths, delete, skip_missing)
+
+def index_rm(repo, index, paths, delete=True, skip_missing=False, invalidate=True):
+    """ Remove paths from index, and from the worktree if delete.
+    Return the absolute paths of the removed entries.  Unless
+    invalidate is false, the cache tree nodes above them are
+    invalidated. """
     worktree = repo.worktree + os.sep
 
     # Make paths absolute
@@ -700,6 +1436,8 @@ def rm(repo, paths, delete=True, skip_missing=False):
         if full_path in abspaths:
             remove.append(full_path)
             abspaths.remove(full_path)
+            if invalidate:
+                cache_tree_invalidate(index, e.name)
         else:
             kept_entries.append(e) # Preserve entry
 
@@ -712,14 +1450,28 @@ def rm(repo, paths, delete=True, skip_missing=False):
         for path in remove:
             os.unlink(path)
 
-    # Update the list of entries in the index, and write it back.
+    # Update the list of entries in the index.  The raw file content
+    # doesn't match them anymore.
     index.entries = kept_entries
-    index_write(repo, index)
+    index.raw = index.offsets = None
+    return remove
     
-def add(repo, paths, delete=True, skip_missing=False):
+def add(repo, paths, delete=True, skip_missing=False, jobs=None):
+    with GitSession(repo) as session:
+        session.add(paths, jobs)
+
+def index_add(repo, index, paths, jobs=None):
+    """ Add paths to index, storing their content as blobs. """
 
-    # First remove all paths from the index, if they exist.
-    rm (repo, paths, delete=False, skip_missing=True)
+    # Remember the current entries, and how much we can trust them,
+    # before they're removed.
+    old_entries = { e.name: e for e in index.entries }
+    index_mtime = index_mtime_ns(repo)
+    _, changed = fsmonitor_query(repo)
+
+    # First remove all paths from the index, if they exist.  The cache
+    # tree is only invalidated for the entries that end up changing.
+    index_rm(repo, index, paths, delete=False, skip_missing=True, invalidate=False)
 
     worktree = repo.worktree + os.sep
 
@@ -733,32 +1485,161 @@ def add(repo, paths, delete=True, skip_missing=False):
         relpath = os.path.relpath(abspath, repo.worktree)
         clean_paths.add((abspath,  relpath))
 
-    # Find and read the index.  It was modified by rm.  (This isn't
-    # optimal, good enough for wyag!)
-    #
-    # @FIXME, though: we could just move the index through
-    # commands instead of reading and writing it over again.
-    index = index_read(repo)
+    # Files whose entry is still clean needn't be hashed again.
+    # fsmonitor tells us so without even a stat; otherwise we compare
+    # stat data, as status does.
+    to_hash = list()
+    for (abspath, relpath) in sorted(clean_paths):
+        old = old_entries.get(relpath)
+        if old and changed is not None and relpath not in changed:
+            index.entries.append(old)
+            continue
+        if old and not index_entry_is_racy(old, index_mtime) \
+           and index_entry_stat_matches(old, os.lstat(abspath)):
+            index.entries.append(old)
+            continue
+        to_hash.append((abspath, relpath))
+    clean_paths = to_hash
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    if jobs > 1 and len(clean_paths) >= ADD_PARALLEL_MIN:
+        # Hashing and compression are CPU-bound: spread batches of
+        # paths over worker processes.  Small batches keep the workers
+        # balanced when file sizes vary.
+        size = max(1, min(ADD_BATCH_MAX, ceil(len(clean_paths) / (jobs * 4))))
+        batches = [ clean_paths[i:i+size] for i in range(0, len(clean_paths), size) ]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            hashed = list()
+            for result in pool.map(add_hash_batch, [ repo.worktree ] * len(batches), batches):
+                hashed += result
+    else:
+        hashed = add_hash_batch(repo.worktree, clean_paths, repo)
+
+    for (relpath, sha, stat) in hashed:
+        entry = index_entry_from_stat(relpath, sha, stat)
+        index.entries.append(entry)
+        old = old_entries.get(relpath)
+        if old is None or old.sha != entry.sha or old.mode_type != entry.mode_type \
+           or old.mode_perms != entry.mode_perms:
+            cache_tree_invalidate(index, relpath)
+
+    # Keep the index sorted by path, as git expects.
+    index.entries.sort(key=lambda e: e.name.encode("utf8"))
 
-    for (abspath, relpath) in clean_paths:
+# Below this many paths, add doesn't bother starting worker processes.
+ADD_PARALLEL_MIN = 64
+# Maximum number of paths sent to a worker at once.
+ADD_BATCH_MAX = 256
+
+def add_hash_batch(worktree, paths, repo=None):
+    """ Hash and store each of paths, a list of (absolute, relative)
+    pairs, as a blob.  Return a list of (relative path, sha, stat).
+
+    This runs in worker processes, which get the worktree and open the
+    repository themselves. """
+    if repo is None:
+        repo = GitRepository(worktree)
+
+    ret = list()
+    for (abspath, relpath) in paths:
         with open(abspath, "rb") as fd:
             sha = object_hash(fd, b"blob", repo)
+        ret.append((relpath, sha, os.stat(abspath)))
+    return ret
 
-            stat = os.stat(abspath)
-
-            ctime_s = int(stat.st_ctime)
-            ctime_ns = stat.st_ctime_ns % 10**9
-            mtime_s = int(stat.st_mtime)
-            mtime_ns = stat.st_mtime_ns % 10**9
+# Below this many entries to compare, the vectorized comparison
+# doesn't make up for importing NumPy.
+INDEX_COLUMNS_MIN = 100000
+
+def index_entries_unclean(index, pairs, index_mtime):
+    """ pairs is a list of (position in the index, os.lstat() result).
+    Return a list of booleans telling, for each pair, whether the file
+    may have changed: its stat data doesn't match the entry's, or the
+    entry is racy.  Large batches are compared with NumPy, when it's
+    installed. """
+    columns = None
+    if len(pairs) >= INDEX_COLUMNS_MIN:
+        columns = index_columns(index)
+
+    if columns is None:
+        entries = index.entries
+        return [ not index_entry_stat_matches(entries[i], st) or index_entry_is_racy(entries[i], index_mtime)
+                 for (i, st) in pairs ]
+
+    matches, racy = columns.compare([ i for (i, _) in pairs ], [ st for (_, st) in pairs ], index_mtime)
+    return (~matches | racy).tolist()
+
+def index_entry_stat_matches(entry, st):
+    """ Return True if st, an os.lstat() result, matches the stat data
+    cached in entry.  All fields are compared modulo 32 bits, as
+    that's what the index stores. """
+    if stat.S_ISLNK(st.st_mode):
+        mode_type = 0b1010
+    elif stat.S_ISREG(st.st_mode):
+        mode_type = 0b1000
+    else:
+        return False
 
-            entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
-                                  mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                                  fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                                  flag_stage=False, name=relpath)
-            index.entries.append(entry)
+    return entry.mode_type == mode_type \
+        and entry.mtime == ((st.st_mtime_ns // 10**9) & 0xFFFFFFFF, st.st_mtime_ns % 10**9) \
+        and entry.ctime == ((st.st_ctime_ns // 10**9) & 0xFFFFFFFF, st.st_ctime_ns % 10**9) \
+        and entry.fsize == st.st_size & 0xFFFFFFFF \
+        and entry.ino == st.st_ino & 0xFFFFFFFF \
+        and entry.dev == st.st_dev & 0xFFFFFFFF \
+        and entry.uid == st.st_uid & 0xFFFFFFFF \
+        and entry.gid == st.st_gid & 0xFFFFFFFF
+
+def index_entry_is_racy(entry, index_mtime):
+    """ Return True if entry is racily clean: the file was modified no
+    earlier than the index was written.  Another modification within
+    the same timestamp tick wouldn't change the stat data, so the stat
+    data can't be trusted and the content must be checked. """
+    if index_mtime is None:
+        return True
+    return entry.mtime[0] * 10**9 + entry.mtime[1] >= index_mtime
+
+def index_mtime_ns(repo):
+    """ Return the index file's mtime in nanoseconds, or None """
+    try:
+        return os.stat(repo_file(repo, "index")).st_mtime_ns
+    except FileNotFoundError:
+        return None
 
-    # Write the index back
-    index_write(repo, index)
+def index_entry_refresh(entry, st):
+    """ Return a copy of entry, with the stat data from st.  Entries
+    are never changed in place: a split index tells the entries of its
+    shared index from changed ones by identity. """
+    fresh = index_entry_from_stat(entry.name, entry.sha, st)
+    for field in ("mode_type", "mode_perms", "flag_assume_valid", "flag_stage",
+                  "flag_skip_worktree", "flag_intent_to_add"):
+        setattr(fresh, field, getattr(entry, field))
+    return fresh
+
+def worktree_file_hash(path, st):
+    """ Hash the worktree file at path, whose os.lstat() is st, as a
+    blob.  A symlink's blob is its target. """
+    if stat.S_ISLNK(st.st_mode):
+        return object_write(GitBlob(os.fsencode(os.readlink(path))))
+    with open(path, "rb") as fd:
+        return object_hash(fd, b"blob", None)
+
+def index_entry_from_stat(name, sha, stat):
+    """ Build an index entry for a regular file, from its os.stat() """
+    ctime_s = stat.st_ctime_ns // 10**9
+    ctime_ns = stat.st_ctime_ns % 10**9
+    mtime_s = stat.st_mtime_ns // 10**9
+    mtime_ns = stat.st_mtime_ns % 10**9
+
+    # The index only has 32 bits for these; git truncates them too.
+    return GitIndexEntry(ctime=(ctime_s & 0xFFFFFFFF, ctime_ns),
+                         mtime=(mtime_s & 0xFFFFFFFF, mtime_ns),
+                         dev=stat.st_dev & 0xFFFFFFFF, ino=stat.st_ino & 0xFFFFFFFF,
+                         mode_type=0b1000, mode_perms=0o644,
+                         uid=stat.st_uid & 0xFFFFFFFF, gid=stat.st_gid & 0xFFFFFFFF,
+                         fsize=stat.st_size & 0xFFFFFFFF, sha=sha,
+                         flag_assume_valid=False, flag_stage=False, name=name)
 
 def gitconfig_read():
     xdg_config_home = os.environ["XDG_CONFIG_HOME"] if "XDG_CONFIG_HOME" in os.environ else "~/.config"
@@ -778,67 +1659,62 @@ def gitconfig_user_get(config):
     return None
 
 def tree_from_index(repo, index):
-    contents = dict()
-    contents[""] = list()
-
-    # Enumerate entries, and turn them into a dictionary where keys
-    # are directories, and values are lists of directory contents.
-    for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
-
-        # We create all dictonary entries up to root ("").  We need
-        # them *all*, because even if a directory holds no files it
-        # will contain at least a tree.
-        key = dirname
-        while key != "":
-            if not key in contents:
-                contents[key] = list()
-            key = os.path.dirname(key)
-
-        # For now, simply store the entry in the list.
-        contents[dirname].append(entry)
-
-    # Get keys (= directories) and sort them by length, descending.
-    # This means that we'll always encounter a given path before its
-    # parent, which is all we need, since for each directory D we'll
-    # need to modify its parent P to add D's tree.
-    sorted_paths = sorted(contents.keys(), key=len, reverse=True)
-
-    # This variable will store the current tree's SHA-1.  After we're
-    # done iterating over our dict, it will contain the hash for the
-    # root tree.
-    sha = None
-
-    # We ge through the sorted list of paths (dict keys)
-    for path in sorted_paths:
-        # Prepare a new, empty tree object
-        tree = GitTree()
-
-        # Add each entry to our new tree, in turn
-        for entry in contents[path]:
-            # An entry can be a normal GitIndexEntry read from the
-            # index, or a tree we've created.
-            if isinstance(entry, GitIndexEntry): # Regular entry (a file)
-
-                # We transcode the mode: the entry stores it as integers,
-                # we need an octal ASCII representation for the tree.
-                leaf_mode = f"{entry.mode_type:02o}{entry.mode_perms:04o}".encode("ascii")
-                leaf = GitTreeLeaf(mode = leaf_mode, path=os.path.basename(entry.name), sha=entry.sha)
-            else: # Tree.  We've stored it as a pair: (basename, SHA)
-                leaf = GitTreeLeaf(mode = b"040000", path=entry[0], sha=entry[1])
-
-            tree.items.append(leaf)
-
-        # Write the new tree object to the store.
-        sha = object_write(tree, repo)
-
-        # Add the new tree hash to the current dictionary's parent, as
-        # a pair (basename, SHA)
-        parent = os.path.dirname(path)
-        base = os.path.basename(path) # The name without the path, eg main.go for src/main.go
-        contents[parent].append((base, sha))
-
-    return sha
+    """ Write the trees for the content of the index, and return the
+    SHA of the root tree.
+
+    The index's cache tree remembers the SHA of every directory whose
+    content hasn't changed since its tree was last written: we reuse
+    those, and only write trees for invalidated directories.  The
+    cache tree is updated in place, so the caller should write the
+    index back. """
+    if index.cache_tree is None:
+        index.cache_tree = GitCacheTree()
+
+    # Entries are sorted by path, so each directory's entries are a
+    # contiguous range.
+    return cache_tree_update(repo, index.cache_tree, index.entries, 0, len(index.entries), "")
+
+def cache_tree_update(repo, node, entries, start, end, prefix):
+    """ Return the SHA of the tree for entries[start:end], which are
+    all under the directory prefix, using node, its cache tree node. """
+    if node.entry_count == end - start:
+        return node.sha
+
+    tree = GitTree()
+    subtrees = dict()
+
+    i = start
+    while i < end:
+        name = entries[i].name[len(prefix):]
+
+        if "/" in name:
+            # A subdirectory: find the range of its entries and recurse.
+            base = name.split("/", 1)[0]
+            subprefix = prefix + base + "/"
+            j = i + 1
+            while j < end and entries[j].name.startswith(subprefix):
+                j += 1
+
+            sub = node.subtrees.get(base) or GitCacheTree()
+            sha = cache_tree_update(repo, sub, entries, i, j, subprefix)
+            subtrees[base] = sub
+            tree.items.append(GitTreeLeaf(mode=b"040000", path=base, sha=sha))
+            i = j
+        else:
+            # A regular entry (a file).  We transcode the mode: the
+            # entry stores it as integers, we need an octal ASCII
+            # representation for the tree.
+            entry = entries[i]
+            leaf_mode = f"{entry.mode_type:02o}{entry.mode_perms:04o}".encode("ascii")
+            tree.items.append(GitTreeLeaf(mode=leaf_mode, path=name, sha=entry.sha))
+            i += 1
+
+    # Write the new tree object to the store, and remember it.
+    node.sha = object_write(tree, repo)
+    node.entry_count = end - start
+    # Directories that are gone from the index are dropped.
+    node.subtrees = subtrees
+    return node.sha
 
 def commit_create(repo, tree, parent, author, timestamp, message):
     commit = GitCommit() # Create the new commit object.
@@ -860,4 +1736,688 @@ def commit_create(repo, tree, parent, author, timestamp, message):
     commit.kvlm[b"committer"] = author.encode("utf8")
     commit.kvlm[None] = message.encode("utf8")
 
-    return object_write(commit, repo)
\ No newline at end of file
+    return object_write(commit, repo)
+
+def objects_reachable(repo, shas):
+    """ Walk the object graph from shas (commits, tags or trees).
+    Return a list of (sha, fmt, size, name) tuples for every reachable
+    object, where name is the path the object was first met at (or ""
+    for commits and tags). """
+    ret = list()
+    seen = set()
+    # Stack of (sha, fmt, name).  We walk iteratively: histories are
+    # much deeper than Python's recursion limit.
+    todo = [ (sha, None, "") for sha in shas ]
+
+    while todo:
+        sha, fmt, name = todo.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        if fmt == b'blob':
+            # Blobs have no outgoing links: we only need their size.
+            _, size = object_info(repo, sha)
+            ret.append((sha, fmt, size, name))
+            continue
+
+        obj_fmt, data = object_read_raw(repo, sha)
+        ret.append((sha, obj_fmt, len(data), name))
+
+        match obj_fmt:
+            case b'commit':
+                commit = GitCommit(data)
+                todo.append((commit.kvlm[b'tree'].decode("ascii"), b'tree', ""))
+                parents = commit.kvlm.get(b'parent', list())
+                if type(parents) != list:
+                    parents = [ parents ]
+                for p in parents:
+                    todo.append((p.decode("ascii"), b'commit', ""))
+            case b'tag':
+                tag = GitTag(data)
+                todo.append((tag.kvlm[b'object'].decode("ascii"), None, ""))
+            case b'tree':
+                for leaf in GitTree(data).items:
+                    # Submodules (mode 160000) point to commits of
+                    # another repository.
+                    if leaf.mode.startswith(b'16'):
+                        continue
+                    leaf_fmt = b'tree' if leaf.mode.startswith(b'04') else b'blob'
+                    todo.append((leaf.sha, leaf_fmt, os.path.join(name, leaf.path)))
+    return ret
+
+def bitmap_reachable(repo, pack, shas, lookup):
+    """ Same walk as objects_reachable, but using reachability bitmaps
+    (see GitBitmap): lookup(sha) returns the bitmap of commit sha
+    (binary) of pack, or None if it has none.  The walk doesn't go past
+    commits that have one.
+
+    Return (an int bitmap of the objects reached in pack, {sha: (fmt,
+    name)} for those reached outside of it). """
+    # Objects of the pack reached so far.  Unlike those of an int, bits
+    # of a bytearray are cheap to test and set one at a time.
+    seen = bytearray((len(pack) + 7) // 8)
+    extra = dict()
+
+    def reach(sha, fmt, name):
+        """ Mark sha as reached.  Return False if it already was. """
+        pos = pack.pack_position(bytes.fromhex(sha))
+        if pos is None:
+            if sha in extra:
+                return False
+            extra[sha] = (fmt, name)
+            return True
+        if seen[pos >> 3] & (1 << (pos & 7)):
+            return False
+        seen[pos >> 3] |= 1 << (pos & 7)
+        return True
+
+    # Commits and tags first: trees are only walked once we know which
+    # ones the bitmaps don't already cover.
+    todo = [ (sha, None) for sha in shas ]
+    trees = list()
+    while todo:
+        sha, fmt = todo.pop()
+        if fmt is None:
+            fmt, _ = object_info(repo, sha)
+        if fmt in (b'tree', b'blob'):
+            trees.append((sha, fmt, ""))
+            continue
+
+        if fmt == b'commit':
+            pos = pack.pack_position(bytes.fromhex(sha))
+            if pos is not None and not seen[pos >> 3] & (1 << (pos & 7)):
+                value = lookup(bytes.fromhex(sha))
+                if value is not None:
+                    value |= int.from_bytes(seen, "little")
+                    seen[:] = value.to_bytes(len(seen), "little")
+                    continue
+        if not reach(sha, fmt, ""):
+            continue
+
+        _, data = object_read_raw(repo, sha)
+        if fmt == b'commit':
+            tree, parents, _ = commit_parse(data)
+            trees.append((tree, b'tree', ""))
+            todo += [ (p, b'commit') for p in parents ]
+        else:
+            todo.append((GitTag(data).kvlm[b'object'].decode("ascii"), None))
+
+    while trees:
+        sha, fmt, name = trees.pop()
+        if not reach(sha, fmt, name) or fmt == b'blob':
+            continue
+        _, data = object_read_raw(repo, sha)
+        for leaf in GitTree(data).items:
+            if leaf.mode.startswith(b'16'):
+                continue
+            leaf_fmt = b'tree' if leaf.mode.startswith(b'04') else b'blob'
+            trees.append((leaf.sha, leaf_fmt, os.path.join(name, leaf.path)))
+
+    return int.from_bytes(seen, "little"), extra
+
+def bitmap_objects(repo, bitmap, shas):
+    """ Same as objects_reachable, using the GitBitmap bitmap.  Objects
+    found in bitmaps come with the name hash the bitmap file recorded
+    (an int) instead of a name. """
+    pack = bitmap.pack
+    value, extra = bitmap_reachable(repo, pack, shas, bitmap.commit_bitmap)
+
+    ret = list()
+    order = pack.revindex()
+    for fmt in BITMAP_TYPES:
+        for pos in bitmap_positions(value & bitmap.types[fmt]):
+            i = order[pos]
+            _, size = pack.info_at(pack.offset(i), lambda base: object_info(repo, base))
+            ret.append((pack.sha(i), fmt, size, bitmap.name_hash(i)))
+    for (sha, (fmt, name)) in extra.items():
+        _, size = object_info(repo, sha)
+        ret.append((sha, fmt, size, name))
+    return ret
+
+def bitmap_select(count):
+    """ Yield which of count commits, newest first, get a bitmap: all of
+    the 100 most recent, then one every 100 commits, then less and less
+    often further back, as git does. """
+    i = 0
+    while i < count:
+        yield i
+        if i < 100:
+            i += 1
+        elif i < 20000:
+            i += 100
+        else:
+            i += min(5000, max(100, i - 20000))
+
+def bitmap_create(repo, path, roots, objects):
+    """ Write the reachability bitmaps of the pack at path, which holds
+    objects (as returned by objects_reachable) and everything reachable
+    from them.  Return the number of commits given a bitmap. """
+    pack = next(p for p in pack_list(repo) if p.path == path)
+    graph = commit_graph(repo)
+
+    tips = [ commit_peel(repo, sha) for sha in roots ]
+    tips = [ commit_node(repo, graph, sha) for sha in tips if sha ]
+    nodes = list(commit_walk_topo(repo, graph, tips))
+    tips = set(tips)
+    selected = set(bitmap_select(len(nodes))) | { i for (i, n) in enumerate(nodes) if n in tips }
+
+    # Oldest first, so that walks stop at the bitmaps of the commits
+    # before.
+    computed = dict()
+    commits = list()
+    for i in sorted(selected, reverse=True):
+        sha = bytes.fromhex(commit_node_sha(graph, nodes[i]))
+        value, extra = bitmap_reachable(repo, pack, [sha.hex()], computed.get)
+        if extra:
+            raise Exception(f"Pack {path} doesn't hold everything reachable from {sha.hex()}")
+        computed[sha] = value
+        commits.append((pack.find(sha), value))
+
+    types = { fmt: bytearray((len(pack) + 7) // 8) for fmt in BITMAP_TYPES }
+    hashes = [0] * len(pack)
+    for (sha, fmt, _, name) in objects:
+        i = pack.find(bytes.fromhex(sha))
+        pos = pack.pack_position(bytes.fromhex(sha))
+        types[fmt][pos >> 3] |= 1 << (pos & 7)
+        hashes[i] = name if type(name) == int else pack_name_hash(name)
+    types = { fmt: int.from_bytes(bits, "little") for (fmt, bits) in types.items() }
+
+    if pack.bitmap is not None:
+        pack.bitmap.close()
+        pack.bitmap = None
+    bitmap_write(pack, types, commits, hashes)
+    return len(commits)
+
+def rev_list_bitmap(repo, include, exclude=()):
+    """ Answer a rev-list --objects query with reachability bitmaps.
+    Return (the GitBitmap, an int bitmap of the objects of its pack
+    reachable from include but not from exclude, {sha: (fmt, name)} for
+    those outside the pack), or None if the repository has no
+    bitmaps. """
+    bitmap = pack_bitmap(repo)
+    if bitmap is None:
+        return None
+
+    value, extra = bitmap_reachable(repo, bitmap.pack, include, bitmap.commit_bitmap)
+    if exclude:
+        excluded, excluded_extra = bitmap_reachable(repo, bitmap.pack, exclude, bitmap.commit_bitmap)
+        value &= ~excluded
+        for sha in excluded_extra:
+            extra.pop(sha, None)
+    return bitmap, value, extra
+
+def rev_list_objects(repo, include, exclude=()):
+    """ Yield (sha, name) for every object reachable from include but not
+    from exclude, like git rev-list --objects.  name is the path the
+    object was met at, or "" for commits, tags, and objects found in
+    bitmaps. """
+    ret = rev_list_bitmap(repo, include, exclude)
+    if ret is None:
+        excluded = set(o[0] for o in objects_reachable(repo, exclude))
+        for (sha, _, _, name) in objects_reachable(repo, include):
+            if sha not in excluded:
+                yield sha, name
+        return
+
+    bitmap, value, extra = ret
+    order = bitmap.pack.revindex()
+    for pos in bitmap_positions(value):
+        yield bitmap.pack.sha(order[pos]), ""
+    for (sha, (_, name)) in extra.items():
+        yield sha, name
+
+def rev_list_count(repo, include, exclude=(), objects=False):
+    """ Count the commits (or with objects, all the objects) reachable
+    from include but not from exclude.  With bitmaps, that's a
+    popcount. """
+    ret = rev_list_bitmap(repo, include, exclude)
+    if ret is None:
+        if objects:
+            return sum(1 for _ in rev_list_objects(repo, include, exclude))
+        return sum(1 for _ in rev_list_nodes(repo, include, exclude))
+
+    bitmap, value, extra = ret
+    if not objects:
+        value &= bitmap.types[b'commit']
+        extra = [ sha for (sha, (fmt, _)) in extra.items() if fmt == b'commit' ]
+    return value.bit_count() + len(extra)
+
+def repo_roots(repo):
+    """ Return the SHAs the refs and HEAD point to """
+    roots = ref_list_flatten(ref_list(repo))
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        roots.append(head)
+    return roots
+
+def rev_list_nodes(repo, include, exclude=()):
+    """ Walk the commits reachable from the commits in include, but not
+    from those in exclude, like git rev-list.  Yield them as nodes of
+    the commit-graph walk (see GitCommitGraph), newest first. """
+    graph = commit_graph(repo)
+    include = [ commit_node(repo, graph, sha) for sha in include ]
+    exclude = [ commit_node(repo, graph, sha) for sha in exclude ]
+
+    if exclude:
+        nodes = rev_list_limit(repo, graph, include, exclude)
+        nodes.sort(key=lambda n: -n[0])
+        for (_, node) in nodes:
+            yield node
+        return
+
+    yield from commit_walk(repo, graph, include)
+
+def commit_walk(repo, graph, starts, since=None, until=None):
+    """ Yield the commits reachable from starts, newest first by commit
+    date.  Commits are walk nodes (see GitCommitGraph).
+
+    The newest commit is popped from a priority queue, yielded, and its
+    parents queued: the walk goes no further than the caller reads.
+    Commits older than since (a Unix timestamp) are neither yielded nor
+    walked past, as with git log --since.  Commits newer than until
+    aren't yielded. """
+    # Parents and date of the queued nodes.  The counter breaks ties,
+    # so that nodes are never compared.
+    info = dict()
+    heap = list()
+    for node in starts:
+        if node not in info:
+            info[node] = commit_node_info(repo, graph, node)
+            heap.append((-info[node][2], len(heap), node))
+    heapq.heapify(heap)
+    counter = len(heap)
+    seen = set(info)
+
+    while heap:
+        _, _, node = heapq.heappop(heap)
+        parents, _, date = info.pop(node)
+        if since is not None and date < since:
+            continue
+        if until is None or date <= until:
+            yield node
+        for p in parents:
+            if p not in seen:
+                seen.add(p)
+                info[p] = commit_node_info(repo, graph, p)
+                heapq.heappush(heap, (-info[p][2], counter, p))
+                counter += 1
+
+def commit_walk_topo(repo, graph, starts, since=None, until=None):
+    """ Same as commit_walk, but in topological order: no commit comes
+    before one of its children, and lines of history aren't mixed, as
+    with git log --topo-order.
+
+    Commits are yielded once all their children were (their "indegree"
+    drops to zero).  As git does, we only count children down to the
+    generation of the commits we're about to yield: no commit of a
+    lower generation can be their child.  With a commit-graph, this
+    streams; without one, every generation is infinite, and all of
+    history is counted first. """
+    info = dict()
+    # Children not yielded yet, plus one, of the commits counted so
+    # far
+    indegree = dict()
+    # Commits whose parents must be counted, by decreasing generation
+    queue = list()
+    counter = 0
+
+    min_generation = GENERATION_INFINITY + 1
+    for node in starts:
+        if node in indegree:
+            continue
+        info[node] = commit_node_info(repo, graph, node)
+        indegree[node] = 1
+        _, generation, date = info[node]
+        heapq.heappush(queue, (-generation, -date, counter, node))
+        counter += 1
+        min_generation = min(min_generation, generation)
+
+    def count_down_to(cutoff):
+        nonlocal counter
+        while queue and -queue[0][0] >= cutoff:
+            _, _, _, node = heapq.heappop(queue)
+            for p in info[node][0]:
+                if p in indegree:
+                    indegree[p] += 1
+                    continue
+                indegree[p] = 2
+                if p not in info:
+                    info[p] = commit_node_info(repo, graph, p)
+                _, generation, date = info[p]
+                heapq.heappush(queue, (-generation, -date, counter, p))
+                counter += 1
+
+    count_down_to(min_generation)
+
+    # Commits ready to be yielded.  A stack, so that we follow a line
+    # of history as long as we can.
+    ready = [ node for node in indegree if indegree[node] == 1 ]
+    ready.reverse()
+    while ready:
+        node = ready.pop()
+        parents, _, date = info[node]
+        if since is not None and date < since:
+            continue
+        if until is None or date <= until:
+            yield node
+
+        for p in parents:
+            if p not in info:
+                info[p] = commit_node_info(repo, graph, p)
+            generation = info[p][1]
+            if generation < min_generation:
+                min_generation = generation
+                count_down_to(min_generation)
+            indegree[p] -= 1
+            if indegree[p] == 1:
+                ready.append(p)
+
+# Units of relative dates, in seconds
+DATE_UNITS = { "second": 1,
+               "minute": 60,
+               "hour": 60 * 60,
+               "day": 24 * 60 * 60,
+               "week": 7 * 24 * 60 * 60,
+               "month": 30 * 24 * 60 * 60,
+               "year": 365 * 24 * 60 * 60 }
+
+def date_parse(value):
+    """ Parse a date, as given to --since and --until: a Unix timestamp
+    (optionally prefixed with @), "<n> <unit>s ago", or an ISO 8601
+    date (in local time unless it says otherwise).  Return a Unix
+    timestamp. """
+    value = value.strip()
+    if value.lstrip("@").isdigit():
+        return int(value.lstrip("@"))
+
+    words = value.lower().replace(".", " ").split()
+    if len(words) == 3 and words[0].isdigit() and words[2] == "ago" \
+       and words[1].rstrip("s") in DATE_UNITS:
+        return int(time.time()) - int(words[0]) * DATE_UNITS[words[1].rstrip("s")]
+
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise Exception(f"Invalid date: {value}")
+
+def rev_list(repo, include, exclude=()):
+    """ Same as rev_list_nodes, but yield SHAs """
+    graph = commit_graph(repo)
+    for node in rev_list_nodes(repo, include, exclude):
+        yield commit_node_sha(graph, node)
+
+# How many more commits rev_list_limit walks once everything queued is
+# excluded, when it walks by date: as git's SLOP, this lets an excluded
+# commit dated before its parent (clock skew) still exclude it.
+LIMIT_SLOP = 5
+
+def rev_list_limit(repo, graph, include, exclude):
+    """ Return the (date, node) of the commits reachable from include
+    but not from exclude.
+
+    Commits are visited by decreasing generation number, so that all
+    the descendants of a commit that we'll ever meet are visited before
+    it: when we reach it, we know whether it's excluded.  We stop as
+    soon as everything queued is excluded, instead of walking all of
+    history down from exclude.
+
+    Commits outside the commit-graph have an infinite generation, and
+    are visited by date only.  Then a commit may turn out to be excluded
+    after we visited it, so we keep walking LIMIT_SLOP commits past that
+    point, and mark what we visited as we go. """
+    uninteresting = set(exclude)
+    seen = set()
+    # Parents, generation and date of the queued nodes
+    info = dict()
+    # Parents of the visited nodes, to mark them later if needed
+    visited = dict()
+    heap = list()
+    # Queued nodes that aren't excluded
+    pending = 0
+    by_date = False
+
+    def queue(node, excluded):
+        nonlocal pending, by_date
+        seen.add(node)
+        if excluded:
+            uninteresting.add(node)
+        else:
+            pending += 1
+        info[node] = commit_node_info(repo, graph, node)
+        _, generation, date = info[node]
+        by_date = by_date or generation == GENERATION_INFINITY
+        heapq.heappush(heap, (-generation, -date, len(seen), node))
+
+    def mark(node):
+        """ Mark node excluded, and the ancestors we visited already """
+        nonlocal pending
+        todo = [ node ]
+        while todo:
+            node = todo.pop()
+            if node in uninteresting:
+                continue
+            uninteresting.add(node)
+            if node in info:
+                pending -= 1
+            else:
+                todo += visited.get(node, ())
+
+    for node in exclude + include:
+        if node not in seen:
+            queue(node, node in uninteresting)
+
+    ret = list()
+    slop = LIMIT_SLOP
+    while heap and (pending or (by_date and slop)):
+        if not pending:
+            slop -= 1
+        _, _, _, node = heapq.heappop(heap)
+        parents, _, date = info.pop(node)
+        visited[node] = parents
+        excluded = node in uninteresting
+        if not excluded:
+            pending -= 1
+            ret.append((date, node))
+
+        for p in parents:
+            if p in seen:
+                # Already queued or visited: it may become excluded.
+                if excluded:
+                    mark(p)
+                continue
+            queue(p, excluded)
+
+    return [ (date, node) for (date, node) in ret if node not in uninteresting ]
+
+# Flags of merge_bases()
+MERGE_PARENT1 = 1
+MERGE_PARENT2 = 2
+MERGE_STALE = 4
+
+def merge_bases(repo, one, two):
+    """ Return the best common ancestors of commits one and two, as
+    git merge-base --all does.
+
+    Ancestors of one and two are painted with a flag each, by
+    decreasing generation.  A commit with both flags is a common
+    ancestor, and its own ancestors are marked stale: they can't be
+    better ones.  We stop when only stale commits are queued. """
+    if one == two:
+        return [ one ]
+
+    graph = commit_graph(repo)
+    flags = dict()
+    info = dict()
+    heap = list()
+    counter = 0
+    for (sha, flag) in ((one, MERGE_PARENT1), (two, MERGE_PARENT2)):
+        node = commit_node(repo, graph, sha)
+        flags[node] = flag
+        info[node] = commit_node_info(repo, graph, node)
+        _, generation, date = info[node]
+        heapq.heappush(heap, (-generation, -date, counter, node))
+        counter += 1
+
+    bases = list()
+    while any(not flags[n] & MERGE_STALE for (_, _, _, n) in heap):
+        _, _, _, node = heapq.heappop(heap)
+        flag = flags[node]
+        if flag & (MERGE_PARENT1 | MERGE_PARENT2 | MERGE_STALE) == MERGE_PARENT1 | MERGE_PARENT2:
+            if node not in bases:
+                bases.append(node)
+            flag |= MERGE_STALE
+
+        parents, _, _ = info[node]
+        for p in parents:
+            if flags.get(p, 0) & flag == flag:
+                continue
+            flags[p] = flags.get(p, 0) | flag
+            if p not in info:
+                info[p] = commit_node_info(repo, graph, p)
+            _, generation, date = info[p]
+            heapq.heappush(heap, (-generation, -date, counter, p))
+            counter += 1
+
+    # A base that's an ancestor of another base isn't a best one.
+    # Those reached from another base got stale; the walk order may
+    # have let others through when dates are skewed, so check.
+    bases = [ b for b in bases if not flags[b] & MERGE_STALE ]
+    if len(bases) > 1:
+        bases = [ b for b in bases
+                  if not commit_is_ancestor(repo, graph, b, [ o for o in bases if o != b ]) ]
+    return [ commit_node_sha(graph, b) for b in bases ]
+
+def commit_is_ancestor(repo, graph, node, descendants):
+    """ Return True if node is reachable from one of descendants (all
+    walk nodes).  Commits with a lower generation number than node
+    can't lead to it, so we don't look past them. """
+    _, generation, _ = commit_node_info(repo, graph, node)
+    seen = set(descendants)
+    todo = list(descendants)
+    while todo:
+        current = todo.pop()
+        if current == node:
+            return True
+        parents, current_generation, _ = commit_node_info(repo, graph, current)
+        if current_generation < generation:
+            continue
+        for p in parents:
+            if p not in seen:
+                seen.add(p)
+                todo.append(p)
+    return False
+
+def ref_list_flatten(refs):
+    """ Return the SHAs in a nested dict as returned by ref_list. """
+    ret = list()
+    for v in refs.values():
+        if type(v) == dict:
+            ret += ref_list_flatten(v)
+        elif v:
+            ret.append(v)
+    return ret
+
+def objects_disk_usage(repo):
+    """ Return (number of files, bytes on disk) under objects/ """
+    count = 0
+    size = 0
+    for (root, _, files) in os.walk(repo_file(repo, "objects")):
+        for f in files:
+            count += 1
+            size += os.stat(os.path.join(root, f)).st_blocks * 512
+    return count, size
+
+def object_read_latency(repo, shas):
+    """ Return the average time, in microseconds, it takes to read
+    each of shas from storage. """
+    if not shas:
+        return 0.0
+    start = time.perf_counter()
+    for sha in shas:
+        object_read_uncached(repo, sha)
+    return (time.perf_counter() - start) * 10**6 / len(shas)
+
+def repack(repo, window=10, depth=50):
+    """ Pack every object reachable from the refs, HEAD and the index
+    into a single packfile, then prune the loose objects and the old
+    packs it makes redundant. """
+    roots = repo_roots(repo)
+    bitmap = pack_bitmap(repo)
+    if bitmap is not None:
+        objects = bitmap_objects(repo, bitmap, roots)
+    else:
+        objects = objects_reachable(repo, roots)
+
+    # Blobs staged but not committed yet are only referenced by the
+    # index.
+    known = set(o[0] for o in objects)
+    for e in index_read(repo).entries:
+        if e.sha not in known:
+            known.add(e.sha)
+            _, size = object_info(repo, e.sha)
+            objects.append((e.sha, b'blob', size, e.name))
+
+    if not objects:
+        print("Nothing to pack.")
+        return
+
+    # Measure reads on an evenly spread sample of the objects.
+    sample = [ o[0] for o in objects[::max(1, len(objects) // 1000)] ]
+
+    files_before, size_before = objects_disk_usage(repo)
+    latency_before = object_read_latency(repo, sample)
+
+    old_packs = list(pack_list(repo))
+    path, count, deltas = pack_write(repo, objects,
+                                     lambda sha: object_read_uncached(repo, sha),
+                                     window, depth)
+
+    # Prune loose objects, now that they are packed.
+    for sha in known:
+        loose = repo_file(repo, "objects", sha[0:2], sha[2:])
+        if os.path.isfile(loose):
+            os.unlink(loose)
+            try:
+                os.rmdir(os.path.dirname(loose))
+            except OSError:
+                pass # Not empty
+
+    # Drop the old packs, unless they hold objects we didn't repack
+    # (unreachable ones): we never destroy data here.
+    for pack in old_packs:
+        if pack.path == path:
+            continue
+        if all(pack.sha(i) in known for i in range(len(pack))):
+            pack.close()
+            os.unlink(pack.path)
+            os.unlink(pack.path[:-len(".pack")] + ".idx")
+            if os.path.exists(pack.path[:-len(".pack")] + ".bitmap"):
+                os.unlink(pack.path[:-len(".pack")] + ".bitmap")
+
+    # A multi-pack-index naming the packs we dropped would be ignored:
+    # cover the packs left instead.
+    if os.path.exists(repo_file(repo, "objects", "pack", "multi-pack-index")):
+        midx_write(repo, pack_list(repo))
+
+    files_after, size_after = objects_disk_usage(repo)
+    latency_after = object_read_latency(repo, sample)
+
+    print(f"Packed {count} objects ({deltas} deltas) into {os.path.basename(path)}")
+    print(f"Disk usage: {files_before} files, {size_before // 1024} KiB -> "
+          f"{files_after} files, {size_after // 1024} KiB")
+    print(f"Object read latency: {latency_before:.1f}us -> {latency_after:.1f}us per object")
+
+    # Like git gc, refresh the commit-graph while we're at it.
+    if repo.conf.getboolean("gc", "writecommitgraph", fallback=True):
+        count = commit_graph_write(repo, roots)
+        print(f"Wrote a commit-graph of {count} commits.")
+
+    if repo.conf.getboolean("repack", "writebitmaps", fallback=True):
+        count = bitmap_create(repo, path, roots, objects)
+        print(f"Wrote reachability bitmaps for {count} commits.")
+
+    # And like git gc, pack the refs.
+    if repo.conf.getboolean("gc", "packrefs", fallback=True):
+        count = refs_pack(repo, True, lambda sha: tag_peel(repo, sha))
+        print(f"Packed {count} refs.")
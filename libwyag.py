@@ -15,11 +15,24 @@ argsp.add_argument("path",
                     nargs="?",
                     default=".",
                     help="Where to create the repository.")
+argsp.add_argument("--ref-format",
+                   choices=["files", "reftable"],
+                   default="files",
+                   help="How to store refs: as files (the default), or in reftables, for millions of refs")
 
 # cat-file
 argsp = argsubparsers.add_parser("cat-file", help="Provide content of repository objects")
+argsp.add_argument("-t",
+                    dest="show_type",
+                    action="store_true",
+                    help="Show the object's type instead of its content")
+argsp.add_argument("-s",
+                    dest="show_size",
+                    action="store_true",
+                    help="Show the object's size instead of its content")
 argsp.add_argument("type",
                     metavar="type",
+                    nargs="?",
                     choices=["blob", "commit", "tag", "tree"],
                     help="Specify the type")
 argsp.add_argument("object",
@@ -49,6 +62,62 @@ argsp.add_argument("commit",
                     default="HEAD",
                     nargs="?",
                     help="Commit to start at.")
+argsp.add_argument("-n", "--max-count",
+                    type=int,
+                    default=None,
+                    metavar="number",
+                    help="Show at most this many commits.")
+argsp.add_argument("--since", "--after",
+                    metavar="date",
+                    help="Show commits more recent than a date.")
+argsp.add_argument("--until", "--before",
+                    metavar="date",
+                    help="Show commits older than a date.")
+argsp.add_argument("--topo-order",
+                    action="store_true",
+                    help="Never show a commit before its children, and don't intermix lines of history.")
+argsp.add_argument("--oneline",
+                    action="store_true",
+                    help="Show each commit on one line, instead of as a Graphviz graph.")
+argsp.add_argument("path",
+                    nargs="*",
+                    help="Only list the commits that changed these paths (after --).")
+
+# rev-list
+argsp = argsubparsers.add_parser("rev-list", help="List commits in reverse chronological order.")
+argsp.add_argument("--count",
+                   action="store_true",
+                   help="Only print the number of commits")
+argsp.add_argument("--objects",
+                   action="store_true",
+                   help="List (or count) the trees, blobs and tags too")
+argsp.add_argument("commit",
+                   nargs="+",
+                   help="Commits to start from.  Prefix one with ^ to exclude its ancestors.")
+
+# merge-base
+argsp = argsubparsers.add_parser("merge-base", help="Find the best common ancestor of two commits.")
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Print all the best common ancestors, not only one")
+argsp.add_argument("one", help="A commit")
+argsp.add_argument("two", help="Another commit")
+
+# commit-graph
+argsp = argsubparsers.add_parser("commit-graph", help="Write the commit-graph file.")
+argsp.add_argument("action",
+                   choices=["write"],
+                   help="Write a commit-graph of the commits reachable from the refs")
+argsp.add_argument("--changed-paths",
+                   action="store_true",
+                   default=None,
+                   help="Include changed-path Bloom filters (default: if the current graph has them)")
+
+# multi-pack-index
+argsp = argsubparsers.add_parser("multi-pack-index", help="Write the multi-pack-index file.")
+argsp.add_argument("action",
+                   choices=["write"],
+                   help="Write a multi-pack-index of every pack")
 
 # ls-tree
 argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object")
@@ -67,6 +136,12 @@ argsp.add_argument("commit",
 argsp.add_argument("path",
                    help="The EMPTY directoy to checkout on.")
 
+# pack-refs
+argsp = argsubparsers.add_parser("pack-refs", help="Move loose refs into packed-refs.")
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Pack branches too, not just tags and the refs already packed")
+
 # show ref
 argsp = argsubparsers.add_parser("show-ref", help="List References")
 
@@ -84,14 +159,6 @@ argsp = argsubparsers.add_parser(
     "rev-parse",
     help="Parse revision (or other objects) identifiers")
 
-# ls-files
-argsp = argsubparsers.add_parser("ls-files", help = "List all the stage files")
-argsp.add_argument("--verbose", action="store_true", help="Show everything.")
-
-# check-ignore
-argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
-argsp.add_argument("path", nargs="+", help="Paths to check")
-
 argsp.add_argument("--wyag-type",
                     metavar="type",
                     dest="type",
@@ -101,6 +168,14 @@ argsp.add_argument("--wyag-type",
 
 argsp.add_argument("name", help="The name to parse")
 
+# ls-files
+argsp = argsubparsers.add_parser("ls-files", help = "List all the stage files")
+argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+
+# check-ignore
+argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
+argsp.add_argument("path", nargs="+", help="Paths to check")
+
 # status
 argsp = argsubparsers.add_parser("status", help = "Show the working tree status.")
 
@@ -110,6 +185,10 @@ argsp.add_argument("path", nargs="+", help="Files to remove")
 
 # add
 argsp = argsubparsers.add_parser("add", help = "Add files contents to the index.")
+argsp.add_argument("-j", "--jobs",
+                   type=int,
+                   default=None,
+                   help="Number of processes hashing files (default: number of CPUs)")
 argsp.add_argument("path", nargs="+", help="Files to add")
 
 # commit
@@ -119,20 +198,53 @@ argsp.add_argument("-m",
                    dest="message",
                    help="Message to associate with this commit.")
 
+# fsmonitor
+argsp = argsubparsers.add_parser("fsmonitor", help="Run a daemon watching the worktree for changes.")
+argsp.add_argument("action",
+                   choices=["start", "stop", "status", "run"],
+                   help="start or stop the daemon in the background, show its status, or run it in the foreground")
+
+# repack
+argsp = argsubparsers.add_parser("repack", aliases=["gc"],
+                                 help="Pack reachable objects into a single packfile.")
+argsp.add_argument("--window",
+                   type=int,
+                   default=None,
+                   help="Number of objects to try as delta bases (default: pack.window, or 10)")
+argsp.add_argument("--depth",
+                   type=int,
+                   default=None,
+                   help="Maximum delta chain length (default: pack.depth, or 50)")
+
 
 def main(argv=sys.argv[1:]):
+    # For log, paths come after "--", as with git: on its own,
+    # argparse would take the first one for the commit.
+    paths = None
+    if argv[:1] == ["log"] and "--" in argv:
+        i = argv.index("--")
+        argv, paths = argv[:i], argv[i+1:]
     args = argparser.parse_args(argv)
+    if paths is not None:
+        args.path = paths
     match args.command:
         case "add"          : cmd_add(args)
         case "cat-file"     : cmd_cat_file(args)
         case "check-ignore" : cmd_check_ignore(args)
         case "checkout"     : cmd_checkout(args)
         case "commit"       : cmd_commit(args)
+        case "commit-graph" : cmd_commit_graph(args)
+        case "fsmonitor"    : cmd_fsmonitor(args)
         case "hash-object"  : cmd_hash_object(args)
         case "init"         : cmd_init(args)
         case "log"          : cmd_log(args)
         case "ls-files"     : cmd_ls_files(args)
         case "ls-tree"      : cmd_ls_tree(args)
+        case "merge-base"   : cmd_merge_base(args)
+        case "multi-pack-index" : cmd_multi_pack_index(args)
+        case "pack-refs"    : cmd_pack_refs(args)
+        case "repack" | "gc": cmd_repack(args)
+        case "rev-list"     : cmd_rev_list(args)
         case "rev-parse"    : cmd_rev_parse(args)
         case "rm"           : cmd_rm(args)
         case "show-ref"     : cmd_show_ref(args)